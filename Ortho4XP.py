@@ -80,5 +80,6 @@ if __name__ == '__main__':
             print("Bon vol!")
         except:
             print("Crash!")
+        TILE.shutdown()
  
         
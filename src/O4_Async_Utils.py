@@ -0,0 +1,464 @@
+import asyncio
+import concurrent.futures
+import functools
+import io
+import threading
+import time
+from PIL import Image
+import O4_Imagery_Utils as IMG
+import O4_Cache_Utils as CACHE
+import O4_Http_Utils as HTTP
+import O4_UI_Utils as UI
+
+has_aiohttp = False
+try:
+    import aiohttp
+
+    has_aiohttp = True
+except:
+    pass
+
+# Event loop download engine : a single loop, running in its own daemon
+# thread, keeps the requests of all textures being built in flight at once.
+# Each provider gets one aiohttp session, and its requests go through the
+# same rate limiter as with the threads engine (HTTP.get_limiter), here
+# allowed to go up to max_requests in the provider definition or
+# async_max_requests simultaneous requests. Decoding and pasting of the tiles
+# is done by a small pool of worker threads so that the loop is never
+# blocked by PIL. Requests for a URL already in flight await it, as with
+# HTTP.coalesced.
+
+loop = None
+loop_thread = None
+loop_lock = threading.Lock()
+decode_pool = None
+providers_state = {}
+inflight = {}
+
+################################################################################
+def supports(provider):
+    if not has_aiohttp:
+        return False
+    if IMG.has_URL and provider["code"] in IMG.URL.custom_url_list:
+        return True
+    return provider["request_type"] in ("tms", "wmts")
+
+
+################################################################################
+
+################################################################################
+def get_loop():
+    global loop, loop_thread, decode_pool
+    with loop_lock:
+        if loop is None:
+            decode_pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(1, int(IMG.async_decode_workers)),
+                thread_name_prefix="O4_decode",
+            )
+            loop = asyncio.new_event_loop()
+            loop_thread = threading.Thread(target=loop.run_forever, daemon=True)
+            loop_thread.start()
+        return loop
+
+
+################################################################################
+
+################################################################################
+def provider_state(provider):
+    # only ever called from within the loop, hence no lock
+    code = provider["code"]
+    if code not in providers_state:
+        limiter = HTTP.get_limiter(provider, int(IMG.async_max_requests))
+        max_requests = limiter.max_window
+        connector = aiohttp.TCPConnector(limit=max_requests, limit_per_host=0)
+        timeout = aiohttp.ClientTimeout(
+            total=None,
+            sock_connect=IMG.http_timeout,
+            sock_read=IMG.http_timeout,
+        )
+        session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        providers_state[code] = (session, limiter)
+        UI.vprint(
+            3,
+            "Opened asyncio session for",
+            code,
+            "with",
+            max_requests,
+            "simultaneous requests.",
+        )
+    return providers_state[code]
+
+
+################################################################################
+
+################################################################################
+async def acquire(limiter):
+    loop = asyncio.get_running_loop()
+    while True:
+        # registered first so that a release in between is not missed
+        future = loop.create_future()
+        limiter.add_async_waiter(loop, future)
+        wait = limiter.try_acquire()
+        if wait == 0:
+            return
+        try:
+            await asyncio.wait_for(
+                future, 0.5 if wait is None else min(wait, 0.5)
+            )
+        except asyncio.TimeoutError:
+            pass
+
+
+################################################################################
+
+################################################################################
+def decode_image(content):
+    small_image = Image.open(io.BytesIO(content))
+    small_image.load()
+    return small_image
+
+
+################################################################################
+
+################################################################################
+async def http_request_to_image(url, request_headers, provider, cache_key):
+    # The images are decoded already and only read by the callers, those
+    # awaiting a request in flight share its one.
+    key = HTTP.request_key(url, provider["code"], request_headers)
+    task = inflight.get(key)
+    HTTP.count_request(task is not None)
+    if task is None:
+        task = inflight[key] = asyncio.ensure_future(
+            request_image(url, request_headers, provider, cache_key)
+        )
+        task.add_done_callback(functools.partial(forget_request, key))
+    return await asyncio.shield(task)
+
+
+################################################################################
+
+################################################################################
+def forget_request(key, task):
+    if inflight.get(key) is task:
+        inflight.pop(key)
+
+
+################################################################################
+
+################################################################################
+async def request_image(url, request_headers, provider, cache_key):
+    # Same answers and retry policy as IMG.http_request_to_image
+    UI.vprint(
+        3, "HTTP request issued :", url, "\nRequest headers :", request_headers
+    )
+    (session, limiter) = provider_state(provider)
+    tentative_request = 0
+    tentative_image = 0
+    status_code = "Connection failure"
+    while True:
+        try:
+            await acquire(limiter)
+            (status, retry_after) = (None, None)
+            start = time.monotonic()
+            try:
+                async with session.get(url, headers=request_headers) as r:
+                    content = await r.read()
+                status = r.status
+                retry_after = r.headers.get("Retry-After")
+            finally:
+                limiter.release(status, time.monotonic() - start, retry_after)
+            status_code = "<Response [" + str(r.status) + "]>"
+            if IMG.is_no_data_answer(url, r.headers):
+                UI.vprint(3, url, r.headers)
+                return (0, "[404]")
+            if r.status == 200 and "image" in r.headers.get(
+                "Content-Type", ""
+            ):
+                try:
+                    small_image = await asyncio.get_running_loop(
+                    ).run_in_executor(decode_pool, decode_image, content)
+                    if CACHE.tile_cache:
+                        await asyncio.get_running_loop().run_in_executor(
+                            decode_pool, CACHE.put, *cache_key, content
+                        )
+                    return (1, small_image)
+                except:
+                    UI.vprint(
+                        2,
+                        "Server said 'OK', but the received ",
+                        "image was corrupted.",
+                    )
+                    UI.vprint(3, url, r.headers)
+            elif r.status == 404:
+                UI.vprint(2, "Server said 'Not Found'")
+                UI.vprint(3, url, r.headers)
+                break
+            elif r.status == 200:
+                UI.vprint(
+                    2, "Server said 'OK' but sent us the wrong Content-Type."
+                )
+                UI.vprint(3, url, r.headers, content)
+                break
+            elif r.status == 403:
+                UI.vprint(2, "Server said 'Forbidden' ! (IP banned?)")
+                UI.vprint(3, url, r.headers, content)
+                break
+            elif r.status == 429:
+                UI.vprint(2, "Server said 'Too Many Requests', slowing down.")
+                UI.vprint(3, url, r.headers)
+            elif r.status >= 500:
+                UI.vprint(2, "Server said 'Internal Error'.", status_code)
+                if not IMG.check_tms_response:
+                    break
+                await asyncio.sleep(2)
+            else:
+                UI.vprint(2, "Unmanaged Server answer:", status_code)
+                UI.vprint(3, url, r.headers)
+                break
+            if UI.red_flag:
+                return (0, "Stopped")
+            tentative_image += 1
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            status_code = "Connection failure"
+            UI.vprint(2, "Server could not be connected, retrying in 2 secs")
+            UI.vprint(3, e)
+            if not IMG.check_tms_response:
+                break
+            await asyncio.sleep(2)
+            if UI.red_flag:
+                return (0, "Stopped")
+            tentative_request += 1
+        if (
+            tentative_request == IMG.max_connect_retries
+            or tentative_image == IMG.max_baddata_retries
+        ):
+            break
+    return (0, status_code)
+
+
+################################################################################
+
+################################################################################
+async def fetch_wmts_tile(tilematrix, til_x, til_y, provider):
+    cache_key = (provider["code"], tilematrix, til_x, til_y)
+    (success, data) = (0, None)
+    if CACHE.tile_cache:
+        (success, data) = await asyncio.get_running_loop().run_in_executor(
+            decode_pool, IMG.cached_image, cache_key, True
+        )
+    if not success:
+        (url, request_headers) = IMG.wmts_request(
+            tilematrix, til_x, til_y, provider
+        )
+        (success, data) = await http_request_to_image(
+            url, request_headers, provider, cache_key
+        )
+    return (success, data)
+
+
+################################################################################
+
+################################################################################
+async def memoized_parent(parents, tilematrix, til_x, til_y, provider):
+    # Same single flight memo as IMG.memoized_parent, the siblings await the
+    # task of the first one.
+    key = (tilematrix, til_x, til_y)
+    if key not in parents:
+        parents[key] = asyncio.ensure_future(
+            fetch_wmts_tile(tilematrix, til_x, til_y, provider)
+        )
+    task = parents[key]
+    (success, data) = await asyncio.shield(task)
+    if not success and "[404]" not in data and parents.get(key) is task:
+        parents.pop(key)
+    return (success, data)
+
+
+################################################################################
+
+################################################################################
+async def get_wmts_image(tilematrix, til_x, til_y, provider, parents=None):
+    # Same fallback as IMG.get_wmts_image : on a 404 the tile is cut from
+    # lower ZL ones (webmercator grids only).
+    til_x_orig, til_y_orig = til_x, til_y
+    width = height = provider["tile_size"]
+    down_sample = 0
+    while True:
+        if down_sample and parents is not None:
+            (success, data) = await memoized_parent(
+                parents, tilematrix, til_x, til_y, provider
+            )
+        else:
+            (success, data) = await fetch_wmts_tile(
+                tilematrix, til_x, til_y, provider
+            )
+        if success and not down_sample:
+            return (success, data)
+        elif success and down_sample:
+            small_image = await asyncio.get_running_loop().run_in_executor(
+                decode_pool,
+                IMG.upsample_part,
+                data,
+                til_x_orig,
+                til_y_orig,
+                down_sample,
+                width,
+                height,
+            )
+            return (success, small_image)
+        elif "[404]" in data:
+            if ("grid_type" not in provider) or (
+                provider["grid_type"] != "webmercator"
+            ):
+                return (0, None)
+            til_x = til_x // 2
+            til_y = til_y // 2
+            tilematrix -= 1
+            down_sample += 1
+            if down_sample >= 6:
+                return (0, None)
+        else:
+            return (0, None)
+
+
+################################################################################
+
+################################################################################
+def paste(big_image, small_image, x0, y0, width, height):
+    if small_image is None:
+        small_image = Image.new("RGB", (width, height), "white")
+    big_image.paste(small_image, (x0, y0))
+
+
+################################################################################
+
+################################################################################
+async def get_and_paste_wmts_part(
+    tilematrix,
+    til_x,
+    til_y,
+    provider,
+    big_image,
+    x0,
+    y0,
+    progress,
+    failed_cells,
+    parents,
+):
+    (success, small_image) = await get_wmts_image(
+        tilematrix, til_x, til_y, provider, parents
+    )
+    if not success and failed_cells is not None:
+        failed_cells.append((til_x, til_y))
+    width = height = provider["tile_size"]
+    await asyncio.get_running_loop().run_in_executor(
+        decode_pool, paste, big_image, small_image, x0, y0, width, height
+    )
+    if progress:
+        progress["done"] += 1
+        UI.progress_bar(
+            progress["bar"], int(100 * progress["done"] / progress["total"])
+        )
+    return success
+
+
+################################################################################
+
+################################################################################
+async def fill_texture(
+    tilbox, zoomlevel, provider, big_image, progress, failed_cells
+):
+    (til_x_min, til_y_min, til_x_max, til_y_max) = tilbox
+    width = height = provider["tile_size"]
+    # lower ZL tiles shared by the parts of this texture
+    parents = {}
+    parts = [
+        get_and_paste_wmts_part(
+            zoomlevel,
+            til_x,
+            til_y,
+            provider,
+            big_image,
+            (til_x - til_x_min) * width,
+            (til_y - til_y_min) * height,
+            progress,
+            failed_cells,
+            parents,
+        )
+        for til_y in range(til_y_min, til_y_max)
+        for til_x in range(til_x_min, til_x_max)
+    ]
+    if progress:
+        progress["total"] = progress["done"] + len(parts)
+    return all(await asyncio.gather(*parts))
+
+
+################################################################################
+
+################################################################################
+def build_texture_from_tilbox(
+    tilbox, zoomlevel, provider, progress=None, failed_cells=None
+):
+    # Drop-in replacement for IMG.build_texture_from_tilbox, may be called
+    # from any number of threads at once, they all share the same loop.
+    (til_x_min, til_y_min, til_x_max, til_y_max) = tilbox
+    width = height = provider["tile_size"]
+    big_image = Image.new(
+        "RGB",
+        (width * (til_x_max - til_x_min), height * (til_y_max - til_y_min)),
+    )
+    future = asyncio.run_coroutine_threadsafe(
+        fill_texture(
+            tilbox, zoomlevel, provider, big_image, progress, failed_cells
+        ),
+        get_loop(),
+    )
+    while True:
+        try:
+            success = future.result(timeout=0.2)
+            break
+        except concurrent.futures.TimeoutError:
+            if UI.red_flag:
+                future.cancel()
+                return (0, big_image)
+    try:
+        UI.progress_bar(progress["bar"], 100)
+    except:
+        pass
+    return (success, big_image)
+
+
+################################################################################
+
+################################################################################
+async def close_provider_sessions():
+    for (session, _) in providers_state.values():
+        await session.close()
+    providers_state.clear()
+
+
+################################################################################
+
+################################################################################
+def close_sessions():
+    with loop_lock:
+        if loop is None:
+            return
+    asyncio.run_coroutine_threadsafe(close_provider_sessions(), loop).result()
+
+
+################################################################################
+
+################################################################################
+def shutdown():
+    # closes the sessions, then stops the loop and its thread
+    global loop, loop_thread, decode_pool
+    close_sessions()
+    with loop_lock:
+        if loop is None:
+            return
+        loop.call_soon_threadsafe(loop.stop)
+        loop_thread.join()
+        loop.close()
+        decode_pool.shutdown()
+        (loop, loop_thread, decode_pool) = (None, None, None)
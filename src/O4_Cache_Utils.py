@@ -0,0 +1,221 @@
+import os
+import sqlite3
+import threading
+import time
+import O4_File_Names as FNAMES
+import O4_UI_Utils as UI
+
+# Local store of the raw provider answers (256px tiles), keyed by provider
+# code, zoomlevel, x and y, consulted before going to the network. It lives
+# in a single SQLite file in WAL mode, every write is its own transaction so
+# that a crash or a kill never leaves a half written tile behind. The least
+# recently used tiles are evicted once the store is above tile_cache_size.
+
+tile_cache = False
+tile_cache_size = 4096  # in MB
+
+cache_file = os.path.join(FNAMES.Cache_dir, "tiles.sqlite")
+# last access times are only written to the db by batches
+touch_batch = 256
+# once above the size bound, evict down to that fraction of it
+evict_ratio = 0.9
+
+local = threading.local()
+lock = threading.Lock()
+evict_lock = threading.Lock()
+total_size = None
+total_size_file = None
+pending_touches = []
+stats = {"hits": 0, "misses": 0, "stored": 0, "evicted": 0}
+
+################################################################################
+def connection():
+    # one connection per thread, WAL lets readers run while one thread writes
+    global total_size, total_size_file
+    if getattr(local, "db", None) is not None and local.file == cache_file:
+        return local.db
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    db = sqlite3.connect(cache_file, timeout=30)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    with db:
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS tiles ("
+            "provider TEXT, zoomlevel INTEGER, x INTEGER, y INTEGER, "
+            "data BLOB, size INTEGER, last_access REAL, "
+            "PRIMARY KEY (provider, zoomlevel, x, y))"
+        )
+        db.execute(
+            "CREATE INDEX IF NOT EXISTS tiles_lru ON tiles (last_access)"
+        )
+    with lock:
+        if total_size_file != cache_file:
+            total_size = db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM tiles"
+            ).fetchone()[0]
+            total_size_file = cache_file
+    local.db = db
+    local.file = cache_file
+    return db
+
+
+################################################################################
+
+################################################################################
+def get(provider_code, zoomlevel, til_x, til_y):
+    if not tile_cache:
+        return None
+    key = (provider_code, zoomlevel, til_x, til_y)
+    try:
+        row = (
+            connection()
+            .execute(
+                "SELECT data FROM tiles WHERE provider=? AND zoomlevel=? "
+                "AND x=? AND y=?",
+                key,
+            )
+            .fetchone()
+        )
+    except sqlite3.Error as e:
+        UI.vprint(2, "Tile cache could not be read :", e)
+        return None
+    with lock:
+        if row is None:
+            stats["misses"] += 1
+            return None
+        stats["hits"] += 1
+        pending_touches.append((time.time(),) + key)
+        flush = len(pending_touches) >= touch_batch
+    if flush:
+        flush_touches()
+    return row[0]
+
+
+################################################################################
+
+################################################################################
+def flush_touches():
+    global pending_touches
+    with lock:
+        (touches, pending_touches) = (pending_touches, [])
+    if not touches:
+        return
+    try:
+        db = connection()
+        with db:
+            db.executemany(
+                "UPDATE tiles SET last_access=? WHERE provider=? AND "
+                "zoomlevel=? AND x=? AND y=?",
+                touches,
+            )
+    except sqlite3.Error as e:
+        UI.vprint(2, "Tile cache could not be updated :", e)
+
+
+################################################################################
+
+################################################################################
+def put(provider_code, zoomlevel, til_x, til_y, data):
+    global total_size
+    if not tile_cache:
+        return
+    try:
+        db = connection()
+        with db:
+            # a tile fetched again replaces its former row and size
+            row = db.execute(
+                "SELECT size FROM tiles WHERE provider=? AND zoomlevel=? AND "
+                "x=? AND y=?",
+                (provider_code, zoomlevel, til_x, til_y),
+            ).fetchone()
+            replaced_size = row[0] if row else 0
+            db.execute(
+                "INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    provider_code,
+                    zoomlevel,
+                    til_x,
+                    til_y,
+                    sqlite3.Binary(data),
+                    len(data),
+                    time.time(),
+                ),
+            )
+    except sqlite3.Error as e:
+        UI.vprint(2, "Tile cache could not be written :", e)
+        return
+    with lock:
+        stats["stored"] += 1
+        total_size += len(data) - replaced_size
+        evict_needed = total_size > tile_cache_size * 1024 ** 2
+    if evict_needed:
+        evict()
+
+
+################################################################################
+
+################################################################################
+def evict():
+    # least recently used tiles go first
+    if not evict_lock.acquire(blocking=False):
+        # another thread is already at it
+        return
+    try:
+        evict_down()
+    finally:
+        evict_lock.release()
+
+
+################################################################################
+
+################################################################################
+def evict_down():
+    global total_size
+    flush_touches()
+    max_size = tile_cache_size * 1024 ** 2
+    try:
+        db = connection()
+        with db:
+            size = db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM tiles"
+            ).fetchone()[0]
+            for (rowid, tile_size) in db.execute(
+                "SELECT rowid, size FROM tiles ORDER BY last_access"
+            ).fetchall():
+                if size <= evict_ratio * max_size:
+                    break
+                db.execute("DELETE FROM tiles WHERE rowid=?", (rowid,))
+                size -= tile_size
+                with lock:
+                    stats["evicted"] += 1
+    except sqlite3.Error as e:
+        UI.vprint(2, "Tile cache could not be trimmed :", e)
+        return
+    with lock:
+        total_size = size
+
+
+################################################################################
+
+################################################################################
+def print_statistics(min_verbosity=2):
+    if not tile_cache:
+        return
+    flush_touches()
+    with lock:
+        if not (stats["hits"] or stats["misses"]):
+            return
+        UI.vprint(
+            min_verbosity,
+            "     Tile cache :",
+            stats["hits"],
+            "hits,",
+            stats["misses"],
+            "misses,",
+            stats["stored"],
+            "stored,",
+            stats["evicted"],
+            "evicted,",
+            round(total_size / 1024 ** 2, 1),
+            "MB used.",
+        )
@@ -44,8 +44,29 @@ cfg_app_vars = {
         "module": "TILE",
         "type": int,
         "default": 4,
+        "values": (1, 2, 3, 4, 5, 6, 7, 8, 12, 16, 24, 32, 48, 64),
+        "hint": "Number of parallel threads (or processes, see convert_engine) for dds conversion. Should be mainly dictated by the number of cores in your CPU.",
+    },
+    "convert_engine": {
+        "module": "TILE",
+        "type": str,
+        "default": "threads",
+        "values": ("threads", "processes"),
+        "hint": "How the textures are converted. 'threads' runs max_convert_slots conversion threads in Ortho4XP itself, 'processes' runs max_convert_slots separate processes, which lets combined providers, color filters and masks use as many cores as there are slots.",
+    },
+    "download_order": {
+        "module": "TILE",
+        "type": str,
+        "default": "hilbert",
+        "values": ("hilbert", "fifo", "masks", "airports"),
+        "hint": "Order in which the textures of a tile are downloaded. 'hilbert' follows a Hilbert curve so that neighbour textures come one after the other (friendlier to the caches of the providers and to the tile cache), 'fifo' keeps the order in which the DSF build finds them, 'masks' starts with the textures having a mask and 'airports' with the ones above the default zoomlevel, both along the Hilbert curve otherwise. The time to the first texture downloaded and converted is printed at the end of the build.",
+    },
+    "max_download_slots": {
+        "module": "TILE",
+        "type": int,
+        "default": 2,
         "values": (1, 2, 3, 4, 5, 6, 7, 8),
-        "hint": "Number of parallel threads for dds conversion. Should be mainly dictated by the number of cores in your CPU.",
+        "hint": "Number of textures downloaded in parallel during Step 3. The requests to a given provider are still capped by its max_threads, additional slots only help keeping them busy while a texture waits for its slowest tiles.",
     },
     "check_tms_response": {
         "module": "IMG",
@@ -71,6 +92,71 @@ cfg_app_vars = {
         "default": 5,
         "hint": "How much times do we try again after an internal server error for an imagery request. Only used if check_tms_response is set to True.",
     },
+    "download_engine": {
+        "module": "IMG",
+        "type": str,
+        "default": "threads",
+        "values": ("threads", "asyncio"),
+        "hint": "Engine used to download imagery tiles. 'threads' uses a fixed number of download threads per texture (max_threads in the provider definition), 'asyncio' uses a single event loop which can keep many more requests in flight, which helps on high latency links. It requires the aiohttp module, and threads are used when it is missing or for local providers.",
+    },
+    "async_max_requests": {
+        "module": "IMG",
+        "type": int,
+        "default": 128,
+        "hint": "Maximum number of simultaneous requests to one provider with the asyncio download engine, shared by all textures being built. It can be overridden per provider with max_requests in the layer definition.",
+    },
+    "async_decode_workers": {
+        "module": "IMG",
+        "type": int,
+        "default": 4,
+        "values": (1, 2, 3, 4, 5, 6, 7, 8),
+        "hint": "Number of threads which decode and paste the downloaded tiles with the asyncio download engine.",
+    },
+    "dds_encoder": {
+        "module": "IMG",
+        "type": str,
+        "default": "nvcompress",
+        "values": ("nvcompress", "numpy"),
+        "hint": "Program used to compress the textures to DDS. 'nvcompress' is the external converter shipped in Utils, 'numpy' is a built-in encoder working directly from memory (no temporary PNG, no external process), its jobs are spread over all cores.",
+    },
+    "derive_lower_zl": {
+        "module": "IMG",
+        "type": bool,
+        "default": False,
+        "hint": "When set, a missing orthophoto is first built from the orthophotos of the same provider one or two zoomlevels above it if they are all already on disk (4 or 16 of them), without any request to the provider.",
+    },
+    "tile_cache": {
+        "module": "CACHE",
+        "type": bool,
+        "default": False,
+        "hint": "When set, the raw tiles received from tms/wmts providers are also kept in a local store (Cache/tiles.sqlite) and looked up there before going to the network. Rebuilding a texture, retrying one with white squares or trying another color filter then mostly reads from disk.",
+    },
+    "tile_cache_size": {
+        "module": "CACHE",
+        "type": int,
+        "default": 4096,
+        "hint": "Maximum size in MB of the local tile store, the least recently used tiles are removed above it.",
+    },
+    "texturing_engine": {
+        "module": "DSF",
+        "type": str,
+        "default": "numpy",
+        "values": ("numpy", "python"),
+        "hint": "How Step 2 assigns a texture to the triangles of the mesh while building the DSF. 'numpy' handles all of them at once, 'python' one after the other as earlier versions did. Both write the very same DSF, 'python' is only kept as a fallback.",
+    },
+    "pool_encoding": {
+        "module": "DSF",
+        "type": str,
+        "default": "smallest",
+        "values": ("smallest", "raw"),
+        "hint": "How the point pools are stored in the DSF. 'smallest' picks for each plane (coordinates, altitudes, normals, texture coordinates...) the smallest of the raw, run-length and run-length differenced encodings of the DSF spec, 'raw' stores them all raw as earlier versions did.",
+    },
+    "cache_gs_rasters": {
+        "module": "DSF",
+        "type": bool,
+        "default": True,
+        "hint": "When set, the elevation and bathymetry rasters taken from the Global Scenery DSF of a tile are kept in Cache/Global_Scenery, so that rebuilding the DSF of the tile skips copying, uncompressing and parsing the Global Scenery DSF again. They are extracted anew whenever that DSF changes.",
+    },
     "ovl_exclude_pol": {
         "module": "OVL",
         "type": list,
@@ -83,6 +169,13 @@ cfg_app_vars = {
         "default": [],
         "hint": "Indices of road types which one would like to left aside in the extraction of overlays. The list of these indices is can be in the roads.net file within X-Plane Resources, but some sceneries use their own corresponding net definition file. Powerlines have index 22001 in XP11 roads.net default file.",
     },
+    "max_overlay_slots": {
+        "module": "OVL",
+        "type": int,
+        "default": 4,
+        "values": (1, 2, 3, 4, 5, 6, 7, 8, 12, 16, 24, 32, 48, 64),
+        "hint": "Number of parallel processes extracting overlays when a batch of tiles is built, each of them dealing with one tile at a time in its own temporary directory. Should be mainly dictated by the number of cores in your CPU and the speed of your disk.",
+    },
     "custom_scenery_dir": {
         "type": str,
         "default": "",
@@ -354,12 +447,26 @@ list_app_vars = [
     "skip_downloads",
     "skip_converts",
     "max_convert_slots",
+    "convert_engine",
+    "download_order",
+    "max_download_slots",
     "check_tms_response",
     "http_timeout",
     "max_connect_retries",
     "max_baddata_retries",
+    "download_engine",
+    "async_max_requests",
+    "async_decode_workers",
+    "dds_encoder",
+    "derive_lower_zl",
+    "tile_cache",
+    "tile_cache_size",
+    "texturing_engine",
+    "pool_encoding",
+    "cache_gs_rasters",
     "ovl_exclude_pol",
     "ovl_exclude_net",
+    "max_overlay_slots",
     "custom_scenery_dir",
     "custom_overlay_src",
     "custom_overlay_src_alternate",
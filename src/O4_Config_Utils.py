@@ -34,8 +34,10 @@ import O4_DEM_Utils as DEM
 import O4_OSM_Utils as OSM
 import O4_Vector_Map as VMAP
 import O4_Imagery_Utils as IMG
+import O4_Cache_Utils as CACHE
 import O4_Tile_Utils as TILE
 import O4_Overlay_Utils as OVL
+import O4_DSF_Utils as DSF
 
 _LOGGER = logging.getLogger(__name__)
 _LOGGER.setLevel(logging.INFO)
@@ -0,0 +1,367 @@
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+from multiprocessing import shared_memory
+import os
+import struct
+import threading
+import numpy
+from PIL import Image
+import O4_UI_Utils as UI
+
+# In-process DDS encoder, an alternative to nvcompress : DXT1 (BC1) for RGB
+# textures and DXT5 (BC3) for textures with an alpha channel, with their full
+# mipmap chain. Each 4x4 block gets the two end colors of its principal axis
+# (a fast range fit comparable to nvcompress -fast), the block rows of each
+# mipmap are encoded by bands in a pool of processes. The pixels are handed to
+# that pool through one shared memory block per texture, only the position of
+# each band is sent to the workers.
+
+nbr_workers = max(1, os.cpu_count() or 1)
+# block rows encoded by one worker job, 32 block rows of a 4096 texture
+# already take some 30MB of temporaries.
+band_rows = 32
+pool = None
+pool_lock = threading.Lock()
+pool_error_shown = False
+
+DDSD_CAPS = 0x1
+DDSD_HEIGHT = 0x2
+DDSD_WIDTH = 0x4
+DDSD_PIXELFORMAT = 0x1000
+DDSD_MIPMAPCOUNT = 0x20000
+DDSD_LINEARSIZE = 0x80000
+DDPF_FOURCC = 0x4
+DDSCAPS_COMPLEX = 0x8
+DDSCAPS_TEXTURE = 0x1000
+DDSCAPS_MIPMAP = 0x400000
+
+################################################################################
+def dds_header(width, height, nbr_mipmaps, dxt5):
+    block_size = 16 if dxt5 else 8
+    linear_size = max(1, (width + 3) // 4) * max(1, (height + 3) // 4)
+    linear_size *= block_size
+    return (
+        b"DDS "
+        + struct.pack(
+            "<7I44x",
+            124,
+            DDSD_CAPS
+            | DDSD_HEIGHT
+            | DDSD_WIDTH
+            | DDSD_PIXELFORMAT
+            | DDSD_MIPMAPCOUNT
+            | DDSD_LINEARSIZE,
+            height,
+            width,
+            linear_size,
+            0,
+            nbr_mipmaps,
+        )
+        + struct.pack(
+            "<2I4s5I",
+            32,
+            DDPF_FOURCC,
+            b"DXT5" if dxt5 else b"DXT1",
+            0,
+            0,
+            0,
+            0,
+            0,
+        )
+        + struct.pack(
+            "<5I", DDSCAPS_COMPLEX | DDSCAPS_TEXTURE | DDSCAPS_MIPMAP, 0, 0, 0, 0
+        )
+    )
+
+
+################################################################################
+
+################################################################################
+def to_blocks(pixels):
+    # (height, width, channels) -> (nbr_blocks, 16, channels), blocks in
+    # row major order and pixels row major within each block
+    (height, width, channels) = pixels.shape
+    return (
+        pixels.reshape(height // 4, 4, width // 4, 4, channels)
+        .transpose(0, 2, 1, 3, 4)
+        .reshape(-1, 16, channels)
+    )
+
+
+################################################################################
+
+################################################################################
+def rgb565(colors):
+    r = numpy.rint(colors[:, 0] * (31 / 255)).astype(numpy.uint16)
+    g = numpy.rint(colors[:, 1] * (63 / 255)).astype(numpy.uint16)
+    b = numpy.rint(colors[:, 2] * (31 / 255)).astype(numpy.uint16)
+    code = (r << 11) | (g << 5) | b
+    # colors as a decoder sees them
+    decoded = numpy.stack(
+        ((r << 3) | (r >> 2), (g << 2) | (g >> 4), (b << 3) | (b >> 2)),
+        axis=1,
+    ).astype(numpy.float32)
+    return (code, decoded)
+
+
+################################################################################
+
+################################################################################
+def encode_color_blocks(blocks):
+    # blocks : (nbr_blocks, 16, 3) uint8, returns (nbr_blocks, 8) uint8
+    blocks = blocks.astype(numpy.float32)
+    mean = blocks.mean(axis=1)
+    centered = blocks - mean[:, None, :]
+    covariance = numpy.matmul(centered.transpose(0, 2, 1), centered)
+    # principal axis by power iteration
+    axis = numpy.ones_like(mean)
+    for _ in range(6):
+        axis = numpy.einsum("nij,nj->ni", covariance, axis)
+        norm = numpy.sqrt((axis * axis).sum(axis=1, keepdims=True))
+        axis = numpy.where(norm > 1e-6, axis / numpy.maximum(norm, 1e-6), 0)
+    projections = numpy.einsum("nki,ni->nk", centered, axis)
+    color0 = mean + projections.max(axis=1)[:, None] * axis
+    color1 = mean + projections.min(axis=1)[:, None] * axis
+    (code0, decoded0) = rgb565(numpy.clip(color0, 0, 255))
+    (code1, decoded1) = rgb565(numpy.clip(color1, 0, 255))
+    # four colors mode needs code0 > code1
+    swap = code0 < code1
+    (code0, code1) = (
+        numpy.where(swap, code1, code0),
+        numpy.where(swap, code0, code1),
+    )
+    (decoded0, decoded1) = (
+        numpy.where(swap[:, None], decoded1, decoded0),
+        numpy.where(swap[:, None], decoded0, decoded1),
+    )
+    # the palette is color1, 2/3 color1 + 1/3 color0, 1/3 color1 + 2/3
+    # color0 and color0 along the segment, pixels take the nearest one of
+    # their projection onto it
+    segment = decoded0 - decoded1
+    length2 = numpy.maximum((segment * segment).sum(axis=1), 1)
+    steps = numpy.einsum(
+        "nki,ni->nk", blocks - decoded1[:, None, :], segment
+    ) / length2[:, None]
+    steps = numpy.rint(numpy.clip(steps, 0, 1) * 3).astype(numpy.uint32)
+    indices = numpy.array([1, 3, 2, 0], dtype=numpy.uint32)[steps]
+    indices[code0 == code1] = 0
+    bits = numpy.zeros(len(blocks), dtype=numpy.uint32)
+    for k in range(16):
+        bits |= indices[:, k] << (2 * k)
+    encoded = numpy.empty(
+        len(blocks), dtype=[("c0", "<u2"), ("c1", "<u2"), ("bits", "<u4")]
+    )
+    encoded["c0"] = code0
+    encoded["c1"] = code1
+    encoded["bits"] = bits
+    return encoded.view(numpy.uint8).reshape(-1, 8)
+
+
+################################################################################
+
+################################################################################
+def encode_alpha_blocks(blocks):
+    # blocks : (nbr_blocks, 16) uint8, returns (nbr_blocks, 8) uint8, with
+    # the eight values mode (alpha0 > alpha1)
+    alpha0 = blocks.max(axis=1)
+    alpha1 = blocks.min(axis=1)
+    spread = (alpha0.astype(numpy.float32) - alpha1)[:, None]
+    steps = numpy.rint(
+        (blocks - alpha1[:, None].astype(numpy.float32))
+        * 7
+        / numpy.maximum(spread, 1)
+    ).astype(numpy.uint64)
+    # step 7 is alpha0 (index 0), step 0 is alpha1 (index 1), step j is
+    # index 8-j in between
+    indices = numpy.where(steps == 7, 0, numpy.where(steps == 0, 1, 8 - steps))
+    indices[alpha0 == alpha1] = 0
+    bits = numpy.zeros(len(blocks), dtype=numpy.uint64)
+    for k in range(16):
+        bits |= indices[:, k].astype(numpy.uint64) << numpy.uint64(3 * k)
+    encoded = numpy.empty((len(blocks), 8), dtype=numpy.uint8)
+    encoded[:, 0] = alpha0
+    encoded[:, 1] = alpha1
+    encoded[:, 2:] = bits.astype("<u8").view(numpy.uint8).reshape(-1, 8)[:, :6]
+    return encoded
+
+
+################################################################################
+
+################################################################################
+def encode_band(pixels):
+    # pixels : (4*n, 4*m, 3 or 4) uint8, returns the DXT1 or DXT5 blocks
+    blocks = to_blocks(pixels)
+    color_blocks = encode_color_blocks(blocks[:, :, :3])
+    if pixels.shape[2] == 3:
+        return color_blocks.tobytes()
+    return numpy.hstack(
+        (encode_alpha_blocks(blocks[:, :, 3]), color_blocks)
+    ).tobytes()
+
+
+################################################################################
+
+################################################################################
+def mipmaps(im):
+    # full chain down to 1x1, halved with a box filter
+    levels = [im]
+    while im.size != (1, 1):
+        (width, height) = im.size
+        im = im.resize((max(1, width // 2), max(1, height // 2)), Image.BOX)
+        levels.append(im)
+    return levels
+
+
+################################################################################
+
+################################################################################
+def block_pixels(im):
+    pixels = numpy.asarray(im)
+    (height, width) = pixels.shape[:2]
+    if height % 4 or width % 4:
+        # the smallest mipmaps are padded to a whole block
+        pixels = numpy.pad(
+            pixels,
+            ((0, -height % 4), (0, -width % 4), (0, 0)),
+            mode="edge",
+        )
+    return pixels
+
+
+################################################################################
+
+################################################################################
+def encode_shared_band(name, offset, shape, row_min, row_max):
+    # runs in a pool process, the mipmap lies in the shared block at offset
+    # the block is unlinked by the process which created it
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        pixels = numpy.ndarray(shape, numpy.uint8, block.buf, offset)
+        data = encode_band(pixels[row_min:row_max])
+        del pixels
+    finally:
+        block.close()
+    return data
+
+
+################################################################################
+
+################################################################################
+def get_pool():
+    global pool
+    with pool_lock:
+        if pool is None and nbr_workers > 1:
+            # spawned, forking a process which runs threads is not safe
+            pool = concurrent.futures.ProcessPoolExecutor(
+                nbr_workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return pool
+
+
+################################################################################
+
+################################################################################
+def discard_pool(executor):
+    global pool
+    with pool_lock:
+        if pool is executor:
+            pool = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+################################################################################
+
+################################################################################
+def pool_error(e):
+    global pool_error_shown
+    with pool_lock:
+        if pool_error_shown:
+            return
+        pool_error_shown = True
+    UI.vprint(
+        1,
+        "   WARNING: DDS encoding processes are not available, textures are",
+        "encoded in this one :",
+        e,
+    )
+
+
+################################################################################
+
+################################################################################
+def encode(im, dxt5=False):
+    # DDS file content (header and mipmaps) for a PIL image whose sides are
+    # powers of two
+    im = im.convert("RGBA" if dxt5 else "RGB")
+    levels = [block_pixels(level) for level in mipmaps(im)]
+    header = dds_header(im.size[0], im.size[1], len(levels), dxt5)
+    executor = get_pool()
+    if executor:
+        try:
+            return header + b"".join(encode_in_pool(executor, levels))
+        except BrokenProcessPool:
+            # a worker died, the next texture gets a new pool
+            discard_pool(executor)
+        except OSError as e:
+            # e.g. processes or shared memory not allowed, encode in this
+            # one instead
+            pool_error(e)
+    return header + b"".join(
+        encode_band(pixels[row : row + 4 * band_rows])
+        for pixels in levels
+        for row in range(0, pixels.shape[0], 4 * band_rows)
+    )
+
+
+################################################################################
+
+################################################################################
+def encode_in_pool(executor, levels):
+    block = shared_memory.SharedMemory(
+        create=True, size=sum(pixels.nbytes for pixels in levels)
+    )
+    try:
+        jobs = []
+        offset = 0
+        for pixels in levels:
+            numpy.ndarray(pixels.shape, numpy.uint8, block.buf, offset)[
+                :
+            ] = pixels
+            for row in range(0, pixels.shape[0], 4 * band_rows):
+                jobs.append(
+                    executor.submit(
+                        encode_shared_band,
+                        block.name,
+                        offset,
+                        pixels.shape,
+                        row,
+                        row + 4 * band_rows,
+                    )
+                )
+            offset += pixels.nbytes
+        return [job.result() for job in jobs]
+    finally:
+        block.close()
+        block.unlink()
+
+
+################################################################################
+
+################################################################################
+def write_dds(im, file_name, dxt5=False):
+    data = encode(im, dxt5)
+    with open(file_name + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(file_name + ".tmp", file_name)
+
+
+################################################################################
+
+################################################################################
+def shutdown():
+    global pool
+    with pool_lock:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+            pool = None
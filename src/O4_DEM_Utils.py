@@ -17,6 +17,7 @@ except:
 from PIL import Image
 import O4_UI_Utils as UI
 import O4_File_Names as FNAMES
+import O4_Http_Utils as HTTP
 
 available_sources = (
     "View",
@@ -800,11 +801,16 @@ def ensure_elevation(source, lat, lon, verbose=True):
 
 ################################################################################
 def http_request(url, source, verbose=False):
-    s = requests.Session()
+    # the DEM sources share the connection pools and rate limiters of the
+    # imagery providers, keyed by their name
+    s = HTTP.get_session(source)
     tentative = 0
     while True:
         try:
-            r = s.get(url, timeout=10)
+            with HTTP.limited(HTTP.session_limiter(s)) as answer:
+                r = s.get(url, timeout=10)
+                answer["status"] = r.status_code
+                answer["retry_after"] = r.headers.get("Retry-After")
             status_code = str(r)
             if "[20" in status_code:
                 return r
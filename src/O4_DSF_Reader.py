@@ -0,0 +1,399 @@
+import collections
+import hashlib
+import mmap
+import struct
+import numpy
+
+# Reader of the (uncompressed) DSF files, as described in the DSF spec of
+# the X-Plane developer site. The atom tree is walked on demand, the pools,
+# rasters and commands are only decoded when asked for, straight from the
+# memory mapped file. 7z compressed DSFs need to be uncompressed first.
+
+# super-atoms, whose content is made of atoms
+super_atoms = ("HEAD", "DEFN", "GEOD", "DEMS")
+
+# atom id, offset of its content in the file, size of its content
+Atom = collections.namedtuple("Atom", "id offset size")
+
+# a terrain patch, its triangles as a (n, 3, 2) array of (pool, index)
+Patch = collections.namedtuple("Patch", "terrain flags near far triangles")
+
+# commands and the struct format of their fixed size arguments, those
+# followed by a list of values have the size of it in the format (8 or 16
+# bits count) and the format of one value separately.
+commands_format = {
+    1: ("<H", None),  # POOL SELECT
+    2: ("<I", None),  # JUNCTION OFFSET SELECT
+    3: ("<B", None),  # SET DEFINITION 8
+    4: ("<H", None),  # SET DEFINITION 16
+    5: ("<I", None),  # SET DEFINITION 32
+    6: ("<B", None),  # SET ROAD SUBTYPE 8
+    7: ("<H", None),  # OBJECT
+    8: ("<HH", None),  # OBJECT RANGE
+    9: ("<B", "<H"),  # NETWORK CHAIN
+    10: ("<HH", None),  # NETWORK CHAIN RANGE
+    11: ("<B", "<I"),  # NETWORK CHAIN 32
+    12: ("<HB", "<H"),  # POLYGON
+    13: ("<HHH", None),  # POLYGON RANGE
+    14: ("<HB", None),  # NESTED POLYGON (windings read separately)
+    15: ("<HB", None),  # NESTED POLYGON RANGE (count + 1 indices)
+    16: ("", None),  # TERRAIN PATCH
+    17: ("<B", None),  # TERRAIN PATCH FLAGS
+    18: ("<Bff", None),  # TERRAIN PATCH FLAGS AND LOD
+    23: ("<B", "<H"),  # PATCH TRIANGLE
+    24: ("<B", "<HH"),  # PATCH TRIANGLE CROSS-POOL
+    25: ("<HH", None),  # PATCH TRIANGLE RANGE
+    26: ("<B", "<H"),  # PATCH TRIANGLE STRIP
+    27: ("<B", "<HH"),  # PATCH TRIANGLE STRIP CROSS-POOL
+    28: ("<HH", None),  # PATCH TRIANGLE STRIP RANGE
+    29: ("<B", "<H"),  # PATCH TRIANGLE FAN
+    30: ("<B", "<HH"),  # PATCH TRIANGLE FAN CROSS-POOL
+    31: ("<HH", None),  # PATCH TRIANGLE FAN RANGE
+    32: ("<B", "<B"),  # COMMENT 8
+    33: ("<H", "<B"),  # COMMENT 16
+    34: ("<I", "<B"),  # COMMENT 32
+}
+
+################################################################################
+def decode_plane(data, offset, length, dtype="<u2"):
+    # Reads the encoding byte and the length values of the plane starting at
+    # offset in data (0 raw, 1 differenced, 2 run-length, 3 run-length
+    # differenced), returns them with the offset past the plane.
+    dtype = numpy.dtype(dtype)
+    size = dtype.itemsize
+    encoding = data[offset]
+    offset += 1
+    if encoding & 2:
+        values = numpy.empty(length, dtype=dtype.newbyteorder("="))
+        i = 0
+        while i < length:
+            count = data[offset] & 0x7F
+            if data[offset] & 0x80:
+                values[i : i + count] = numpy.frombuffer(
+                    data, dtype, 1, offset + 1
+                )[0]
+                offset += 1 + size
+            else:
+                values[i : i + count] = numpy.frombuffer(
+                    data, dtype, count, offset + 1
+                )
+                offset += 1 + size * count
+            i += count
+    else:
+        values = numpy.frombuffer(data, dtype, length, offset).astype(
+            dtype.newbyteorder("=")
+        )
+        offset += size * length
+    if encoding & 1:
+        values = numpy.cumsum(values, dtype=values.dtype)
+    return (values, offset)
+
+
+################################################################################
+
+################################################################################
+def triangles_of(command, vertices):
+    # The triangles of a triangle list, strip or fan command, vertices
+    # being a (n, 2) array of (pool, index).
+    if command in (23, 24, 25):
+        return vertices.reshape(-1, 3, 2)
+    nbr = len(vertices) - 2
+    if nbr <= 0:
+        return numpy.zeros((0, 3, 2), dtype=vertices.dtype)
+    if command in (26, 27, 28):
+        # every other triangle of a strip is flipped to keep the orientation
+        first = numpy.arange(nbr)
+        second = first + 1 + (first % 2)
+        third = first + 2 - (first % 2)
+        return numpy.stack(
+            (vertices[first], vertices[second], vertices[third]), axis=1
+        )
+    return numpy.stack(
+        (
+            numpy.repeat(vertices[:1], nbr, axis=0),
+            vertices[1:-1],
+            vertices[2:],
+        ),
+        axis=1,
+    )
+
+
+################################################################################
+
+################################################################################
+class DSF_Reader:
+    def __init__(self, file_name, use_mmap=True):
+        self.file_name = file_name
+        self.f = open(file_name, "rb")
+        if use_mmap:
+            self.data = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.data = self.f.read()
+        if self.data[:8] != b"XPLNEDSF":
+            self.close()
+            raise ValueError(file_name + " is not an (uncompressed) DSF file.")
+        (self.version,) = struct.unpack_from("<I", self.data, 8)
+        self.children = {}
+        self.decoded_pools = {}
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            try:
+                self.data.close()
+            except BufferError:
+                # arrays still viewing the file keep it mapped until freed
+                pass
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def atoms(self, parent=None):
+        # the top level atoms, or the children of a super-atom
+        if parent not in self.children:
+            if parent is None:
+                (offset, end) = (12, len(self.data) - 16)
+            else:
+                (offset, end) = (parent.offset, parent.offset + parent.size)
+            atoms = []
+            while offset + 8 <= end:
+                (tag, size) = struct.unpack_from("<4sI", self.data, offset)
+                if size < 8:
+                    raise ValueError("Corrupted atom in " + self.file_name)
+                atoms.append(
+                    Atom(tag[::-1].decode("ascii"), offset + 8, size - 8)
+                )
+                offset += size
+            self.children[parent] = atoms
+        return self.children[parent]
+
+    def atom(self, *path):
+        # the first atom along path, e.g. atom("DEFN", "TERT"), or None
+        atom = None
+        for atom_id in path:
+            atom = next(
+                (child for child in self.atoms(atom) if child.id == atom_id),
+                None,
+            )
+            if atom is None:
+                return None
+        return atom
+
+    def content(self, atom):
+        return memoryview(self.data)[atom.offset : atom.offset + atom.size]
+
+    def strings(self, *path):
+        # the null terminated strings of an atom (PROP, TERT, OBJT, ...)
+        atom = self.atom(*path)
+        if atom is None:
+            return []
+        return bytes(self.content(atom)).decode("utf-8").split("\0")[:-1]
+
+    def properties(self):
+        strings = self.strings("HEAD", "PROP")
+        return dict(zip(strings[0::2], strings[1::2]))
+
+    def terrains(self):
+        return self.strings("DEFN", "TERT")
+
+    def pool_atoms(self, bits=16):
+        # pools and 32 bits pools are numbered separately
+        (pool_id, scal_id) = ("POOL", "SCAL") if bits == 16 else ("PO32", "SC32")
+        geod = self.atom("GEOD")
+        if geod is None:
+            return ([], [])
+        return (
+            [atom for atom in self.atoms(geod) if atom.id == pool_id],
+            [atom for atom in self.atoms(geod) if atom.id == scal_id],
+        )
+
+    def nbr_pools(self, bits=16):
+        return len(self.pool_atoms(bits)[0])
+
+    def pool(self, idx, bits=16):
+        # the (nbr_planes, length) array of the raw values of a pool
+        if (idx, bits) not in self.decoded_pools:
+            atom = self.pool_atoms(bits)[0][idx]
+            (length, nbr_planes) = struct.unpack_from(
+                "<IB", self.data, atom.offset
+            )
+            offset = atom.offset + 5
+            planes = numpy.empty(
+                (nbr_planes, length),
+                dtype=numpy.uint16 if bits == 16 else numpy.uint32,
+            )
+            for plane in range(nbr_planes):
+                (planes[plane], offset) = decode_plane(
+                    self.data, offset, length, "<u2" if bits == 16 else "<u4"
+                )
+            if offset != atom.offset + atom.size:
+                raise ValueError("Corrupted pool in " + self.file_name)
+            self.decoded_pools[idx, bits] = planes
+        return self.decoded_pools[idx, bits]
+
+    def scale(self, idx, bits=16):
+        # the (nbr_planes, 2) array of the scale and offset of each plane
+        atom = self.pool_atoms(bits)[1][idx]
+        return numpy.frombuffer(
+            self.data, "<f4", atom.size // 4, atom.offset
+        ).reshape(-1, 2)
+
+    def pool_coordinates(self, idx, bits=16):
+        # the values of a pool, scaled and offset back
+        scale = self.scale(idx, bits).astype(numpy.float64)
+        return (
+            self.pool(idx, bits) / (65535.0 if bits == 16 else 4294967295.0)
+            * scale[:, :1]
+            + scale[:, 1:]
+        )
+
+    def rasters(self):
+        # (header, values) of the rasters of the DEMS atom, the header being
+        # the dict of the DEMI fields.
+        dems = self.atom("DEMS")
+        if dems is None:
+            return []
+        rasters = []
+        header = None
+        for atom in self.atoms(dems):
+            if atom.id == "DEMI":
+                fields = struct.unpack_from("<BBHIIff", self.data, atom.offset)
+                header = dict(
+                    zip(
+                        ("version", "bpp", "flags", "width", "height",
+                         "scale", "offset"),
+                        fields,
+                    )
+                )
+            elif atom.id == "DEMD" and header is not None:
+                # flags & 3 : 0 float, 1 signed, 2 unsigned integers
+                kind = ("f", "i", "u")[header["flags"] & 3]
+                values = numpy.frombuffer(
+                    self.data,
+                    "<" + kind + str(header["bpp"]),
+                    header["width"] * header["height"],
+                    atom.offset,
+                ).reshape(header["height"], header["width"])
+                rasters.append((header, values))
+                header = None
+        return rasters
+
+    def commands(self):
+        # Yields the (command, arguments, values) of the CMDS atom, values
+        # being the numpy array of the list following some of them (or
+        # None).
+        atom = self.atom("CMDS")
+        if atom is None:
+            return
+        data = self.data
+        (offset, end) = (atom.offset, atom.offset + atom.size)
+        while offset < end:
+            command = data[offset]
+            offset += 1
+            if command not in commands_format:
+                raise ValueError(
+                    "Unknown DSF command " + str(command) + " at " + str(offset)
+                )
+            (fmt, value_fmt) = commands_format[command]
+            arguments = struct.unpack_from(fmt, data, offset)
+            offset += struct.calcsize(fmt)
+            values = None
+            if command == 14:
+                windings = []
+                for _ in range(arguments[1]):
+                    count = data[offset]
+                    windings.append(
+                        numpy.frombuffer(data, "<u2", count, offset + 1)
+                    )
+                    offset += 1 + 2 * count
+                values = windings
+            elif command == 15:
+                values = numpy.frombuffer(data, "<u2", arguments[1] + 1, offset)
+                offset += 2 * (arguments[1] + 1)
+            elif value_fmt is not None:
+                count = arguments[-1]
+                width = struct.calcsize(value_fmt)
+                values = numpy.frombuffer(
+                    data, "<u" + str(width // len(value_fmt[1:])),
+                    count * len(value_fmt[1:]), offset
+                )
+                offset += count * width
+            yield (command, arguments, values)
+
+    def patches(self):
+        # Yields the terrain patches with their triangles
+        (pool, terrain, flags, near, far) = (0, 0, 1, -1.0, -1.0)
+        patch = None
+        for (command, arguments, values) in self.commands():
+            if command == 1:
+                pool = arguments[0]
+            elif command in (3, 4, 5):
+                terrain = arguments[0]
+            elif command in (16, 17, 18):
+                if patch is not None:
+                    yield self.make_patch(*patch)
+                if command == 17:
+                    flags = arguments[0]
+                elif command == 18:
+                    (flags, near, far) = arguments
+                patch = (terrain, flags, near, far, [])
+            elif 23 <= command <= 31:
+                if command in (25, 28, 31):
+                    indices = numpy.arange(*arguments)
+                    vertices = numpy.stack(
+                        (numpy.full(len(indices), pool), indices), axis=1
+                    )
+                elif command in (24, 27, 30):
+                    vertices = values.reshape(-1, 2).astype(numpy.int64)
+                else:
+                    vertices = numpy.stack(
+                        (numpy.full(len(values), pool), values), axis=1
+                    )
+                patch[4].append(triangles_of(command, vertices))
+        if patch is not None:
+            yield self.make_patch(*patch)
+
+    @staticmethod
+    def make_patch(terrain, flags, near, far, triangles):
+        if triangles:
+            triangles = numpy.concatenate(triangles).astype(numpy.int64)
+        else:
+            triangles = numpy.zeros((0, 3, 2), dtype=numpy.int64)
+        return Patch(terrain, flags, near, far, triangles)
+
+    def statistics(self):
+        # Number of triangles per terrain (name), of patches, and the fill
+        # factor of the pools (points out of the 65536 they can hold).
+        terrains = self.terrains()
+        triangles = collections.Counter()
+        nbr_patches = 0
+        for patch in self.patches():
+            nbr_patches += 1
+            name = (
+                terrains[patch.terrain]
+                if patch.terrain < len(terrains)
+                else str(patch.terrain)
+            )
+            triangles[name] += len(patch.triangles)
+        pool_lengths = [
+            struct.unpack_from("<I", self.data, atom.offset)[0]
+            for atom in self.pool_atoms()[0]
+        ]
+        return {
+            "triangles": dict(triangles),
+            "nbr_triangles": sum(triangles.values()),
+            "nbr_patches": nbr_patches,
+            "nbr_pools": len(pool_lengths),
+            "pool_fill": [length / 65536 for length in pool_lengths],
+        }
+
+    def check_md5(self):
+        # the md5 of the file (but its last 16 bytes) is its last 16 bytes
+        md5 = hashlib.md5()
+        view = memoryview(self.data)
+        for start in range(0, len(self.data) - 16, 1 << 24):
+            md5.update(view[start : min(start + (1 << 24), len(self.data) - 16)])
+        return md5.digest() == bytes(view[-16:])
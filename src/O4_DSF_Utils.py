@@ -1,16 +1,17 @@
 import array
 import hashlib
-import io
+import json
 import numpy
 import os
 import pickle
 import shutil
 import struct
 from collections import defaultdict
-from math import ceil, floor
+from math import ceil
 from PIL import Image, ImageDraw
 import subprocess
 import O4_Bathymetry as BATHY
+import O4_DSF_Reader as DSFR
 import O4_File_Names as FNAMES
 import O4_Geo_Utils as GEO
 import O4_Mask_Utils as MASK
@@ -25,84 +26,157 @@ quad_capacity_low = 35000
 # For Laminar test suite
 use_test_texture = False
 
+# "numpy" textures all triangles at once, "python" one after the other (as
+# earlier versions did), both write the very same DSF.
+texturing_engine = "numpy"
+
+# "smallest" writes each plane of the point pools in the smallest of the
+# encodings allowed by the DSF spec, "raw" keeps them all raw.
+pool_encoding = "smallest"
+
+# The DEMN atom and the DEMS rasters taken from the Global Scenery DSFs are
+# cached in Cache/Global_Scenery (.npy files), and reused as long as the
+# path, size and mtime of their DSF are unchanged.
+cache_gs_rasters = True
+
 ################################################################################
-def float2qquad(x):
-    if x >= 1:
-        return "111111111111111111111111"
-    return numpy.binary_repr(int(16777216 * x)).zfill(24)  # 2**24 == 16777216
+def spread_bits(x):
+    # 0b abc -> 0b 0a0b0c, for up to 32 bits
+    x = x & numpy.uint64(0x00000000FFFFFFFF)
+    x = (x | (x << numpy.uint64(16))) & numpy.uint64(0x0000FFFF0000FFFF)
+    x = (x | (x << numpy.uint64(8))) & numpy.uint64(0x00FF00FF00FF00FF)
+    x = (x | (x << numpy.uint64(4))) & numpy.uint64(0x0F0F0F0F0F0F0F0F)
+    x = (x | (x << numpy.uint64(2))) & numpy.uint64(0x3333333333333333)
+    x = (x | (x << numpy.uint64(1))) & numpy.uint64(0x5555555555555555)
+    return x
 
 
 ################################################################################
 
 ################################################################################
-class QuadTree(dict):
-    class Bucket(dict):
-        def __init__(self):
-            self["size"] = 0
-            self["idx_nodes"] = set()
-
-    def __init__(self, level, bucket_size):
-        self.bucket_size = bucket_size
-        if level == 0:
-            self[("", "")] = self.Bucket()
-        else:
-            for i in range(2 ** level):
-                for j in range(2 ** level):
-                    key = (
-                        numpy.binary_repr(i).zfill(level),
-                        numpy.binary_repr(j).zfill(level),
-                    )
-                    self[key] = self.Bucket()
-        self.nodes = {}
-        self.levels = {}
-        self.last_node = 0
-
-    def split_bucket(self, key):
-        level = len(key[0]) + 1
-        self[(key[0] + "0", key[1] + "0")] = self.Bucket()
-        self[(key[0] + "0", key[1] + "1")] = self.Bucket()
-        self[(key[0] + "1", key[1] + "0")] = self.Bucket()
-        self[(key[0] + "1", key[1] + "1")] = self.Bucket()
-        for idx in self[key]["idx_nodes"]:
-            new_key = (self.nodes[idx][0][:level], self.nodes[idx][1][:level])
-            self[new_key]["idx_nodes"].add(idx)
-            self[new_key]["size"] += 1
-            self.levels[idx] += 1
-        del self[key]
-
-    def insert(self, bx, by, level):
-        while True:
-            key = (bx[:level], by[:level])
-            if key in self:
-                break
-            level += 1
-        if self[key]["size"] < self.bucket_size:
-            self[key]["idx_nodes"].add(self.last_node)
-            self[key]["size"] += 1
-            self.nodes[self.last_node] = (bx, by)
-            self.levels[self.last_node] = level
-            self.last_node += 1
-        else:
-            self.split_bucket(key)
-            self.insert(bx, by, level + 1)
-
-    def clean(self):
-        for key in list(self.keys()):
-            if not self[key]["size"]:
-                del self[key]
-
-    def statistics(self):
-        lengths = numpy.array([self[key]["size"] for key in self])
-        depths = numpy.array([len(key[0]) for key in self])
-        UI.vprint(2, "     Number of buckets:", len(lengths))
-        UI.vprint(
-            2,
-            "     Average depth:",
-            depths.mean(),
-            ", Average bucket size:",
-            lengths.mean(),
+def morton_codes(x, y):
+    # x and y in [0,1] are quantized to 24 bits (2**24 == 16777216) and
+    # interleaved, x bits first : the nodes within a quadtree cell of level L
+    # are those sharing the 2L leading bits of their (48 bits) code.
+    ix = numpy.clip((16777216 * x).astype(numpy.int64), 0, 16777215)
+    iy = numpy.clip((16777216 * y).astype(numpy.int64), 0, 16777215)
+    codes = (spread_bits(ix.astype(numpy.uint64)) << numpy.uint64(1)) | (
+        spread_bits(iy.astype(numpy.uint64))
+    )
+    return (ix, iy, codes)
+
+
+################################################################################
+
+################################################################################
+def quadtree_leaves(sorted_codes, level, capacity):
+    # The cells of the quadtree (starting with all those of the given level)
+    # are split as long as they hold more than capacity nodes. Returns the
+    # first code and the level of the non empty leaves, in Morton order.
+    (starts, levels) = ([], [])
+    cells = numpy.arange(4**level, dtype=numpy.uint64)
+    while len(cells):
+        shift = numpy.uint64(2 * (24 - level))
+        sizes = numpy.searchsorted(
+            sorted_codes, (cells + numpy.uint64(1)) << shift
+        ) - numpy.searchsorted(sorted_codes, cells << shift)
+        leaf = (sizes > 0) & ((sizes <= capacity) | (level == 24))
+        starts.append(cells[leaf] << shift)
+        levels.append(numpy.full(leaf.sum(), level))
+        cells = cells[~leaf & (sizes > 0)]
+        cells = ((cells << numpy.uint64(2))[:, None] + numpy.arange(
+            4, dtype=numpy.uint64)).ravel()
+        level += 1
+    starts = numpy.concatenate(starts)
+    order = numpy.argsort(starts)
+    return (starts[order], numpy.concatenate(levels)[order])
+
+
+################################################################################
+
+################################################################################
+def build_pools(tile, nbr_nodes, node_coords, capacity):
+    # Splits the nodes of the mesh into DSF point pools, one per quadtree
+    # leaf, and computes their pool coordinates. Returns the number of pools,
+    # the pool of each node, the node_icoords and the pool parameters.
+    node_coords = numpy.asarray(node_coords[: 5 * nbr_nodes], numpy.float64)
+    (ix, iy, codes) = morton_codes(
+        node_coords[0::5] - tile.lon, node_coords[1::5] - tile.lat
+    )
+    (starts, levels) = quadtree_leaves(
+        numpy.sort(codes), quad_init_level, capacity
+    )
+    pool_nbr = len(starts)
+    node_pool = numpy.searchsorted(starts, codes, side="right") - 1
+    UI.vprint(2, "     Number of buckets:", pool_nbr)
+    UI.vprint(
+        2,
+        "     Average depth:",
+        levels.mean(),
+        ", Average bucket size:",
+        nbr_nodes / pool_nbr,
+    )
+    UI.vprint(2, "     Largest depth:", levels.max())
+    node_icoords = numpy.zeros(5 * nbr_nodes, dtype=numpy.uint16)
+    # the 16 bits of the position within the pool that follow its level ones,
+    # or what is left of the 24 bits beyond level 8
+    node_level = levels[node_pool]
+    nbr_bits = numpy.minimum(16, 24 - node_level)
+    mask = (1 << nbr_bits) - 1
+    node_icoords[0::5] = (ix >> (24 - node_level - nbr_bits)) & mask
+    node_icoords[1::5] = (iy >> (24 - node_level - nbr_bits)) & mask
+    # altitude range of each pool
+    by_pool = numpy.argsort(node_pool, kind="stable")
+    firsts = numpy.searchsorted(node_pool[by_pool], numpy.arange(pool_nbr))
+    altitudes = node_coords[2::5]
+    altmin = numpy.floor(numpy.minimum.reduceat(altitudes[by_pool], firsts))
+    altmax = numpy.ceil(numpy.maximum.reduceat(altitudes[by_pool], firsts))
+    spans = altmax - altmin
+    # 65535 = 771*85 = 1285*51 = 4369*15 = 13107*5
+    conditions = (spans < 770, spans < 1284, spans < 4368)
+    scale_z = numpy.select(conditions, (771, 1285, 4369), 13107)
+    inv_stp = numpy.select(conditions, (85, 51, 15), 5)
+    node_icoords[2::5] = numpy.round(
+        (altitudes - altmin[node_pool]) * inv_stp[node_pool]
+    )
+    node_icoords[3::5] = numpy.round(
+        (1 + tile.normal_map_strength * node_coords[3::5]) / 2 * 65535
+    )
+    node_icoords[4::5] = numpy.round(
+        (1 - tile.normal_map_strength * node_coords[4::5]) / 2 * 65535
+    )
+    pool_param = []
+    for (level, til_x, til_y, scale, alt) in zip(
+        levels.tolist(),
+        ix[by_pool[firsts]].tolist(),
+        iy[by_pool[firsts]].tolist(),
+        scale_z.tolist(),
+        altmin.astype(int).tolist(),
+    ):
+        scal_x = scal_y = 2 ** (-level)
+        pool_param.append(
+            (
+                scal_x,
+                tile.lon + (til_x >> (24 - level)) * scal_x,
+                scal_y,
+                tile.lat + (til_y >> (24 - level)) * scal_y,
+                scale,
+                alt,
+                2,
+                -1,
+                2,
+                -1,
+                1,
+                0,
+                1,
+                0,
+                1,
+                0,
+                1,
+                0,
+            )
         )
-        UI.vprint(2, "     Largest depth:", numpy.max(depths))
+    return (pool_nbr, node_pool, node_icoords, pool_param)
 
 
 ################################################################################
@@ -358,33 +432,128 @@ def create_terrain_file(
 ################################################################################
 
 ################################################################################
-def extract_elevation_and_bathymetry_data(lat, lon):
-    UI.vprint(1, "     Extracting some rasters from X-Plane's Global Scenery")
-    global_scenery_dsf = os.path.join(
+def global_scenery_dsf(lat, lon):
+    dsf_file_name = os.path.join(
         OVL.custom_overlay_src,
         "Earth nav data",
         FNAMES.long_latlon(lat, lon) + ".dsf",
     )
-    if not os.path.exists(global_scenery_dsf):
-        global_scenery_dsf = os.path.join(
-        OVL.custom_overlay_src_alternate,
-        "Earth nav data",
-        FNAMES.long_latlon(lat, lon) + ".dsf",
+    if not os.path.exists(dsf_file_name):
+        dsf_file_name = os.path.join(
+            OVL.custom_overlay_src_alternate,
+            "Earth nav data",
+            FNAMES.long_latlon(lat, lon) + ".dsf",
+        )
+    return dsf_file_name
+
+
+################################################################################
+
+################################################################################
+def raster_cache_dir(lat, lon):
+    return os.path.join(
+        FNAMES.Cache_dir, "Global_Scenery", FNAMES.long_latlon(lat, lon)
+    )
+
+
+################################################################################
+
+################################################################################
+def raster_cache_key(dsf_file_name):
+    stat = os.stat(dsf_file_name)
+    return {
+        "source": os.path.abspath(dsf_file_name),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+    }
+
+
+################################################################################
+
+################################################################################
+def read_cached_rasters(lat, lon, dsf_file_name):
+    # The DEMN atom and the DEMS sub-atoms extracted earlier from the same
+    # (path, size, mtime) Global Scenery DSF, or None.
+    cache_dir = raster_cache_dir(lat, lon)
+    try:
+        with open(os.path.join(cache_dir, "metadata.json")) as f:
+            metadata = json.load(f)
+        if metadata["key"] != raster_cache_key(dsf_file_name):
+            return None
+        bDEMN = numpy.load(
+            os.path.join(cache_dir, "DEMN.npy"), mmap_mode="r"
+        ).tobytes()
+        bDEMS = b""
+        for (i, tag) in enumerate(metadata["DEMS"]):
+            data = numpy.load(
+                os.path.join(cache_dir, "DEMS_" + str(i) + ".npy"),
+                mmap_mode="r",
+            )
+            bDEMS += struct.pack("<4sI", tag.encode("ascii"), 8 + len(data))
+            bDEMS += data.tobytes()
+        return (bDEMN, bDEMS)
+    except:
+        return None
+
+
+################################################################################
+
+################################################################################
+def write_cached_rasters(lat, lon, dsf_file_name, bDEMN, dems_atoms):
+    # The metadata goes last, an interrupted write is never read back.
+    cache_dir = raster_cache_dir(lat, lon)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        metadata_file = os.path.join(cache_dir, "metadata.json")
+        if os.path.exists(metadata_file):
+            os.remove(metadata_file)
+        numpy.save(
+            os.path.join(cache_dir, "DEMN.npy"),
+            numpy.frombuffer(bDEMN, dtype=numpy.uint8),
         )
-    if not os.path.exists(global_scenery_dsf):
+        for (i, (tag, data)) in enumerate(dems_atoms):
+            numpy.save(
+                os.path.join(cache_dir, "DEMS_" + str(i) + ".npy"),
+                numpy.frombuffer(data, dtype=numpy.uint8),
+            )
+        with open(metadata_file + ".tmp", "w") as f:
+            json.dump(
+                {
+                    "key": raster_cache_key(dsf_file_name),
+                    "DEMS": [tag for (tag, _) in dems_atoms],
+                },
+                f,
+            )
+        os.replace(metadata_file + ".tmp", metadata_file)
+    except Exception as e:
+        UI.vprint(1, "     WARNING: could not cache the rasters :", e)
+
+
+################################################################################
+
+################################################################################
+def extract_elevation_and_bathymetry_data(lat, lon):
+    UI.vprint(1, "     Extracting some rasters from X-Plane's Global Scenery")
+    global_scenery_dsf_file = global_scenery_dsf(lat, lon)
+    if not os.path.exists(global_scenery_dsf_file):
         UI.exit_message_and_bottom_line(
             "   ERROR: file ",
-            global_scenery_dsf,
+            global_scenery_dsf_file,
             "absent. Global Scenery directory needs to be set in the config ",
             "window first.",
         )
         return (b"", b"")
+    if cache_gs_rasters:
+        cached = read_cached_rasters(lat, lon, global_scenery_dsf_file)
+        if cached is not None:
+            UI.vprint(2, "     Using the rasters cached from a previous build")
+            return cached
     tmp_file = os.path.join(
         FNAMES.Tmp_dir, FNAMES.short_latlon(lat, lon) + ".dsf"
     )
     UI.vprint(2, "     Making a copy of the Global Scenery DSF in tmp dir")
     try:
-        shutil.copy(global_scenery_dsf, tmp_file)
+        shutil.copy(global_scenery_dsf_file, tmp_file)
     except:
         UI.exit_message_and_bottom_line(
             "     ERROR: could not copy it. Disk full, write permissions,",
@@ -400,241 +569,239 @@ def extract_elevation_and_bathymetry_data(lat, lon):
         os.replace(tmp_file, tmp_file + ".7z")
         subprocess.run([OVL.unzip_cmd, "e", f"-o{FNAMES.Tmp_dir}", f"{tmp_file}.7z"])
         os.remove(tmp_file + '.7z')
-    file_len = os.path.getsize(tmp_file)
-    f = open(tmp_file, "rb")
-    # read filetype cookie
-    dsfid = f.read(8).decode("ascii")
-    if dsfid != "XPLNEDSF":
+    try:
+        dsf = DSFR.DSF_Reader(tmp_file)
+    except:
         UI.exit_message_and_bottom_line("     ERROR: Corrupted DSF file.")
         os.remove(tmp_file)
         return (b"", b"")
-    # skip format number
-    f.read(4)
-    # read atoms
-    atoms_len = file_len - 12 - 16  # 12 for HDR and 16 for MD5
-    atoms_consumed = 0
-    while atoms_consumed < atoms_len:
-        atom_hdr = f.read(4).decode("ascii")
-        atom_len = struct.unpack("<I", f.read(4))[0]
-        if atom_hdr == "SMED":
-            bDEMS_orig = f.read(atom_len - 8)
-            bDEMS = b""
-            bELEV = b""
-            g = io.BytesIO(bDEMS_orig)
-            consumed = 8
-            i = 0
-            while consumed < atom_len:
-                bH = g.read(4)
-                sub_atom_hdr = bH.decode("ascii")
-                bL = g.read(4)
-                sub_atom_len = struct.unpack("<I", bL)[0]
-                bDATA = g.read(sub_atom_len - 8)
-                if (sub_atom_len > 100):
-                    i += 1
-                    if (i == 1):
-                        bELEV = bDATA
-                    elif (i == 2):
-                        # XP bathy data for inland water is only partial,
-                        # we use a safe margin = DEM_elev - 2 to cope with it
-                        bathy = numpy.frombuffer(bDATA, dtype=numpy.int16)
-                        safe  = numpy.frombuffer(bELEV, dtype=numpy.int16) - 2 
-                        bathy = numpy.minimum(bathy, safe)
-                        bDATA = bytes(bathy)
-                bDEMS += bH + bL + bDATA
-                consumed += sub_atom_len
-            g.close()
-        elif atom_hdr == "NFED":
-            consumed = 8
-            while consumed < atom_len:
-                sub_atom_hdr = f.read(4).decode("ascii")
-                sub_atom_len = struct.unpack("<I", f.read(4))[0]
-                data = f.read(sub_atom_len - 8)
-                if sub_atom_hdr == "NMED":
-                    bDEMN = data
-                consumed += sub_atom_len
-        else:
-            f.read(atom_len - 8)
-
-        atoms_consumed += atom_len
-
-    f.close()
+    with dsf:
+        demn = dsf.atom("DEFN", "DEMN")
+        bDEMN = bytes(dsf.content(demn)) if demn else b""
+        bDEMS = b""
+        bELEV = b""
+        dems_atoms = []
+        dems = dsf.atom("DEMS")
+        i = 0
+        for atom in dsf.atoms(dems) if dems else []:
+            bDATA = bytes(dsf.content(atom))
+            if atom.size + 8 > 100:
+                i += 1
+                if i == 1:
+                    bELEV = bDATA
+                elif i == 2:
+                    # XP bathy data for inland water is only partial,
+                    # we use a safe margin = DEM_elev - 2 to cope with it
+                    bathy = numpy.frombuffer(bDATA, dtype=numpy.int16)
+                    safe = numpy.frombuffer(bELEV, dtype=numpy.int16) - 2
+                    bathy = numpy.minimum(bathy, safe)
+                    bDATA = bytes(bathy)
+            # atom ids are stored backwards
+            sub_atom_hdr = atom.id[::-1]
+            bDEMS += struct.pack(
+                "<4sI", sub_atom_hdr.encode("ascii"), 8 + len(bDATA)
+            )
+            bDEMS += bDATA
+            dems_atoms.append((sub_atom_hdr, bDATA))
     os.remove(tmp_file)
 
+    if cache_gs_rasters:
+        write_cached_rasters(
+            lat, lon, global_scenery_dsf_file, bDEMN, dems_atoms
+        )
     return (bDEMN, bDEMS)
 
 
 ################################################################################
 
 ################################################################################
-def build_dsf(tile, download_queue):
-
-    
-    dico_customzl = zone_list_to_ortho_dico(tile)
-
-    # 1 Read mesh file
-    UI.vprint(1, "-> Reading mesh file")
-    mesh_filename = FNAMES.mesh_file(tile.build_dir, tile.lat, tile.lon)
-    (mesh_version, nbr_nodes, node_coords, nbr_tris, tri_idx, tri_types) \
-            = MESH.read_mesh_file(mesh_filename)
-
-    # 2 Remap tri_types in (0,1,2)
-    has_water = 7 if (mesh_version >= 1.3) else 3
-    for i in range(nbr_tris):
-        t = tri_types[i] & has_water
-        t = t and (2 * (t > 1 or tile.use_masks_for_inland) or 1)
-        tri_types[i] = t
+class Terrains:
+    """Terrains of a DSF, created (with their terrain file and the download
+    of their texture) the first time a triangle needs them."""
+
+    def __init__(self, tile, download_queue):
+        self.tile = tile
+        self.download_queue = download_queue
+        self.dico = {"terrain_Water": 0}
+        self.overlays = set()
+        self.treated_textures = set()
+        self.skipped_for_masking = set()
+        self.tris = {0: defaultdict(lambda: array.array("H"))}
+        self.bTERT = bytes("terrain_Water\0", "ascii")
+
+    def get(self, texture_attributes, tri_type):
+        # (terrain_idx, is_overlay), terrain_idx 0 being X-Plane water
+        terrain_attributes = (texture_attributes, tri_type)
+        if terrain_attributes in self.dico:
+            terrain_idx = self.dico[terrain_attributes]
+            return (terrain_idx, terrain_idx in self.overlays)
+        if tri_type == 2:
+            return self.new_sea_terrain(texture_attributes, tri_type)
+        return self.new_land_terrain(texture_attributes, tri_type)
+
+    def new_terrain(self, texture_attributes, tri_type, is_overlay):
+        terrain_idx = len(self.dico)
+        self.tris[terrain_idx] = defaultdict(lambda: array.array("H"))
+        self.dico[(texture_attributes, tri_type)] = terrain_idx
+        if is_overlay:
+            self.overlays.add(terrain_idx)
+        return terrain_idx
+
+    def add_terrain_file(
+        self, texture_file_name, texture_attributes, tri_type, is_overlay
+    ):
+        terrain_file_name = create_terrain_file(
+            self.tile,
+            texture_file_name,
+            *texture_attributes,
+            tri_type,
+            is_overlay
+        )
+        self.bTERT += bytes("terrain/" + terrain_file_name + "\0", "ascii")
 
-    # 3 Recut water tris for XP12
-    UI.vprint(1, "-> Adapting water triangles to XP12 requirements")
-    (nbr_nodes, node_coords, node_types, node_is_coast, nbr_tris, tri_idx, 
-        tri_types) = BATHY.recut_water_tris(node_coords, tri_idx, tri_types)
+    def new_sea_terrain(self, texture_attributes, tri_type):
+        tile = self.tile
+        terrain_attributes = (texture_attributes, tri_type)
+        # we need to check with masks values
+        if terrain_attributes in self.skipped_for_masking:
+            return (0, False)
+        mask_im = MASK.needs_mask(tile, *texture_attributes)
+        if not mask_im:
+            self.skipped_for_masking.add(terrain_attributes)
+            # clean up potential old masks in the tile dir
+            try:
+                os.remove(
+                    os.path.join(
+                        tile.build_dir,
+                        "textures",
+                        FNAMES.mask_file(*texture_attributes),
+                    )
+                )
+            except:
+                pass
+            return (0, False)
+        UI.vprint(2, "      Use of an alpha mask.")
+        # Is it an overlay terrain or the new XP 12 phys water type ?
+        # XP11 style => overlay
+        is_overlay = (tile.water_tech == "XP11 + bathy") 
+        # No alpha channel in DDS => overlay
+        is_overlay |= not tile.imprint_masks_to_dds
+        terrain_idx = self.new_terrain(texture_attributes, tri_type, is_overlay)
+        texture_file_name = FNAMES.dds_file_name_from_attributes(
+            *texture_attributes
+        )
+        # do we need to (re)build a texture ?
+        if texture_attributes not in self.treated_textures:
+            target_tex = os.path.join(
+                    tile.build_dir, "textures", texture_file_name
+                    )
+            rebuild = False
+            if (not os.path.isfile(target_tex)):
+                rebuild = True
+            elif (tile.imprint_masks_to_dds):
+                # Maybe target_tex was a DXT1, we need DXT5
+                if (os.path.getsize(target_tex) < 20000000):
+                    rebuild = True
+                # Maybe masks were updated after target_tex was created
+                target_mask = MASK.mask_name_for_texture(tile, 
+                                  *texture_attributes)
+                if (os.path.isfile(target_mask)):
+                    mask_last_modified = os.path.getmtime(target_mask)
+                    tex_last_modified = os.path.getmtime(target_tex)
+                    if (tex_last_modified < mask_last_modified):
+                        rebuild = True
+            else: 
+                # maybe target_tex was a DXT5, it should ne a DXT1
+                if (os.path.getsize(target_tex) > 20000000):
+                    rebuild = True
+                else:
+                    print(os.path.getsize(target_tex))
+            
+            if (rebuild or not tile.imprint_masks_to_dds):
+                mask_im.save(os.path.join(
+                    tile.build_dir,
+                    "textures",
+                    FNAMES.mask_file(*texture_attributes),
+                )
+            )
 
-    # 4 Compute bathymetry depth ratio bounds based on masks
-    UI.vprint(1, "-> Computing bathymetry depth ratio bounds based on distance masks")
-    node_bathy = BATHY.compute_depth_ratio_bounds_from_masks(
-                            nbr_nodes, node_coords, node_types, tile)
-    
-    UI.vprint(1, "-> Computing point pools and texture requirements")
-    
-    # 5 Compute quadtree
-    if (tile.use_masks_for_inland):
-        quad_capacity = quad_capacity_low
-    else:
-        quad_capacity = quad_capacity_high
-    pool_quadtree = QuadTree(quad_init_level, quad_capacity)
-    for i in range(nbr_nodes):
-        pool_quadtree.insert(
-                float2qquad(node_coords[5 * i + 0] - tile.lon),
-                float2qquad(node_coords[5 * i + 1] - tile.lat),
-                quad_init_level)
-    pool_quadtree.clean()
-    pool_quadtree.statistics()
-    
-    # 6 Compute pool params
-    pool_nbr = len(pool_quadtree)
-    idx_node_to_idx_pool = {}
-    idx_pool = 0
-    key_to_idx_pool = {}
-    for key in pool_quadtree:
-        key_to_idx_pool[key] = idx_pool
-        for idx_node in pool_quadtree[key]["idx_nodes"]:
-            idx_node_to_idx_pool[idx_node] = idx_pool
-        idx_pool += 1
-    pool_param = {}
-    node_icoords = numpy.zeros(5 * nbr_nodes, dtype = numpy.uint16)
-    for key in pool_quadtree:
-        level = len(key[0])
-        plist = sorted(list(pool_quadtree[key]["idx_nodes"]))
-        node_icoords[[5 * idx_node for idx_node in plist]] = [
-            int(pool_quadtree.nodes[idx_node][0][level : level + 16], 2)
-            for idx_node in plist
-        ]
-        node_icoords[[5 * idx_node + 1 for idx_node in plist]] = [
-            int(pool_quadtree.nodes[idx_node][1][level : level + 16], 2)
-            for idx_node in plist
-        ]
-        altitudes = numpy.array(
-            [node_coords[5 * idx_node + 2] for idx_node in plist]
+            if (rebuild):
+                    self.download_queue.put(texture_attributes)
+            else:
+                UI.vprint(
+                    2,
+                    "   Texture file "
+                    + texture_file_name
+                    + " already present.",
+                )
+            self.treated_textures.add(texture_attributes)
+        self.add_terrain_file(
+            texture_file_name, texture_attributes, tri_type, is_overlay
         )
-        altmin = floor(altitudes.min())
-        altmax = ceil(altitudes.max())
-        if altmax - altmin < 770:
-            scale_z = 771  # 65535=771*85
-            inv_stp = 85
-        elif altmax - altmin < 1284:
-            scale_z = 1285  # 65535=1285*51
-            inv_stp = 51
-        elif altmax - altmin < 4368:
-            scale_z = 4369  # 65535=4369*15
-            inv_stp = 15
-        else:
-            scale_z = 13107  # 65535=13107*5
-            inv_stp = 5
-        scal_x = scal_y = 2 ** (-level)
-        node_icoords[[5 * idx_node + 2 for idx_node in plist]] = numpy.round(
-            (altitudes - altmin) * inv_stp
+        return (terrain_idx, is_overlay)
+
+    def new_land_terrain(self, texture_attributes, tri_type):
+        tile = self.tile
+        is_overlay = tri_type == 1
+        terrain_idx = self.new_terrain(texture_attributes, tri_type, is_overlay)
+        texture_file_name = FNAMES.dds_file_name_from_attributes(
+            *texture_attributes
         )
-        pool_param[key_to_idx_pool[key]] = (
-            scal_x,
-            tile.lon + int(key[0], 2) * scal_x,
-            scal_y,
-            tile.lat + int(key[1], 2) * scal_y,
-            scale_z,
-            altmin,
-            2,
-            -1,
-            2,
-            -1,
-            1,
-            0,
-            1,
-            0,
-            1,
-            0,
-            1,
-            0,
+        # do we need to download a new texture ?
+        if texture_attributes not in self.treated_textures:
+            target_tex = os.path.join(
+                        tile.build_dir, "textures", texture_file_name
+                        )
+            rebuild = False
+            if (not os.path.isfile(target_tex)):
+                rebuild = True
+            if (rebuild):
+                self.download_queue.put(texture_attributes)
+            else:
+                UI.vprint(
+                    2,
+                    "   Texture file "
+                    + texture_file_name
+                    + " already present.",
+                )
+            self.treated_textures.add(texture_attributes)
+        self.add_terrain_file(
+            texture_file_name, texture_attributes, tri_type, is_overlay
         )
-    node_icoords[3::5] = numpy.round(
-        (1 + tile.normal_map_strength * node_coords[3::5]) / 2 * 65535
-    )
-    node_icoords[4::5] = numpy.round(
-        (1 - tile.normal_map_strength * node_coords[4::5]) / 2 * 65535
-    )
-    node_icoords = array.array("H", node_icoords)
+        return (terrain_idx, is_overlay)
 
-    
-    
-    ##########################
-    dico_terrains = {}
-    overlay_terrains = set()
-    treated_textures = set()
-    skipped_terrains_for_masking = set()
+
+################################################################################
+
+################################################################################
+def texture_triangles(
+    tile,
+    terrains,
+    dico_customzl,
+    nbr_tris,
+    tri_idx,
+    tri_types,
+    node_coords,
+    node_icoords,
+    idx_node_to_idx_pool,
+    pool_nbr,
+    node_is_coast,
+    node_bathy,
+):
+    # Builds the DSF mesh points (these take into accound texture as well)
+    # in their pools, and puts the triangles in the patches of their terrain.
+    # Returns None if interrupted.
     dsf_pools = {}
+    idx_node_to_idx_pool = idx_node_to_idx_pool.tolist()
     # we need more pools for textured nodes than for nodes : land, UV masked
     # water, and XP water
     dsf_pool_nbr = 3 * pool_nbr
     for idx_dsfpool in range(dsf_pool_nbr):
         dsf_pools[idx_dsfpool] = array.array("H")
     dsf_pool_length = numpy.zeros(dsf_pool_nbr, "int")
-    if (tile.water_tech == "XP11 + bathy"):
-        # Land with ortho
-        dsf_pool_plane = 7 * numpy.ones(dsf_pool_nbr, "int")
-        # Masked ortho (UV1 = ortho, UV2 = border_tex (if aplicable))
-        dsf_pool_plane[pool_nbr : 2 * pool_nbr] = 9
-        # Regular XP water
-        dsf_pool_plane[2 * pool_nbr : 3 * pool_nbr] = 7
-    elif (tile.water_tech == "XP12"):
-        # Land with ortho
-        dsf_pool_plane = 7 * numpy.ones(dsf_pool_nbr, "int")
-        # Masked ortho : UV1 = fetch/depth UV2 = ortho)
-        #           or : UV1 = ortho, V2 = border_tex
-        #                for inland water with constant alpha
-        dsf_pool_plane[pool_nbr : 2 * pool_nbr] = 9
-        # Regular XP water
-        dsf_pool_plane[2 * pool_nbr : 3 * pool_nbr] = 7
     textured_nodes = {}
     len_textured_nodes = 0
-    textured_tris = {}
     total_cross_pool = 0
-    ##########################
-
-    bPROP = b""
-    bTERT = b""
-    bOBJT = b""
-    bPOLY = b""
-    bNETW = b""
-    bDEMN = b""
-    bGEOD = b""
-    bDEMS = b""
-    bCMDS = b""
-
-    nbr_dsfpools_yet_in = 0
-    dico_terrains = {"terrain_Water": 0}
-    bTERT = bytes("terrain_Water\0", "ascii")
-    textured_tris[0] = defaultdict(lambda: array.array("H"))
-
-    # Next, we build DSF mesh points (these take into accound texture 
-    # as well), point pools, etc.
 
     step = nbr_tris // 100 + 1
     
@@ -651,8 +818,7 @@ def build_dsf(tile, download_queue):
         if done % step == 0:
             UI.progress_bar(1, int(done / step * 0.9))
             if UI.red_flag:
-                UI.vprint(1, "DSF construction interrupted.")
-                return 0
+                return None
         done += 1
         bary_lon = (
             node_coords[5 * n1 + 0]
@@ -667,110 +833,7 @@ def build_dsf(tile, download_queue):
         texture_attributes = dico_customzl[
             GEO.wgs84_to_orthogrid(bary_lat, bary_lon, tile.mesh_zl)
         ]
-        # The entries for the terrain and texture main dictionnaries
-        terrain_attributes = (texture_attributes, tri_type)
-        is_overlay = False
-        
-
-        # Do we need to build new terrain file(s) ?
-        if terrain_attributes in dico_terrains:
-            terrain_idx = dico_terrains[terrain_attributes]
-            is_overlay = terrain_idx in overlay_terrains
-        else:
-            needs_new_terrain = False
-            # if not we need to check with masks values
-            if terrain_attributes not in skipped_terrains_for_masking:
-                mask_im = MASK.needs_mask(tile, *texture_attributes)
-                if mask_im:
-                    UI.vprint(2, "      Use of an alpha mask.")
-                    needs_new_terrain = True
-                else:
-                    skipped_terrains_for_masking.add(terrain_attributes)
-                    # clean up potential old masks in the tile dir
-                    try:
-                        os.remove(
-                            os.path.join(
-                                tile.build_dir,
-                                "textures",
-                                FNAMES.mask_file(*texture_attributes),
-                            )
-                        )
-                    except:
-                        pass
-            if needs_new_terrain:
-                terrain_idx = len(dico_terrains)
-                textured_tris[terrain_idx] = defaultdict(
-                    lambda: array.array("H")
-                )
-                dico_terrains[terrain_attributes] = terrain_idx
-                
-                # Is it an overlay terrain or the new XP 12 phys water type ?
-                # XP11 style => overlay
-                is_overlay = (tile.water_tech == "XP11 + bathy") 
-                # No alpha channel in DDS => overlay
-                is_overlay |= not tile.imprint_masks_to_dds
-                
-                if is_overlay:
-                    overlay_terrains.add(terrain_idx)
-                
-                texture_file_name = FNAMES.dds_file_name_from_attributes(
-                    *texture_attributes
-                )
-                # do we need to (re)build a texture ?
-                if texture_attributes not in treated_textures:
-                    target_tex = os.path.join(
-                            tile.build_dir, "textures", texture_file_name
-                            )
-                    rebuild = False
-                    if (not os.path.isfile(target_tex)):
-                        rebuild = True
-                    elif (tile.imprint_masks_to_dds):
-                        # Maybe target_tex was a DXT1, we need DXT5
-                        if (os.path.getsize(target_tex) < 20000000):
-                            rebuild = True
-                        # Maybe masks were updated after target_tex was created
-                        target_mask = MASK.mask_name_for_texture(tile, 
-                                          *texture_attributes)
-                        if (os.path.isfile(target_mask)):
-                            mask_last_modified = os.path.getmtime(target_mask)
-                            tex_last_modified = os.path.getmtime(target_tex)
-                            if (tex_last_modified < mask_last_modified):
-                                rebuild = True
-                    else: 
-                        # maybe target_tex was a DXT5, it should ne a DXT1
-                        if (os.path.getsize(target_tex) > 20000000):
-                            rebuild = True
-                        else:
-                            print(os.path.getsize(target_tex))
-                    
-                    if (rebuild or not tile.imprint_masks_to_dds):
-                        mask_im.save(os.path.join(
-                            tile.build_dir,
-                            "textures",
-                            FNAMES.mask_file(*texture_attributes),
-                        )
-                    )
-
-                    if (rebuild):
-                            download_queue.put(texture_attributes)
-                    else:
-                        UI.vprint(
-                            2,
-                            "   Texture file "
-                            + texture_file_name
-                            + " already present.",
-                        )
-                    treated_textures.add(texture_attributes)
-                terrain_file_name = create_terrain_file(
-                    tile,
-                    texture_file_name,
-                    *texture_attributes,
-                    tri_type,
-                    is_overlay
-                )
-                bTERT += bytes("terrain/" + terrain_file_name + "\0", "ascii")
-            else:
-                terrain_idx = 0
+        (terrain_idx, is_overlay) = terrains.get(texture_attributes, tri_type)
         
         # We put the tri in the right terrain
         # First the ones associated to the dico_customzl
@@ -834,12 +897,12 @@ def build_dsf(tile, download_queue):
             ):
                 continue
             if tri_p[0] == tri_p[2] == tri_p[4]:
-                textured_tris[terrain_idx][tri_p[0]].extend(
+                terrains.tris[terrain_idx][tri_p[0]].extend(
                     (tri_p[1], tri_p[3], tri_p[5])
                 )
             else:
                 total_cross_pool += 1
-                textured_tris[terrain_idx]["cross-pool"].extend(tri_p)
+                terrains.tris[terrain_idx]["cross-pool"].extend(tri_p)
         # X-Plane water
         if (not terrain_idx) or is_overlay: 
             tri_p = array.array("H")
@@ -869,12 +932,12 @@ def build_dsf(tile, download_queue):
                     dsf_pool_length[idx_dsfpool] += 1
                 tri_p.extend((idx_dsfpool, pos_in_pool))
             if tri_p[0] == tri_p[2] == tri_p[4]:
-                textured_tris[0][tri_p[0]].extend(
+                terrains.tris[0][tri_p[0]].extend(
                     (tri_p[1], tri_p[3], tri_p[5])
                 )
             else:
                 total_cross_pool += 1
-                textured_tris[0]["cross-pool"].extend(tri_p)
+                terrains.tris[0]["cross-pool"].extend(tri_p)
 
     # Second land and inland water tris with no mask
     for tri in range(nbr_tris):
@@ -886,8 +949,7 @@ def build_dsf(tile, download_queue):
         if done % step == 0:
             UI.progress_bar(1, int(done / step * 0.9))
             if UI.red_flag:
-                UI.vprint(1, "DSF construction interrupted.")
-                return 0
+                return None
         done += 1
         bary_lon = (
             node_coords[5 * n1] + node_coords[5 * n2] + node_coords[5 * n3]
@@ -900,50 +962,7 @@ def build_dsf(tile, download_queue):
         texture_attributes = dico_customzl[
             GEO.wgs84_to_orthogrid(bary_lat, bary_lon, tile.mesh_zl)
         ]
-        # The entries for the terrain and texture main dictionnaries
-        terrain_attributes = (texture_attributes, tri_type)
-        is_overlay = False
-
-        # Do we need to build new terrain file(s) ?
-        if terrain_attributes in dico_terrains:
-            terrain_idx = dico_terrains[terrain_attributes]
-            is_overlay = terrain_idx in overlay_terrains
-        else:
-            terrain_idx = len(dico_terrains)
-            textured_tris[terrain_idx] = defaultdict(lambda: array.array("H"))
-            dico_terrains[terrain_attributes] = terrain_idx
-            is_overlay = tri_type == 1
-            if is_overlay:
-                overlay_terrains.add(terrain_idx)
-            texture_file_name = FNAMES.dds_file_name_from_attributes(
-                *texture_attributes
-            )
-            # do we need to download a new texture ?
-            if texture_attributes not in treated_textures:
-                target_tex = os.path.join(
-                            tile.build_dir, "textures", texture_file_name
-                            )
-                rebuild = False
-                if (not os.path.isfile(target_tex)):
-                    rebuild = True
-                if (rebuild):
-                    download_queue.put(texture_attributes)
-                else:
-                    UI.vprint(
-                        2,
-                        "   Texture file "
-                        + texture_file_name
-                        + " already present.",
-                    )
-                treated_textures.add(texture_attributes)
-            terrain_file_name = create_terrain_file(
-                tile,
-                texture_file_name,
-                *texture_attributes,
-                tri_type,
-                is_overlay
-            )
-            bTERT += bytes("terrain/" + terrain_file_name + "\0", "ascii")
+        (terrain_idx, is_overlay) = terrains.get(texture_attributes, tri_type)
         # We put the tri in the right terrain
         # First the ones associated to the dico_customzl
         tri_p = array.array("H")
@@ -1002,12 +1021,12 @@ def build_dsf(tile, download_queue):
         ):
             continue
         if tri_p[0] == tri_p[2] == tri_p[4]:
-            textured_tris[terrain_idx][tri_p[0]].extend(
+            terrains.tris[terrain_idx][tri_p[0]].extend(
                 (tri_p[1], tri_p[3], tri_p[5])
             )
         else:
             total_cross_pool += 1
-            textured_tris[terrain_idx]["cross-pool"].extend(tri_p)
+            terrains.tris[terrain_idx]["cross-pool"].extend(tri_p)
         
         # XP water
         if is_overlay: 
@@ -1037,138 +1056,597 @@ def build_dsf(tile, download_queue):
                     dsf_pool_length[idx_dsfpool] += 1
                 tri_p.extend((idx_dsfpool, pos_in_pool))
             if tri_p[0] == tri_p[2] == tri_p[4]:
-                textured_tris[0][tri_p[0]].extend(
+                terrains.tris[0][tri_p[0]].extend(
                     (tri_p[1], tri_p[3], tri_p[5])
                 )
             else:
                 total_cross_pool += 1
-                textured_tris[0]["cross-pool"].extend(tri_p)
-    
-    download_queue.put("quit")
+                terrains.tris[0]["cross-pool"].extend(tri_p)
+    return (dsf_pools, dsf_pool_length, len_textured_nodes, total_cross_pool)
 
-    UI.vprint(1, "-> Encoding of the DSF file")
-    UI.vprint(1, "     Final nbr of nodes: " + str(len_textured_nodes))
-    UI.vprint(2, "     Final nbr of cross pool tris: " + str(total_cross_pool))
 
-    # Now is time to write our DSF to disk, the exact binary format is 
-    # described on the wiki
-    dsf_file_name = os.path.join(
-        tile.build_dir,
-        "Earth nav data",
-        FNAMES.long_latlon(tile.lat, tile.lon) + ".dsf",
-    )
-    
-    if os.path.exists(dsf_file_name):
-        os.replace(dsf_file_name, dsf_file_name + ".bak")
+################################################################################
 
-    # Note: present code should always choose the first branch.
-    if bPROP == b"":
-        bPROP = bytes(
-            "sim/west\0"
-            + str(tile.lon)
-            + "\0"
-            + "sim/east\0"
-            + str(tile.lon + 1)
-            + "\0"
-            + "sim/south\0"
-            + str(tile.lat)
-            + "\0"
-            + "sim/north\0"
-            + str(tile.lat + 1)
-            + "\0"
-            + "sim/creation_agent\0"
-            + "Ortho4XP\0",
-            "ascii",
+################################################################################
+def orthogrid_cells(lats, lons, zoomlevel):
+    # GEO.wgs84_to_orthogrid for arrays, with the very same results : numpy
+    # and math may disagree on the last bit of log(tan(.)), which only
+    # matters right on a cell border, those few points go through math.
+    mult = 2 ** (zoomlevel - 5)
+    ratio_x = lons / 180
+    ratio_y = numpy.log(numpy.tan((90 + lats) * numpy.pi / 360)) / numpy.pi
+    x = (ratio_x + 1) * mult
+    y = (1 - ratio_y) * mult
+    til_x = x.astype(numpy.int64) * 16
+    til_y = y.astype(numpy.int64) * 16
+    for i in numpy.flatnonzero(numpy.abs(y - numpy.rint(y)) < 1e-6):
+        (til_x[i], til_y[i]) = GEO.wgs84_to_orthogrid(
+            float(lats[i]), float(lons[i]), zoomlevel
         )
-    else:
-        bPROP += b"sim/creation_agent\0Patched by Ortho4XP\0"
+    return (til_x, til_y)
 
-    # Transfer DEM and bathymetry raster from Global Scenery tiles
-    (bDEMN, bDEMS) = extract_elevation_and_bathymetry_data(tile.lat, tile.lon)
 
-    # Computation of intermediate and of total length
-    size_of_head_atom = 16 + len(bPROP)
-    size_of_prop_atom = 8 + len(bPROP)
-    size_of_defn_atom = (
-        48 + len(bTERT) + len(bOBJT) + len(bPOLY) + len(bNETW) + len(bDEMN)
-    )
-    size_of_geod_atom = 8 + len(bGEOD)
-    size_of_dems_atom = 8 + len(bDEMS)
-    for k in range(dsf_pool_nbr):
-        if dsf_pool_length[k] > 0:
-            size_of_geod_atom += 21 + dsf_pool_plane[k] * (
-                9 + 2 * dsf_pool_length[k]
+################################################################################
+
+################################################################################
+def st_icoords(lats, lons, til_x_left, til_y_top, zoomlevel):
+    # GEO.st_coord for arrays, rounded to 16 bits as in the DSF, and with the
+    # same caution as orthogrid_cells (for t only, s has no log in it).
+    mult = numpy.ldexp(1.0, zoomlevel - 5)
+    ratio_x = lons / 180
+    ratio_y = numpy.log(numpy.tan((90 + lats) * numpy.pi / 360)) / numpy.pi
+    s = numpy.clip((ratio_x + 1) * mult - til_x_left // 16, 0, 1) * 65535
+    t = numpy.clip(1 - ((1 - ratio_y) * mult - til_y_top // 16), 0, 1) * 65535
+    s = numpy.rint(s).astype(numpy.int64)
+    unsure = numpy.abs(t - numpy.floor(t) - 0.5) < 1e-4
+    t = numpy.rint(t).astype(numpy.int64)
+    for i in numpy.flatnonzero(unsure):
+        t[i] = int(
+            round(
+                GEO.st_coord(
+                    float(lats[i]),
+                    float(lons[i]),
+                    int(til_x_left[i]),
+                    int(til_y_top[i]),
+                    int(zoomlevel[i]),
+                    None,
+                )[1]
+                * 65535
             )
-    UI.vprint(
-        2, "     Size of DEFN atom : " + str(size_of_defn_atom) + " bytes."
+        )
+    return (s, t)
+
+
+################################################################################
+
+################################################################################
+def depth_ratios(nodes, node_is_coast, node_bathy, tile):
+    # BATHY.set_depth_ratio for arrays, scaled to 16 bits
+    ratios = numpy.clip(10 * tile.ratio_bathy * node_bathy[nodes] / 255, 0.1, 1)
+    ratios[node_is_coast[nodes]] = 0
+    return (65535 * ratios).astype(numpy.int64)
+
+
+################################################################################
+
+################################################################################
+def new_pool_entries(keys, pools, dsf_pool_length):
+    # keys and pools of a sequence of vertices. The distinct keys take the
+    # next free positions of their pool, in the order they first appear.
+    # Returns, for each vertex, its position in its pool, and the index of
+    # the first vertex of each new entry, grouped by pool.
+    (_, first, inverse) = numpy.unique(
+        keys, return_index=True, return_inverse=True
+    )
+    appearance = numpy.argsort(first, kind="stable")
+    first = first[appearance]
+    by_pool = numpy.argsort(pools[first], kind="stable")
+    new_pools = pools[first][by_pool]
+    ranks = numpy.empty(len(first), dtype=numpy.int64)
+    ranks[by_pool] = numpy.arange(len(first)) - numpy.searchsorted(
+        new_pools, new_pools
+    )
+    positions = numpy.empty(len(first), dtype=numpy.int64)
+    positions[appearance] = dsf_pool_length[pools[first]] + ranks
+    dsf_pool_length += numpy.bincount(
+        new_pools, minlength=len(dsf_pool_length)
+    )
+    return (positions[inverse.ravel()], first[by_pool])
+
+
+################################################################################
+
+################################################################################
+def extend_pools(dsf_pools, pools, values):
+    # values : one row per new entry, rows grouped by pool and in order
+    bounds = numpy.flatnonzero(numpy.diff(pools)) + 1
+    for (start, end) in zip(
+        numpy.concatenate(([0], bounds)), numpy.concatenate((bounds, [len(pools)]))
+    ):
+        if start < end:
+            dsf_pools[int(pools[start])].frombytes(
+                numpy.ascontiguousarray(values[start:end], dtype=numpy.uint16)
+                .tobytes()
+            )
+
+
+################################################################################
+
+################################################################################
+def add_tris(terrain_tris, terrains, tri_pools, tri_positions):
+    # appends the triangles (already in their final order) to the patches
+    # of their terrain, patches being created in order of first use as in
+    # texture_triangles
+    same_pool = (tri_pools[:, 0] == tri_pools[:, 1]) & (
+        tri_pools[:, 1] == tri_pools[:, 2]
+    )
+    patches = numpy.where(same_pool, tri_pools[:, 0], -1)
+    (_, first, inverse) = numpy.unique(
+        terrain_tris * (1 << 32) + patches + 1,
+        return_index=True,
+        return_inverse=True,
+    )
+    inverse = inverse.ravel()
+    by_patch = numpy.argsort(inverse, kind="stable")
+    bounds = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(inverse))))
+    for patch in numpy.argsort(first, kind="stable"):
+        members = by_patch[bounds[patch] : bounds[patch + 1]]
+        terrain_idx = int(terrain_tris[first[patch]])
+        idx_dsfpool = int(patches[first[patch]])
+        if idx_dsfpool >= 0:
+            terrains.tris[terrain_idx][idx_dsfpool].frombytes(
+                tri_positions[members].astype(numpy.uint16).tobytes()
+            )
+        else:
+            terrains.tris[terrain_idx]["cross-pool"].frombytes(
+                numpy.stack(
+                    (tri_pools[members], tri_positions[members]), axis=2
+                )
+                .astype(numpy.uint16)
+                .tobytes()
+            )
+    return int(numpy.count_nonzero(~same_pool))
+
+
+################################################################################
+
+################################################################################
+def texture_triangles_numpy(
+    tile,
+    terrains,
+    dico_customzl,
+    nbr_tris,
+    tri_idx,
+    tri_types,
+    node_coords,
+    node_icoords,
+    idx_node_to_idx_pool,
+    pool_nbr,
+    node_is_coast,
+    node_bathy,
+):
+    # Same DSF pools and triangles as texture_triangles, byte for byte, but
+    # with all triangles at once.
+    dsf_pool_nbr = 3 * pool_nbr
+    dsf_pools = {k: array.array("H") for k in range(dsf_pool_nbr)}
+    dsf_pool_length = numpy.zeros(dsf_pool_nbr, "int")
+    node_coords = numpy.asarray(node_coords, dtype=numpy.float64)
+    (lons, lats) = (node_coords[0::5], node_coords[1::5])
+    icoords = numpy.array(node_icoords, dtype=numpy.int64).reshape(-1, 5)
+    node_pool = numpy.asarray(idx_node_to_idx_pool, dtype=numpy.int64)
+    node_is_coast = numpy.asarray(node_is_coast, dtype=bool)
+    node_bathy = numpy.asarray(node_bathy)
+    tri_types = numpy.asarray(tri_types[:nbr_tris], dtype=numpy.int64)
+    # potentially masked water tris first, then land and inland water ones,
+    # each with its vertices in the (n1, n3, n2) order
+    order = numpy.concatenate(
+        (numpy.flatnonzero(tri_types == 2), numpy.flatnonzero(tri_types != 2))
+    )
+    tris = numpy.asarray(tri_idx[: 3 * nbr_tris], dtype=numpy.int64)
+    tris = tris.reshape(-1, 3)[order][:, [0, 2, 1]]
+    types = tri_types[order]
+    bary_lon = (lons[tris[:, 0]] + lons[tris[:, 2]] + lons[tris[:, 1]]) / 3
+    bary_lat = (lats[tris[:, 0]] + lats[tris[:, 2]] + lats[tris[:, 1]]) / 3
+    (cell_x, cell_y) = orthogrid_cells(bary_lat, bary_lon, tile.mesh_zl)
+    UI.progress_bar(1, 10)
+
+    # terrains, in order of first appearance as with the loop
+    (combos, first, inverse) = numpy.unique(
+        (cell_x * (1 << 32) + cell_y) * 4 + types,
+        return_index=True,
+        return_inverse=True,
+    )
+    combo_terrain = numpy.zeros(len(combos), dtype=numpy.int64)
+    combo_overlay = numpy.zeros(len(combos), dtype=bool)
+    combo_texture = numpy.zeros((len(combos), 3), dtype=numpy.int64)
+    for combo in numpy.argsort(first, kind="stable"):
+        if UI.red_flag:
+            return None
+        tri = first[combo]
+        texture_attributes = dico_customzl[(int(cell_x[tri]), int(cell_y[tri]))]
+        (combo_terrain[combo], combo_overlay[combo]) = terrains.get(
+            texture_attributes, int(types[tri])
+        )
+        combo_texture[combo] = texture_attributes[:3]
+    inverse = inverse.ravel()
+    terrain = combo_terrain[inverse]
+    is_overlay = combo_overlay[inverse]
+    UI.progress_bar(1, 30)
+
+    # textured nodes, shared by the vertices snapped to the same pool point
+    # of a terrain
+    textured = numpy.flatnonzero(terrain != 0)
+    nodes = tris[textured].ravel()
+    vertex_terrain = numpy.repeat(terrain[textured], 3)
+    vertex_type = numpy.repeat(types[textured], 3)
+    vertex_pools = node_pool[nodes] + pool_nbr * (vertex_type != 0)
+    keys = (vertex_terrain * pool_nbr + node_pool[nodes]) * (1 << 32) + (
+        icoords[nodes, 0] * (1 << 16) + icoords[nodes, 1]
+    )
+    (positions, new) = new_pool_entries(keys, vertex_pools, dsf_pool_length)
+    len_textured_nodes = len(new)
+    new_nodes = nodes[new]
+    new_types = vertex_type[new]
+    new_overlay = numpy.repeat(is_overlay[textured], 3)[new]
+    texture = numpy.repeat(combo_texture[inverse][textured], 3, axis=0)[new]
+    (s, t) = st_icoords(
+        lats[new_nodes],
+        lons[new_nodes],
+        texture[:, 0],
+        texture[:, 1],
+        texture[:, 2],
+    )
+    values = numpy.zeros((len(new), 9), dtype=numpy.int64)
+    values[:, :5] = icoords[new_nodes]
+    # land
+    values[:, 5] = s
+    values[:, 6] = t
+    # inland water, constant alpha overlay with flat shading
+    inland = new_types == 1
+    values[inland, 3:5] = 32768
+    values[inland, 5] = s[inland]
+    values[inland, 6] = t[inland]
+    values[inland, 7] = 0
+    values[inland, 8] = int(round(tile.ratio_water * 65535))
+    # masked water, border_tex masks with original normal
+    sea = new_types == 2
+    overlay = sea & new_overlay
+    values[overlay, 7] = s[overlay]
+    values[overlay, 8] = t[overlay]
+    # masked water, dxt5 dds with mask included
+    sea &= ~new_overlay
+    values[sea, 5] = 65535
+    values[sea, 6] = depth_ratios(new_nodes[sea], node_is_coast, node_bathy, tile)
+    values[sea, 7] = s[sea]
+    values[sea, 8] = t[sea]
+    land = new_types == 0
+    extend_pools(dsf_pools, vertex_pools[new][land], values[land, :7])
+    extend_pools(dsf_pools, vertex_pools[new][~land], values[~land])
+    UI.progress_bar(1, 60)
+
+    # some triangles could be reduced to nothing by the pool snapping,
+    # we skip them (and their X-Plane water too)
+    tri_pools = vertex_pools.reshape(-1, 3)
+    tri_positions = positions.reshape(-1, 3)
+    degenerate = numpy.zeros(len(tris), dtype=bool)
+    for (i, j) in ((0, 1), (1, 2), (2, 0)):
+        degenerate[textured] |= (tri_pools[:, i] == tri_pools[:, j]) & (
+            tri_positions[:, i] == tri_positions[:, j]
+        )
+    kept = ~degenerate[textured]
+    total_cross_pool = add_tris(
+        terrain[textured][kept], terrains, tri_pools[kept], tri_positions[kept]
+    )
+    UI.progress_bar(1, 70)
+    if UI.red_flag:
+        return None
+
+    # X-Plane water, one pool entry per node
+    water = numpy.flatnonzero(((terrain == 0) | is_overlay) & ~degenerate)
+    nodes = tris[water].ravel()
+    vertex_pools = node_pool[nodes] + 2 * pool_nbr
+    (positions, new) = new_pool_entries(nodes, vertex_pools, dsf_pool_length)
+    len_textured_nodes += len(new)
+    new_nodes = nodes[new]
+    values = numpy.zeros((len(new), 7), dtype=numpy.int64)
+    values[:, :3] = icoords[new_nodes, :3]
+    values[:, 3:5] = 32768
+    # TODO improve bathy and fetch ratio variety
+    values[:, 5] = 65535
+    values[:, 6] = depth_ratios(new_nodes, node_is_coast, node_bathy, tile)
+    extend_pools(dsf_pools, vertex_pools[new], values)
+    total_cross_pool += add_tris(
+        numpy.zeros(len(water), dtype=numpy.int64),
+        terrains,
+        vertex_pools.reshape(-1, 3),
+        positions.reshape(-1, 3),
+    )
+    UI.progress_bar(1, 90)
+    return (dsf_pools, dsf_pool_length, len_textured_nodes, total_cross_pool)
+
+
+################################################################################
+
+################################################################################
+def differenced(values):
+    # each value minus the previous one (modulo 65536), the first one as is
+    return numpy.diff(values, prepend=numpy.uint16(0))
+
+
+################################################################################
+
+################################################################################
+def rle_packets(values):
+    # The packets of the run-length encoding of values : a repeated value
+    # for the runs of 3 or more, the literal values in between, each packet
+    # counting at most 127 values. Returns their start, count and kind
+    # (True for a repeat), in order.
+    if len(values) == 0:
+        return (numpy.zeros(0, int), numpy.zeros(0, int), numpy.zeros(0, bool))
+    run_starts = numpy.flatnonzero(
+        numpy.concatenate(([True], values[1:] != values[:-1]))
+    )
+    run_lengths = numpy.diff(numpy.append(run_starts, len(values)))
+    repeat = run_lengths >= 3
+    # consecutive short runs are gathered in literal segments
+    literal = ~repeat
+    first = literal & numpy.concatenate(([True], repeat[:-1]))
+    last = literal & numpy.concatenate((repeat[1:], [True]))
+    starts = numpy.concatenate((run_starts[repeat], run_starts[first]))
+    lengths = numpy.concatenate(
+        (
+            run_lengths[repeat],
+            run_starts[last] + run_lengths[last] - run_starts[first],
+        )
+    )
+    kinds = numpy.arange(len(starts)) < numpy.count_nonzero(repeat)
+    nbr_packets = (lengths + 126) // 127
+    item = numpy.repeat(numpy.arange(len(starts)), nbr_packets)
+    k = numpy.arange(len(item)) - numpy.repeat(
+        numpy.cumsum(nbr_packets) - nbr_packets, nbr_packets
+    )
+    starts = starts[item] + 127 * k
+    counts = numpy.minimum(127, lengths[item] - 127 * k)
+    order = numpy.argsort(starts)
+    return (starts[order], counts[order], kinds[item][order])
+
+
+################################################################################
+
+################################################################################
+def rle_size(packets):
+    (_, counts, kinds) = packets
+    return int(numpy.where(kinds, 3, 1 + 2 * counts).sum())
+
+
+################################################################################
+
+################################################################################
+def plane_encoding(values):
+    # The smallest of the plane encodings of the DSF spec : 0 raw,
+    # 1 differenced, 2 run-length, 3 run-length differenced. Differencing
+    # alone does not save anything. Returns it with the encoded size.
+    sizes = (
+        2 * len(values),
+        rle_size(rle_packets(values)),
+        rle_size(rle_packets(differenced(values))),
+    )
+    best = min(range(3), key=sizes.__getitem__)
+    return ((0, 2, 3)[best], sizes[best])
+
+
+################################################################################
+
+################################################################################
+def encode_plane(values, encoding):
+    # values (uint16) in the given encoding, without the encoding byte
+    if encoding & 1:
+        values = differenced(values)
+    words = numpy.ascontiguousarray(values, dtype="<u2").view(numpy.uint8)
+    if not encoding & 2:
+        return words
+    words = words.reshape(-1, 2)
+    (starts, counts, kinds) = rle_packets(values)
+    sizes = numpy.where(kinds, 3, 1 + 2 * counts)
+    offsets = numpy.cumsum(sizes) - sizes
+    encoded = numpy.empty(sizes.sum(), dtype=numpy.uint8)
+    encoded[offsets] = numpy.where(kinds, 0x80, 0) | counts
+    # then the repeated value or the literal ones
+    nbr_words = numpy.where(kinds, 1, counts)
+    packet = numpy.repeat(numpy.arange(len(starts)), nbr_words)
+    j = numpy.arange(len(packet)) - numpy.repeat(
+        numpy.cumsum(nbr_words) - nbr_words, nbr_words
+    )
+    positions = offsets[packet] + 1 + 2 * j
+    encoded[positions] = words[starts[packet] + j, 0]
+    encoded[positions + 1] = words[starts[packet] + j, 1]
+    return encoded
+
+
+################################################################################
+
+################################################################################
+def pool_planes(pool, nbr_planes):
+    # The pools hold their points one after the other, the DSF wants them
+    # plane after plane.
+    return numpy.frombuffer(pool, dtype=numpy.uint16).reshape(-1, nbr_planes).T
+
+
+################################################################################
+
+################################################################################
+class DSF_Writer:
+    # Writes the atoms of a DSF from contiguous buffers, the md5 checksum
+    # which closes the file is updated along the way.
+    def __init__(self, file_name):
+        self.f = open(file_name, "wb")
+        self.md5 = hashlib.md5()
+
+    def write(self, data):
+        self.f.write(data)
+        self.md5.update(data)
+
+    def pack(self, fmt, *values):
+        self.write(struct.pack(fmt, *values))
+
+    def atom(self, tag, data):
+        self.pack("<4sI", tag, 8 + len(data))
+        self.write(data)
+
+    def pool_atom(self, planes, encodings):
+        # planes is the (nbr_planes, length) array of the pool values, each
+        # of them is written with its encoding byte.
+        (nbr_planes, length) = planes.shape
+        self.pack(
+            "<4sIIB",
+            b"LOOP",
+            13 + sum(1 + size for (_, size) in encodings),
+            length,
+            nbr_planes,
+        )
+        for (plane, (encoding, _)) in zip(planes, encodings):
+            self.pack("<B", encoding)
+            self.write(encode_plane(plane, encoding))
+
+    def scal_atom(self, params, nbr_planes):
+        self.pack(
+            "<4sI" + 2 * nbr_planes * "f",
+            b"LACS",
+            8 + 8 * nbr_planes,
+            *params[: 2 * nbr_planes]
+        )
+
+    def patch_triangles(self, command, coords, width):
+        # PATCH TRIANGLE (23) or PATCH TRIANGLE CROSS-POOL (24) commands for
+        # coords made of width uint16 each, by blocks of at most 255 coords.
+        coords = (
+            numpy.ascontiguousarray(coords, dtype="<u2")
+            .view(numpy.uint8)
+            .reshape(-1, 2 * width)
+        )
+        full = len(coords) - len(coords) % 255
+        blocks = numpy.empty((full // 255, 2 + 510 * width), dtype=numpy.uint8)
+        blocks[:, 0] = command
+        blocks[:, 1] = 255
+        blocks[:, 2:] = coords[:full].reshape(-1, 510 * width)
+        self.write(blocks)
+        if len(coords) > full:
+            self.pack("<BB", command, len(coords) - full)
+            self.write(coords[full:])
+
+    def close(self):
+        self.f.write(self.md5.digest())
+        self.f.close()
+
+    def abort(self):
+        self.f.close()
+
+
+################################################################################
+
+################################################################################
+def write_dsf(
+    dsf_file_name,
+    tile,
+    atoms,
+    dsf_pools,
+    dsf_pool_length,
+    dsf_pool_plane,
+    pool_param,
+    textured_tris,
+    overlay_terrains,
+    nbr_dsfpools_yet_in,
+):
+    # Now is time to write our DSF to disk, the exact binary format is
+    # described on the wiki. atoms holds the raw content of the PROP, TERT,
+    # OBJT, POLY, NETW, DEMN, GEOD, DEMS and CMDS atoms, the latter ones
+    # being completed by our pools and patches.
+    dsf_pool_nbr = len(dsf_pools)
+    pool_nbr = len(pool_param)
+    # Computation of intermediate and of total length
+    size_of_head_atom = 16 + len(atoms["PROP"])
+    size_of_defn_atom = 8 + sum(
+        8 + len(atoms[name]) for name in ("TERT", "OBJT", "POLY", "NETW", "DEMN")
+    )
+    size_of_geod_atom = 8 + len(atoms["GEOD"])
+    size_of_dems_atom = 8 + len(atoms["DEMS"])
+    # The encodings of the planes of the pools are chosen beforehand, the
+    # GEOD atom size depends on them.
+    pool_encodings = {}
+    size_of_raw_pools = size_of_pools = 0
+    for k in range(dsf_pool_nbr):
+        if dsf_pool_length[k] == 0:
+            continue
+        if pool_encoding == "smallest":
+            pool_encodings[k] = [
+                plane_encoding(plane)
+                for plane in pool_planes(dsf_pools[k], dsf_pool_plane[k])
+            ]
+        else:
+            pool_encodings[k] = [(0, 2 * int(dsf_pool_length[k]))] * int(
+                dsf_pool_plane[k]
+            )
+        size_of_raw_pools += dsf_pool_plane[k] * (1 + 2 * dsf_pool_length[k])
+        size_of_pools += sum(1 + size for (_, size) in pool_encodings[k])
+        size_of_geod_atom += 21 + 8 * dsf_pool_plane[k]
+    size_of_geod_atom += size_of_pools
+    nbr_encodings = numpy.bincount(
+        [
+            encoding
+            for encodings in pool_encodings.values()
+            for (encoding, _) in encodings
+        ],
+        minlength=4,
+    )
+    UI.vprint(
+        2,
+        "     Pool planes : "
+        + str(nbr_encodings[0])
+        + " raw, "
+        + str(nbr_encodings[2])
+        + " run-length, "
+        + str(nbr_encodings[3])
+        + " run-length differenced, "
+        + UI.human_print(size_of_pools)
+        + " instead of "
+        + UI.human_print(size_of_raw_pools)
+        + ".",
+    )
+    UI.vprint(
+        2, "     Size of DEFN atom : " + str(size_of_defn_atom) + " bytes."
     )
     UI.vprint(
         2, "     Size of GEOD atom : " + str(size_of_geod_atom) + " bytes."
     )
-    f = open(dsf_file_name + ".tmp", "wb")
-    f.write(b"XPLNEDSF")
-    f.write(struct.pack("<I", 1))
+    writer = DSF_Writer(dsf_file_name + ".tmp")
+    writer.pack("<8sI", b"XPLNEDSF", 1)
 
     # Head super-atom
-    f.write(b"DAEH")
-    f.write(struct.pack("<I", size_of_head_atom))
-    f.write(b"PORP")
-    f.write(struct.pack("<I", size_of_prop_atom))
-    f.write(bPROP)
+    writer.pack("<4sI", b"DAEH", size_of_head_atom)
+    writer.atom(b"PORP", atoms["PROP"])
 
     # Definitions super-atom
-    f.write(b"NFED")
-    f.write(struct.pack("<I", size_of_defn_atom))
-    f.write(b"TRET")
-    f.write(struct.pack("<I", 8 + len(bTERT)))
-    f.write(bTERT)
-    f.write(b"TJBO")
-    f.write(struct.pack("<I", 8 + len(bOBJT)))
-    f.write(bOBJT)
-    f.write(b"YLOP")
-    f.write(struct.pack("<I", 8 + len(bPOLY)))
-    f.write(bPOLY)
-    f.write(b"WTEN")
-    f.write(struct.pack("<I", 8 + len(bNETW)))
-    f.write(bNETW)
-    f.write(b"NMED")
-    f.write(struct.pack("<I", 8 + len(bDEMN)))
-    f.write(bDEMN)
+    writer.pack("<4sI", b"NFED", size_of_defn_atom)
+    for name in ("TERT", "OBJT", "POLY", "NETW", "DEMN"):
+        writer.atom(name[::-1].encode("ascii"), atoms[name])
 
     # Geodata super-atom
-    f.write(b"DOEG")
-    f.write(struct.pack("<I", size_of_geod_atom))
-    f.write(bGEOD)
+    writer.pack("<4sI", b"DOEG", size_of_geod_atom)
+    writer.write(atoms["GEOD"])
     for k in range(dsf_pool_nbr):
         if dsf_pool_length[k] == 0:
             continue
-        f.write(b"LOOP")
-        f.write(
-            struct.pack(
-                "<I",
-                13
-                + dsf_pool_plane[k]
-                + 2 * dsf_pool_plane[k] * dsf_pool_length[k],
-            )
+        writer.pool_atom(
+            pool_planes(dsf_pools[k], dsf_pool_plane[k]), pool_encodings[k]
         )
-        f.write(struct.pack("<I", dsf_pool_length[k]))
-        f.write(struct.pack("<B", dsf_pool_plane[k]))
-        for l in range(dsf_pool_plane[k]):
-            f.write(struct.pack("<B", 0))
-            for m in range(dsf_pool_length[k]):
-                f.write(
-                    struct.pack("<H", dsf_pools[k][dsf_pool_plane[k] * m + l])
-                )
     for k in range(dsf_pool_nbr):
         if dsf_pool_length[k] == 0:
             continue
-        f.write(b"LACS")
-        f.write(struct.pack("<I", 8 + 8 * dsf_pool_plane[k]))
-        for l in range(2 * dsf_pool_plane[k]):
-            f.write(struct.pack("<f", pool_param[k % pool_nbr][l]))
+        writer.scal_atom(pool_param[k % pool_nbr], int(dsf_pool_plane[k]))
 
     UI.progress_bar(1, 95)
     if UI.red_flag:
+        writer.abort()
         UI.vprint(1, "DSF construction interrupted.")
         return 0
 
@@ -1176,17 +1654,14 @@ def build_dsf(tile, download_queue):
     # get pools from elsewhere, we rebuild a dico
     # which tells the pool position in the dsf of a pool prior
     # to the stripping :
-
-    dico_new_dsf_pool = {}
-    new_idx_dsfpool = nbr_dsfpools_yet_in
-    for k in range(dsf_pool_nbr):
-        if dsf_pool_length[k] != 0:
-            dico_new_dsf_pool[k] = new_idx_dsfpool
-            new_idx_dsfpool += 1
+    new_dsf_pool = numpy.zeros(dsf_pool_nbr, dtype=numpy.uint16)
+    new_dsf_pool[dsf_pool_length != 0] = nbr_dsfpools_yet_in + numpy.arange(
+        numpy.count_nonzero(dsf_pool_length)
+    )
 
     # Commands atom
     # we first compute its size :
-    size_of_cmds_atom = 8 + len(bCMDS)
+    size_of_cmds_atom = 8 + len(atoms["CMDS"])
     for terrain_idx in textured_tris:
         if len(textured_tris[terrain_idx]) == 0:
             continue
@@ -1205,153 +1680,52 @@ def build_dsf(tile, download_queue):
     UI.vprint(
         2, "     Size of CMDS atom : " + str(size_of_cmds_atom) + " bytes."
     )
-    f.write(b"SDMC")  # CMDS header
-    f.write(struct.pack("<I", size_of_cmds_atom))  # CMDS length
-    f.write(bCMDS)
+    writer.pack("<4sI", b"SDMC", size_of_cmds_atom)
+    writer.write(atoms["CMDS"])
     for terrain_idx in textured_tris:
         if len(textured_tris[terrain_idx]) == 0:
             continue
-        # print("terrain_idx = "+str(terrain_idx))
-        f.write(struct.pack("<B", 4))  # SET DEFINITION 16
-        f.write(struct.pack("<H", terrain_idx))  # TERRAIN INDEX
+        # SET DEFINITION 16, TERRAIN INDEX
+        writer.pack("<BH", 4, terrain_idx)
         flag = (
             1 if terrain_idx not in overlay_terrains else 2
         )  # physical or overlay
         lod = -1 if flag == 1 else tile.overlay_lod
         for idx_dsfpool in textured_tris[terrain_idx]:
+            tris = numpy.frombuffer(
+                textured_tris[terrain_idx][idx_dsfpool], dtype=numpy.uint16
+            )
             if idx_dsfpool != "cross-pool":
-                f.write(struct.pack("<B", 1))  # POOL SELECT
-                f.write(
-                    struct.pack("<H", dico_new_dsf_pool[idx_dsfpool])
-                )  # POOL INDEX
-
-                f.write(struct.pack("<B", 18))  # TERRAIN PATCH FLAGS AND LOD
-                f.write(struct.pack("<B", flag))  # FLAG
-                f.write(struct.pack("<f", 0))  # NEAR LOD
-                f.write(struct.pack("<f", lod))  # FAR LOD
-
-                blocks = floor(
-                    len(textured_tris[terrain_idx][idx_dsfpool]) / 255
-                )
-                for j in range(blocks):
-                    f.write(struct.pack("<B", 23))  # PATCH TRIANGLE
-                    f.write(struct.pack("<B", 255))  # COORDINATE COUNT
-
-                    for k in range(255):
-                        f.write(
-                            struct.pack(
-                                "<H",
-                                textured_tris[terrain_idx][idx_dsfpool][
-                                    255 * j + k
-                                ],
-                            )
-                        )  # COORDINATE IDX
-                remaining_tri_p = (
-                    len(textured_tris[terrain_idx][idx_dsfpool]) % 255
-                )
-                if remaining_tri_p != 0:
-                    f.write(struct.pack("<B", 23))  # PATCH TRIANGLE
-                    f.write(
-                        struct.pack("<B", remaining_tri_p)
-                    )  # COORDINATE COUNT
-                    for k in range(remaining_tri_p):
-                        f.write(
-                            struct.pack(
-                                "<H",
-                                textured_tris[terrain_idx][idx_dsfpool][
-                                    255 * blocks + k
-                                ],
-                            )
-                        )  # COORDINATE IDX
-            else:  # idx_dsfpool == 'cross-pool'
-                pool_idx_init = textured_tris[terrain_idx][idx_dsfpool][0]
-                f.write(struct.pack("<B", 1))  # POOL SELECT
-                f.write(
-                    struct.pack("<H", dico_new_dsf_pool[pool_idx_init])
-                )  # POOL INDEX
-                f.write(struct.pack("<B", 18))  # TERRAIN PATCH FLAGS AND LOD
-                f.write(struct.pack("<B", flag))  # FLAG
-                f.write(struct.pack("<f", 0))  # NEAR LOD
-                f.write(struct.pack("<f", lod))  # FAR LOD
-
-                blocks = floor(
-                    len(textured_tris[terrain_idx][idx_dsfpool]) / 510
-                )
-                for j in range(blocks):
-                    f.write(struct.pack("<B", 24))  # PATCH TRIANGLE CROSS-POOL
-                    f.write(struct.pack("<B", 255))  # COORDINATE COUNT
-                    for k in range(255):
-                        f.write(
-                            struct.pack(
-                                "<H",
-                                dico_new_dsf_pool[
-                                    textured_tris[terrain_idx][idx_dsfpool][
-                                        510 * j + 2 * k
-                                    ]
-                                ],
-                            )
-                        )  # POOL IDX
-                        f.write(
-                            struct.pack(
-                                "<H",
-                                textured_tris[terrain_idx][idx_dsfpool][
-                                    510 * j + 2 * k + 1
-                                ],
-                            )
-                        )  # POS_IN_POOL IDX
-                remaining_tri_p = int(
-                    (len(textured_tris[terrain_idx][idx_dsfpool]) % 510) / 2
-                )
-                if remaining_tri_p != 0:
-                    f.write(struct.pack("<B", 24))  # PATCH TRIANGLE CROSS-POOL
-                    f.write(
-                        struct.pack("<B", remaining_tri_p)
-                    )  # COORDINATE COUNT
-                    for k in range(remaining_tri_p):
-                        f.write(
-                            struct.pack(
-                                "<H",
-                                dico_new_dsf_pool[
-                                    textured_tris[terrain_idx][idx_dsfpool][
-                                        510 * blocks + 2 * k
-                                    ]
-                                ],
-                            )
-                        )  # POOL IDX
-                        f.write(
-                            struct.pack(
-                                "<H",
-                                textured_tris[terrain_idx][idx_dsfpool][
-                                    510 * blocks + 2 * k + 1
-                                ],
-                            )
-                        )  # POS_IN_PO0L IDX
+                pool_idx = idx_dsfpool
+            else:
+                pool_idx = tris[0]
+            # POOL SELECT, POOL INDEX, TERRAIN PATCH FLAGS AND LOD, FLAG,
+            # NEAR LOD, FAR LOD
+            writer.pack(
+                "<BHBBff", 1, new_dsf_pool[pool_idx], 18, flag, 0, lod
+            )
+            if idx_dsfpool != "cross-pool":
+                writer.patch_triangles(23, tris, 1)
+            else:
+                # (POOL IDX, POS_IN_POOL IDX) coordinates
+                tris = tris.copy()
+                tris[0::2] = new_dsf_pool[tris[0::2]]
+                writer.patch_triangles(24, tris, 2)
 
     # DEMS atom
-    if bDEMS != b"":
-        f.write(b"SMED")
-        f.write(struct.pack("<I", 8 + len(bDEMS)))
-        f.write(bDEMS)
+    if atoms["DEMS"] != b"":
+        writer.atom(b"SMED", atoms["DEMS"])
 
     UI.progress_bar(1, 98)
     if UI.red_flag:
+        writer.abort()
         UI.vprint(1, "DSF construction interrupted.")
         return 0
 
-    f.close()
+    writer.close()
 
-    f = open(dsf_file_name + ".tmp", "rb")
-    data = f.read()
-    m = hashlib.md5()
-    m.update(data)
-    md5sum = m.digest()
-    f.close()
-    f = open(dsf_file_name + ".tmp", "ab")
-    f.write(md5sum)
-    f.close()
-    
     UI.progress_bar(1, 100)
-    
+
     size_of_dsf = (
         28
         + size_of_head_atom
@@ -1370,4 +1744,182 @@ def build_dsf(tile, download_queue):
     return 1
 
 
+################################################################################
+
+################################################################################
+def build_dsf(tile, download_queue):
+
+    
+    dico_customzl = zone_list_to_ortho_dico(tile)
+
+    # 1 Read mesh file
+    UI.vprint(1, "-> Reading mesh file")
+    mesh_filename = FNAMES.mesh_file(tile.build_dir, tile.lat, tile.lon)
+    (mesh_version, nbr_nodes, node_coords, nbr_tris, tri_idx, tri_types) \
+            = MESH.read_mesh_file(mesh_filename)
+
+    # 2 Remap tri_types in (0,1,2)
+    has_water = 7 if (mesh_version >= 1.3) else 3
+    for i in range(nbr_tris):
+        t = tri_types[i] & has_water
+        t = t and (2 * (t > 1 or tile.use_masks_for_inland) or 1)
+        tri_types[i] = t
+
+    # 3 Recut water tris for XP12
+    UI.vprint(1, "-> Adapting water triangles to XP12 requirements")
+    (nbr_nodes, node_coords, node_types, node_is_coast, nbr_tris, tri_idx, 
+        tri_types) = BATHY.recut_water_tris(node_coords, tri_idx, tri_types)
+
+    # 4 Compute bathymetry depth ratio bounds based on masks
+    UI.vprint(1, "-> Computing bathymetry depth ratio bounds based on distance masks")
+    node_bathy = BATHY.compute_depth_ratio_bounds_from_masks(
+                            nbr_nodes, node_coords, node_types, tile)
+    
+    UI.vprint(1, "-> Computing point pools and texture requirements")
+    
+    # 5 Split the nodes into pools along a quadtree
+    if (tile.use_masks_for_inland):
+        quad_capacity = quad_capacity_low
+    else:
+        quad_capacity = quad_capacity_high
+    (pool_nbr, idx_node_to_idx_pool, node_icoords, pool_param) = build_pools(
+        tile, nbr_nodes, node_coords, quad_capacity
+    )
+    node_icoords = array.array("H", node_icoords)
+
+    
+    
+    ##########################
+    # we need more pools for textured nodes than for nodes : land, UV masked
+    # water, and XP water
+    dsf_pool_nbr = 3 * pool_nbr
+    if (tile.water_tech == "XP11 + bathy"):
+        # Land with ortho
+        dsf_pool_plane = 7 * numpy.ones(dsf_pool_nbr, "int")
+        # Masked ortho (UV1 = ortho, UV2 = border_tex (if aplicable))
+        dsf_pool_plane[pool_nbr : 2 * pool_nbr] = 9
+        # Regular XP water
+        dsf_pool_plane[2 * pool_nbr : 3 * pool_nbr] = 7
+    elif (tile.water_tech == "XP12"):
+        # Land with ortho
+        dsf_pool_plane = 7 * numpy.ones(dsf_pool_nbr, "int")
+        # Masked ortho : UV1 = fetch/depth UV2 = ortho)
+        #           or : UV1 = ortho, V2 = border_tex
+        #                for inland water with constant alpha
+        dsf_pool_plane[pool_nbr : 2 * pool_nbr] = 9
+        # Regular XP water
+        dsf_pool_plane[2 * pool_nbr : 3 * pool_nbr] = 7
+    ##########################
+
+    bPROP = b""
+    bTERT = b""
+    bOBJT = b""
+    bPOLY = b""
+    bNETW = b""
+    bDEMN = b""
+    bGEOD = b""
+    bDEMS = b""
+    bCMDS = b""
+
+    nbr_dsfpools_yet_in = 0
+    terrains = Terrains(tile, download_queue)
+    mask_stats = dict(MASK.mask_cache_stats)
+
+    if texturing_engine == "numpy":
+        texture_engine = texture_triangles_numpy
+    else:
+        texture_engine = texture_triangles
+    result = texture_engine(
+        tile,
+        terrains,
+        dico_customzl,
+        nbr_tris,
+        tri_idx,
+        tri_types,
+        node_coords,
+        node_icoords,
+        idx_node_to_idx_pool,
+        pool_nbr,
+        node_is_coast,
+        node_bathy,
+    )
+    if result is None:
+        UI.vprint(1, "DSF construction interrupted.")
+        return 0
+    (dsf_pools, dsf_pool_length, len_textured_nodes, total_cross_pool) = result
+    textured_tris = terrains.tris
+    overlay_terrains = terrains.overlays
+    bTERT = terrains.bTERT
+    
+    download_queue.put("quit")
+
+    UI.vprint(1, "-> Encoding of the DSF file")
+    UI.vprint(1, "     Final nbr of nodes: " + str(len_textured_nodes))
+    UI.vprint(
+        2,
+        "     Masks decoded: "
+        + str(MASK.mask_cache_stats["decodes"] - mask_stats["decodes"])
+        + ", read from cache: "
+        + str(MASK.mask_cache_stats["hits"] - mask_stats["hits"]),
+    )
+    UI.vprint(2, "     Final nbr of cross pool tris: " + str(total_cross_pool))
+
+    dsf_file_name = os.path.join(
+        tile.build_dir,
+        "Earth nav data",
+        FNAMES.long_latlon(tile.lat, tile.lon) + ".dsf",
+    )
+    
+    if os.path.exists(dsf_file_name):
+        os.replace(dsf_file_name, dsf_file_name + ".bak")
+
+    # Note: present code should always choose the first branch.
+    if bPROP == b"":
+        bPROP = bytes(
+            "sim/west\0"
+            + str(tile.lon)
+            + "\0"
+            + "sim/east\0"
+            + str(tile.lon + 1)
+            + "\0"
+            + "sim/south\0"
+            + str(tile.lat)
+            + "\0"
+            + "sim/north\0"
+            + str(tile.lat + 1)
+            + "\0"
+            + "sim/creation_agent\0"
+            + "Ortho4XP\0",
+            "ascii",
+        )
+    else:
+        bPROP += b"sim/creation_agent\0Patched by Ortho4XP\0"
+
+    # Transfer DEM and bathymetry raster from Global Scenery tiles
+    (bDEMN, bDEMS) = extract_elevation_and_bathymetry_data(tile.lat, tile.lon)
+
+    return write_dsf(
+        dsf_file_name,
+        tile,
+        {
+            "PROP": bPROP,
+            "TERT": bTERT,
+            "OBJT": bOBJT,
+            "POLY": bPOLY,
+            "NETW": bNETW,
+            "DEMN": bDEMN,
+            "GEOD": bGEOD,
+            "DEMS": bDEMS,
+            "CMDS": bCMDS,
+        },
+        dsf_pools,
+        dsf_pool_length,
+        dsf_pool_plane,
+        pool_param,
+        textured_tris,
+        overlay_terrains,
+        nbr_dsfpools_yet_in,
+    )
+
+
 ##############################################################################
@@ -29,6 +29,7 @@ Patch_dir = resource_path("Patches")
 Utils_dir = resource_path("Utils")
 Tile_dir = resource_path("Tiles")
 Tmp_dir = resource_path("tmp")
+Cache_dir = resource_path("Cache")
 Overlay_dir = resource_path("yOrtho4XP_Overlays")
 
 ##############################################################################
@@ -385,6 +386,14 @@ def jpeg_file_name_from_attributes(
     return file_name
 
 
+##############################################################################
+
+##############################################################################
+def failed_cells_file(jpeg_file_path):
+    # sub-tiles of an orthophoto which could not be obtained, next to it
+    return jpeg_file_path[:-4] + ".failed"
+
+
 ##############################################################################
 
 ##############################################################################
@@ -775,6 +775,7 @@ class Ortho4XP_GUI(tk.Tk):
         self.after_cancel(self.callback_pgrb)
         self.after_cancel(self.callback_console)
         sys.stdout = self.stdout_orig
+        TILE.shutdown()
         self.destroy()
 
 ################################################################################
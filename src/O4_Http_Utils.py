@@ -0,0 +1,428 @@
+import contextlib
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+import O4_UI_Utils as UI
+
+# Connection pools are shared by the whole process and kept alive across
+# textures and tiles: one requests.Session per provider (or DEM source), with
+# as many keep-alive connections per host as the provider has download
+# threads. Broken connections are discarded by urllib3 itself when a request
+# fails on them, the other ones in the pool stay open.
+# Each provider also has a rate limiter, shared by all the textures (and both
+# download engines) downloading from it at once. It caps the number of
+# requests in flight, starting from max_threads, and once the provider has
+# shown signs of throttling the number of requests per second as well. Both
+# limits follow AIMD : they grow a little with each round trip of good
+# answers (up to the caps of the provider, max_requests and max_rps), and are
+# halved on 429s, 5xx, connection failures or latencies far above the usual
+# ones. Retry-After headers are honoured.
+# Finally, requests for the same URL issued while one is already in flight
+# (overlapping textures of combined providers, capped max_zl, airport ZL
+# upgrades) wait for it and share its answer instead of going out again,
+# provided they are for the same provider and send the same headers.
+
+default_pool_size = 16
+# number of distinct hosts (e.g. {switch:a,b,c} servers) kept per session
+pool_hosts = 10
+
+# AIMD parameters
+decrease_factor = 0.5
+latency_factor = 4
+min_rate = 0.5  # requests per second
+max_retry_after = 60  # seconds
+
+sessions = {}
+sessions_lock = threading.Lock()
+limiters = {}
+limiters_lock = threading.Lock()
+inflight = {}
+inflight_lock = threading.Lock()
+# since the start of the current tile build
+coalesce_stats = {"requests": 0, "coalesced": 0}
+
+
+################################################################################
+class RateLimiter:
+    """Token bucket and in-flight window of one provider, AIMD driven."""
+
+    def __init__(self, code, window, max_window, rate=None):
+        self.code = code
+        self.max_window = max(1, max_window)
+        self.window = float(min(max(1, window), self.max_window))
+        # requests per second, None until the provider throttles us, never
+        # above max_rate when the provider sets one
+        self.rate = rate
+        self.max_rate = rate
+        self.tokens = 1.0
+        self.refilled = time.monotonic()
+        self.not_before = 0
+        self.in_flight = 0
+        self.min_latency = None
+        self.latency = None
+        self.last_decrease = 0
+        self.last_increase = 0
+        self.stats = {"requests": 0, "throttled": 0, "decreases": 0}
+        self.condition = threading.Condition()
+        self.async_waiters = []
+
+    def try_acquire(self):
+        # 0 when a request may go now, otherwise the time to wait in seconds
+        # (None : until a request in flight is done)
+        with self.condition:
+            now = time.monotonic()
+            if now < self.not_before:
+                return self.not_before - now
+            if self.in_flight >= int(self.window):
+                return None
+            if self.rate is not None:
+                self.tokens = min(
+                    max(1.0, self.rate),
+                    self.tokens + (now - self.refilled) * self.rate,
+                )
+                self.refilled = now
+                if self.tokens < 1:
+                    return (1 - self.tokens) / self.rate
+                self.tokens -= 1
+            self.in_flight += 1
+            self.stats["requests"] += 1
+            return 0
+
+    def acquire(self):
+        while True:
+            wait = self.try_acquire()
+            if wait == 0:
+                return
+            with self.condition:
+                self.condition.wait(0.5 if wait is None else min(wait, 0.5))
+
+    def release(self, status, latency, retry_after=None):
+        # status is the HTTP status code, None for a connection failure
+        with self.condition:
+            now = time.monotonic()
+            self.in_flight -= 1
+            if status == 429 or status == 503:
+                self.stats["throttled"] += 1
+                try:
+                    delay = min(max_retry_after, float(retry_after))
+                    self.not_before = max(self.not_before, now + delay)
+                except (TypeError, ValueError):
+                    pass
+                self.decrease(now, latency)
+            elif status is None or status >= 500:
+                self.decrease(now, latency)
+            else:
+                self.observe_latency(latency, now)
+                self.window = min(
+                    self.max_window, self.window + 1 / self.window
+                )
+                self.increase_rate(now)
+            self.condition.notify_all()
+            waiters, self.async_waiters = self.async_waiters, []
+        for (loop, future) in waiters:
+            loop.call_soon_threadsafe(wake_up, future)
+
+    def observe_latency(self, latency, now):
+        if self.min_latency is None or latency < self.min_latency:
+            self.min_latency = latency
+        self.latency = (
+            latency
+            if self.latency is None
+            else 0.9 * self.latency + 0.1 * latency
+        )
+        if (
+            self.latency > 1
+            and self.latency > latency_factor * self.min_latency
+        ):
+            self.decrease(now, latency)
+            # start again from the new latency level
+            self.latency = self.min_latency = latency
+
+    def increase_rate(self, now):
+        # once per round trip at most, as the decreases
+        if self.rate is None or (
+            now - self.last_increase < max(0.5, self.latency or 0)
+        ):
+            return
+        self.last_increase = now
+        self.rate += 1
+        if self.max_rate is not None:
+            self.rate = min(self.rate, self.max_rate)
+
+    def decrease(self, now, latency):
+        # once per round trip at most, many requests in flight fail together
+        if now - self.last_decrease < max(0.5, self.latency or 0):
+            return
+        self.last_decrease = now
+        self.stats["decreases"] += 1
+        if self.rate is None:
+            # start from what the window was letting through (Little's law)
+            self.rate = self.window / max(0.01, self.latency or latency)
+        self.window = max(1.0, self.window * decrease_factor)
+        self.rate = max(min_rate, self.rate * decrease_factor)
+        self.tokens = min(self.tokens, 1.0)
+
+    def add_async_waiter(self, loop, future):
+        with self.condition:
+            self.async_waiters.append((loop, future))
+
+
+################################################################################
+
+################################################################################
+def wake_up(future):
+    if not future.done():
+        future.set_result(None)
+
+
+################################################################################
+
+################################################################################
+def get_limiter(provider, max_window=None):
+    # provider is either a provider dict or a plain code (DEM sources, ...),
+    # max_window is the cap of the caller if above max_threads (asyncio).
+    # The limiter keeps the widest cap it was asked for, the threads engine
+    # never has more requests in flight than it has threads anyway.
+    (code, size) = session_key_and_size(provider)
+    try:
+        max_window = int(provider["max_requests"])
+    except:
+        max_window = max_window or size
+    with limiters_lock:
+        if code not in limiters:
+            rate = None
+            try:
+                rate = float(provider["max_rps"])
+            except:
+                pass
+            limiters[code] = RateLimiter(code, size, max_window, rate)
+        limiter = limiters[code]
+    with limiter.condition:
+        limiter.max_window = max(limiter.max_window, max_window)
+    return limiter
+
+
+################################################################################
+
+################################################################################
+@contextlib.contextmanager
+def limited(limiter):
+    # The caller fills answer with the status code and the Retry-After
+    # header of what it received, a missing status is a connection failure.
+    answer = {"status": None, "retry_after": None}
+    if limiter is None:
+        yield answer
+        return
+    limiter.acquire()
+    start = time.monotonic()
+    try:
+        yield answer
+    finally:
+        limiter.release(
+            answer["status"], time.monotonic() - start, answer["retry_after"]
+        )
+
+
+################################################################################
+
+################################################################################
+def count_request(coalesced):
+    with inflight_lock:
+        coalesce_stats["requests"] += 1
+        coalesce_stats["coalesced"] += coalesced
+
+
+################################################################################
+
+################################################################################
+def reset_coalesce_stats():
+    with inflight_lock:
+        coalesce_stats["requests"] = coalesce_stats["coalesced"] = 0
+
+
+################################################################################
+
+################################################################################
+def request_key(url, code, request_headers):
+    # headers may hold a Referer, an API key or cookies, the answer to one
+    # provider is not the answer to another one with the same URL
+    return (url, code, frozenset((request_headers or {}).items()))
+
+
+################################################################################
+
+################################################################################
+def coalesced(key, fetch):
+    # Single flight : the first caller for key runs fetch, those arriving
+    # while it runs wait for its result. Returns (result, shared), shared
+    # being True for the waiters.
+    with inflight_lock:
+        coalesce_stats["requests"] += 1
+        entry = inflight.get(key)
+        if entry is None:
+            entry = inflight[key] = {"done": threading.Event(), "result": None}
+            leader = True
+        else:
+            coalesce_stats["coalesced"] += 1
+            leader = False
+    if not leader:
+        entry["done"].wait()
+        if entry["result"] is not None:
+            return (entry["result"], True)
+        # the first caller failed with an exception, try on our own
+        return (fetch(), False)
+    try:
+        entry["result"] = fetch()
+    finally:
+        with inflight_lock:
+            inflight.pop(key, None)
+        entry["done"].set()
+    return (entry["result"], False)
+
+
+################################################################################
+
+################################################################################
+def session_key_and_size(provider):
+    if isinstance(provider, dict):
+        code = provider["code"]
+        try:
+            size = int(provider["max_threads"])
+        except:
+            size = default_pool_size
+    else:
+        code = str(provider)
+        size = default_pool_size
+    return (code, max(1, size))
+
+
+################################################################################
+
+################################################################################
+def get_session(provider):
+    # provider is either a provider dict or a plain code (DEM sources, ...)
+    (code, size) = session_key_and_size(provider)
+    with sessions_lock:
+        if code in sessions:
+            return sessions[code]
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_hosts, pool_maxsize=size, max_retries=0
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.limiter = get_limiter(provider)
+        session.code = code
+        sessions[code] = session
+        UI.vprint(
+            3, "Opened connection pool for", code, "with", size, "slots."
+        )
+        return session
+
+
+################################################################################
+
+################################################################################
+def session_limiter(http_session):
+    return getattr(http_session, "limiter", None)
+
+
+################################################################################
+
+################################################################################
+def connection_statistics(code=None):
+    # For each session, number of requests issued and of connections opened,
+    # their difference is the number of requests that reused a live
+    # connection (and thus saved the TCP and TLS handshakes).
+    stats = {}
+    with sessions_lock:
+        items = [
+            (key, session)
+            for (key, session) in sessions.items()
+            if code is None or key == code
+        ]
+    for (key, session) in items:
+        nbr_requests = nbr_connections = 0
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for pool_key in pools.keys():
+                pool = pools.get(pool_key)
+                if pool is None:
+                    continue
+                nbr_requests += pool.num_requests
+                nbr_connections += pool.num_connections
+        stats[key] = {
+            "requests": nbr_requests,
+            "connections": nbr_connections,
+            "reused": max(0, nbr_requests - nbr_connections),
+        }
+    return stats
+
+
+################################################################################
+
+################################################################################
+def print_statistics(min_verbosity=2):
+    with inflight_lock:
+        (nbr_requests, nbr_coalesced) = (
+            coalesce_stats["requests"],
+            coalesce_stats["coalesced"],
+        )
+    if nbr_coalesced:
+        UI.vprint(
+            min_verbosity,
+            "     Duplicate requests avoided :",
+            nbr_coalesced,
+            "of",
+            nbr_requests,
+            "tile requests.",
+        )
+    with limiters_lock:
+        items = sorted(limiters.items())
+    for (code, limiter) in items:
+        if not limiter.stats["throttled"] and not limiter.stats["decreases"]:
+            continue
+        UI.vprint(
+            min_verbosity,
+            "     Rate limiter for",
+            code,
+            ":",
+            limiter.stats["throttled"],
+            "throttled answers,",
+            limiter.stats["decreases"],
+            "slow downs, now",
+            int(limiter.window),
+            "requests in flight",
+            "at " + str(round(limiter.rate, 1)) + " per second."
+            if limiter.rate is not None
+            else "and no rate limit.",
+        )
+    for (code, stats) in sorted(connection_statistics().items()):
+        if not stats["requests"]:
+            continue
+        UI.vprint(
+            min_verbosity,
+            "     Connections for",
+            code,
+            ":",
+            stats["requests"],
+            "requests over",
+            stats["connections"],
+            "connections,",
+            stats["reused"],
+            "reused.",
+        )
+
+
+################################################################################
+
+################################################################################
+def close_sessions():
+    with sessions_lock:
+        for session in sessions.values():
+            try:
+                session.close()
+            except:
+                pass
+        sessions.clear()
@@ -1,4 +1,4 @@
-from O4_Parallel_Utils import parallel_execute
+from O4_Parallel_Utils import parallel_execute, worker_state
 import O4_Mask_Utils as MASK
 import O4_OSM_Utils as OSM
 import O4_Mesh_Utils as MESH
@@ -6,6 +6,10 @@ import O4_Vector_Utils as VECT
 import O4_File_Names as FNAMES
 import O4_Geo_Utils as GEO
 import O4_UI_Utils as UI
+import O4_Http_Utils as HTTP
+import O4_Async_Utils as AIO
+import O4_Cache_Utils as CACHE
+import O4_DDS_Utils as DDS
 import time
 import os
 import sys
@@ -14,6 +18,8 @@ import io
 import requests
 import queue
 import random
+import threading
+import collections
 from math import ceil, log, tan, pi
 import numpy
 from PIL import Image, ImageFilter, ImageEnhance, ImageOps
@@ -42,7 +48,17 @@ http_timeout = 10
 check_tms_response = False
 max_connect_retries = 10
 max_baddata_retries = 10
+download_engine = "threads"
+async_max_requests = 128
+async_decode_workers = 4
+dds_encoder = "nvcompress"
+derive_lower_zl = False
 incomplete_imgs = {}
+incomplete_imgs_lock = threading.Lock()
+# one lock per orthophoto file, so that textures built in parallel which
+# need the same (e.g. lower max_zl) orthophoto download it only once
+file_locks = {}
+file_locks_lock = threading.Lock()
 
 
 user_agent_generic = (
@@ -89,6 +105,7 @@ combined_providers_dict = {}
 local_combined_providers_dict = {}
 extents_dict = {"global": {"dir": None, "code": "global"}}
 color_filters_dict = {"none": []}
+compiled_color_filters = {}
 
 ################################################################################
 def initialize_extents_dict():
@@ -191,6 +208,9 @@ def initialize_color_filters_dict():
                 valid_color_filters = False
         if valid_color_filters:
             color_filters_dict[color_code] = color_filters
+            compiled_color_filters[color_code] = compile_color_filters(
+                color_filters
+            )
         else:
             print(
                 "Could not understand color filter ",
@@ -368,11 +388,16 @@ def initialize_providers_dict():
                             provider_code,
                         )
                         valid_provider = False
-                elif key == "max_threads":
+                elif key in ("max_threads", "max_requests"):
                     try:
                         provider[key] = int(value)
                     except:
                         pass
+                elif key == "max_rps":
+                    try:
+                        provider[key] = float(value)
+                    except:
+                        pass
                 elif key == "extent":
                     pass
                 elif key == "color_filters":
@@ -845,6 +870,123 @@ def read_tilematrixsets(file_name):
     return tilematrixsets
 
 
+################################################################################
+
+################################################################################
+# Decoded extent masks are kept in memory (least recently used first out,
+# within extent_cache_mb), together with two integral images counting their
+# non zero and their fully white pixels. Whether a bbox is not, fully or
+# partially covered is then four lookups, and the mask image itself is only
+# cropped and resized when it is partially covered.
+extent_cache = collections.OrderedDict()
+extent_cache_lock = threading.Lock()
+extent_cache_mb = 512
+extent_cache_stats = {"decoded": 0, "hits": 0}
+
+################################################################################
+def integral_image(bool_array):
+    (sizey, sizex) = bool_array.shape
+    sat = numpy.zeros((sizey + 1, sizex + 1), dtype=numpy.int32)
+    numpy.cumsum(
+        numpy.cumsum(bool_array, axis=0, dtype=numpy.int32),
+        axis=1,
+        out=sat[1:, 1:],
+    )
+    return sat
+
+
+################################################################################
+
+################################################################################
+def decoded_extent(extent_code):
+    file_name = os.path.join(
+        FNAMES.Extent_dir,
+        extents_dict[extent_code]["dir"],
+        extents_dict[extent_code]["code"] + ".png",
+    )
+    # Auto extents can be rebuilt in between two tiles
+    mtime = os.path.getmtime(file_name)
+    with extent_cache_lock:
+        extent = extent_cache.get(file_name)
+        if extent and extent["mtime"] == mtime:
+            extent_cache.move_to_end(file_name)
+            extent_cache_stats["hits"] += 1
+            return extent
+    mask_im = Image.open(file_name).convert("L")
+    mask_array = numpy.array(mask_im)
+    extent = {
+        "mtime": mtime,
+        "image": mask_im,
+        "nonzero": integral_image(mask_array > 0),
+        "full": integral_image(mask_array == 255),
+    }
+    extent["nbytes"] = (
+        mask_array.nbytes + extent["nonzero"].nbytes + extent["full"].nbytes
+    )
+    with extent_cache_lock:
+        extent_cache_stats["decoded"] += 1
+        extent_cache[file_name] = extent
+        extent_cache.move_to_end(file_name)
+        while len(extent_cache) > 1 and (
+            sum(x["nbytes"] for x in extent_cache.values())
+            > extent_cache_mb * 1024 ** 2
+        ):
+            extent_cache.popitem(last=False)
+    return extent
+
+
+################################################################################
+
+################################################################################
+def extent_coverage(extent, crop_box, negative):
+    # "none", "full" or "partial" for the (possibly inverted) crop of the
+    # extent mask over crop_box, pixels outside of the mask count as 0 just
+    # like with Image.crop.
+    (pxx0, pxy0, pxx1, pxy1) = crop_box
+    area = max(0, pxx1 - pxx0) * max(0, pxy1 - pxy0)
+    if not area:
+        return "none"
+    (sizex, sizey) = extent["image"].size
+    (ix0, ix1) = (min(max(pxx0, 0), sizex), min(max(pxx1, 0), sizex))
+    (iy0, iy1) = (min(max(pxy0, 0), sizey), min(max(pxy1, 0), sizey))
+    inside = (ix1 - ix0) * (iy1 - iy0)
+
+    def count(sat):
+        return int(
+            sat[iy1, ix1] - sat[iy0, ix1] - sat[iy1, ix0] + sat[iy0, ix0]
+        )
+
+    nonzero = count(extent["nonzero"])
+    full = count(extent["full"])
+    if negative:
+        (nonzero, full) = (
+            inside - full + area - inside,
+            inside - nonzero + area - inside,
+        )
+    if not nonzero:
+        return "none"
+    if full == area:
+        return "full"
+    return "partial"
+
+
+################################################################################
+
+################################################################################
+def extent_mask(
+    extent, crop_box, negative, coverage, mask_size, is_sharp_resize
+):
+    if coverage == "full":
+        return Image.new("L", mask_size, "white")
+    mask_im = extent["image"].crop(crop_box)
+    if negative:
+        mask_im = ImageOps.invert(mask_im)
+    if is_sharp_resize:
+        return mask_im.resize(mask_size)
+    else:
+        return mask_im.resize(mask_size, Image.BICUBIC)
+
+
 ################################################################################
 
 ################################################################################
@@ -887,14 +1029,8 @@ def has_data(
         if x0 > xmax or x1 < xmin or y0 < ymin or y1 > ymax:
             return negative
         if (not is_mask_layer) or (x1 - x0) == 1:
-            mask_im = Image.open(
-                os.path.join(
-                    FNAMES.Extent_dir,
-                    extents_dict[extent_code]["dir"],
-                    extents_dict[extent_code]["code"] + ".png",
-                )
-            ).convert("L")
-            (sizex, sizey) = mask_im.size
+            extent = decoded_extent(extent_code)
+            (sizex, sizey) = extent["image"].size
             pxx0 = int((x0 - xmin) / (xmax - xmin) * sizex)
             pxx1 = int((x1 - xmin) / (xmax - xmin) * sizex)
             pxy0 = int((ymax - y0) / (ymax - ymin) * sizey)
@@ -904,17 +1040,15 @@ def has_data(
                 pxx1 = min(sizex, pxx1)
                 pxy0 = max(-1, pxy0)
                 pxy1 = min(sizey, pxy1)
-            mask_im = mask_im.crop((pxx0, pxy0, pxx1, pxy1))
-            if negative:
-                mask_im = ImageOps.invert(mask_im)
-            if not mask_im.getbbox():
+            crop_box = (pxx0, pxy0, pxx1, pxy1)
+            coverage = extent_coverage(extent, crop_box, negative)
+            if coverage == "none":
                 return False
             if not return_mask:
                 return True
-            if is_sharp_resize:
-                return mask_im.resize(mask_size)
-            else:
-                return mask_im.resize(mask_size, Image.BICUBIC)
+            return extent_mask(
+                extent, crop_box, negative, coverage, mask_size, is_sharp_resize
+            )
         else:
             # following code only visited when is_mask_layer is True
             # in which case it is passed as (lat,lon,mask_zl)
@@ -937,27 +1071,24 @@ def has_data(
                 return False
             # build extent mask_im
             if extent_code != "global":
-                mask_im = Image.open(
-                    os.path.join(
-                        FNAMES.Extent_dir,
-                        extents_dict[extent_code]["dir"],
-                        extents_dict[extent_code]["code"] + ".png",
-                    )
-                ).convert("L")
-                (sizex, sizey) = mask_im.size
+                extent = decoded_extent(extent_code)
+                (sizex, sizey) = extent["image"].size
                 pxx0 = int((x0 - xmin) / (xmax - xmin) * sizex)
                 pxx1 = int((x1 - xmin) / (xmax - xmin) * sizex)
                 pxy0 = int((ymax - y0) / (ymax - ymin) * sizey)
                 pxy1 = int((ymax - y1) / (ymax - ymin) * sizey)
-                mask_im = mask_im.crop((pxx0, pxy0, pxx1, pxy1))
-                if negative:
-                    mask_im = ImageOps.invert(mask_im)
-                if not mask_im.getbbox():
+                crop_box = (pxx0, pxy0, pxx1, pxy1)
+                coverage = extent_coverage(extent, crop_box, negative)
+                if coverage == "none":
                     return False
-                if is_sharp_resize:
-                    mask_im = mask_im.resize(mask_size)
-                else:
-                    mask_im = mask_im.resize(mask_size, Image.BICUBIC)
+                mask_im = extent_mask(
+                    extent,
+                    crop_box,
+                    negative,
+                    coverage,
+                    mask_size,
+                    is_sharp_resize,
+                )
             else:
                 mask_im = Image.new("L", mask_size, "white")
             # build sea mask_im2
@@ -1002,7 +1133,46 @@ def has_data(
 ################################################################################
 
 ################################################################################
-def http_request_to_image(width, height, url, request_headers, http_session):
+def is_no_data_answer(url, headers):
+    # Some providers answer with a small placeholder image rather than a 404
+    content_length = headers.get("Content-Length")
+    return (content_length == "1033" and "virtualearth" in url) or (
+        content_length == "2521" and "arcgisonline" in url
+    )
+
+
+################################################################################
+
+################################################################################
+def http_request_to_image(
+    width, height, url, request_headers, http_session, cache_key=None
+):
+    # Overlapping textures being built at once may ask for the same tile,
+    # only the first request goes out and the others share its answer.
+    ((success, data), shared) = HTTP.coalesced(
+        HTTP.request_key(
+            url, getattr(http_session, "code", None), request_headers
+        ),
+        lambda: http_request_to_image_and_content(
+            url, request_headers, http_session, cache_key
+        ),
+    )
+    if not success:
+        return (success, data)
+    (small_image, content) = data
+    if shared:
+        # an image of its own for each caller, they may decode it at
+        # different scales
+        small_image = Image.open(io.BytesIO(content))
+    return (1, small_image)
+
+
+################################################################################
+
+################################################################################
+def http_request_to_image_and_content(
+    url, request_headers, http_session, cache_key=None
+):
     UI.vprint(
         3, "HTTP request issued :", url, "\nRequest headers :", request_headers
     )
@@ -1011,34 +1181,32 @@ def http_request_to_image(width, height, url, request_headers, http_session):
     r = False
     while True:
         try:
-            if request_headers:
-                r = http_session.get(
-                    url, timeout=http_timeout, headers=request_headers
-                )
-            else:
-                r = http_session.get(url, timeout=http_timeout)
+            with HTTP.limited(HTTP.session_limiter(http_session)) as answer:
+                if request_headers:
+                    r = http_session.get(
+                        url, timeout=http_timeout, headers=request_headers
+                    )
+                else:
+                    r = http_session.get(url, timeout=http_timeout)
+                answer["status"] = r.status_code
+                answer["retry_after"] = r.headers.get("Retry-After")
             status_code = str(r)
             # Bing white image with small camera or Arcgis no data yet =>
             # try to downsample to lower ZL
-            if ("Content-Length" in r.headers) and int(
-                r.headers["Content-Length"]
-            ) <= 2521:
-                if (r.headers["Content-Length"] == "1033") and (
-                    "virtualearth" in url
-                ):
-                    UI.vprint(3, url, r.headers)
-                    return (0, "[404]")
-                if (r.headers["Content-Length"] == "2521") and (
-                    "arcgisonline" in url
-                ):
-                    UI.vprint(3, url, r.headers)
-                    return (0, "[404]")
+            if is_no_data_answer(url, r.headers):
+                UI.vprint(3, url, r.headers)
+                return (0, "[404]")
             if ("[200]" in status_code) and (
                 "image" in r.headers["Content-Type"]
             ):
                 try:
-                    small_image = Image.open(io.BytesIO(r.content))
-                    return (1, small_image)
+                    if cache_key:
+                        # only cache what actually decodes
+                        small_image = checked_image(r.content)
+                        CACHE.put(*cache_key, r.content)
+                    else:
+                        small_image = Image.open(io.BytesIO(r.content))
+                    return (1, (small_image, r.content))
                 except:
                     UI.vprint(
                         2,
@@ -1060,6 +1228,10 @@ def http_request_to_image(width, height, url, request_headers, http_session):
                 UI.vprint(2, "Server said 'Forbidden' ! (IP banned?)")
                 UI.vprint(3, url, r.headers, r.content)
                 break
+            elif "[429]" in status_code:
+                # the rate limiter holds the next request as long as asked
+                UI.vprint(2, "Server said 'Too Many Requests', slowing down.")
+                UI.vprint(3, url, r.headers)
             elif "[5" in status_code:
                 UI.vprint(2, "Server said 'Internal Error'.", status_code)
                 if not check_tms_response:
@@ -1078,8 +1250,8 @@ def http_request_to_image(width, height, url, request_headers, http_session):
             UI.vprint(3, e)
             if not check_tms_response:
                 break
-            # trying a new session ?
-            http_session = requests.Session()
+            # the session is kept, urllib3 has already dropped the broken
+            # connection from its pool and will open a fresh one.
             time.sleep(2)
             if UI.red_flag:
                 return (0, "Stopped")
@@ -1149,77 +1321,203 @@ def get_wms_image(bbox, width, height, provider, http_session):
 ################################################################################
 
 ################################################################################
-def get_wmts_image(tilematrix, til_x, til_y, provider, http_session):
+def checked_image(data):
+    # The image held in data, once checked that it decodes. A JPEG is
+    # checked at its smallest DCT scale on a handle of its own, the one
+    # returned is still to be decoded, at the scale reduced_image asks for.
+    small_image = Image.open(io.BytesIO(data))
+    if small_image.format != "JPEG":
+        small_image.load()
+        return small_image
+    check_image = Image.open(io.BytesIO(data))
+    check_image.draft(check_image.mode, (1, 1))
+    check_image.load()
+    return small_image
+
+
+################################################################################
+
+################################################################################
+def cached_image(cache_key, decode=False):
+    # decode is for the callers which share the image between threads
+    data = CACHE.get(*cache_key)
+    if data is None:
+        return (0, None)
+    try:
+        if decode:
+            small_image = Image.open(io.BytesIO(data))
+            small_image.load()
+        else:
+            small_image = checked_image(data)
+        return (1, small_image)
+    except:
+        UI.vprint(2, "Corrupted tile in the tile cache, downloading it again.")
+        return (0, None)
+
+
+################################################################################
+
+################################################################################
+def wmts_request(tilematrix, til_x, til_y, provider):
+    # url and request headers for one tile of a tms/wmts provider
+    request_headers = None
+    if has_URL and provider["code"] in URL.custom_url_list:
+        (url, request_headers) = URL.custom_tms_request(
+            tilematrix, til_x, til_y, provider
+        )
+    elif provider["request_type"] == "tms":  # TMS
+        url = provider["url_template"].replace("{zoom}", str(tilematrix))
+        url = url.replace("{x}", str(til_x))
+        url = url.replace("{y}", str(til_y))
+        url = url.replace("{|y|}", str(abs(til_y) - 1))
+        url = url.replace("{-y}", str(2 ** tilematrix - 1 - til_y))
+        url = url.replace(
+            "{quadkey}", GEO.gtile_to_quadkey(til_x, til_y, tilematrix)
+        )
+        url = url.replace(
+            "{xcenter}",
+            str(
+                (til_x + 0.5)
+                * provider["resolutions"][tilematrix]
+                * provider["tile_size"]
+                + provider["top_left_corner"][tilematrix][0]
+            ),
+        )
+        url = url.replace(
+            "{ycenter}",
+            str(
+                -1
+                * (til_y + 0.5)
+                * provider["resolutions"][tilematrix]
+                * provider["tile_size"]
+                + provider["top_left_corner"][tilematrix][1]
+            ),
+        )
+        url = url.replace(
+            "{size}",
+            str(
+                int(
+                    provider["resolutions"][tilematrix]
+                    * provider["tile_size"]
+                )
+            ),
+        )
+        if "{switch:" in url:
+            (url_0, tmp) = url.split("{switch:")
+            (tmp, url_2) = tmp.split("}")
+            server_list = tmp.split(",")
+            url_1 = random.choice(server_list).strip()
+            url = url_0 + url_1 + url_2
+    elif provider["request_type"] == "wmts":  # WMTS
+        url = (
+            provider["url_prefix"]
+            + "&SERVICE=WMTS&VERSION=1.0.0&REQUEST=GetTile&LAYER="
+            + provider["layers"]
+            + "&STYLE=&FORMAT=image/"
+            + provider["image_type"]
+            + "&TILEMATRIXSET="
+            + provider["tilematrixset"]["identifier"]
+            + "&TILEMATRIX="
+            + provider["tilematrixset"]["tilematrices"][tilematrix][
+                "identifier"
+            ]
+            + "&TILEROW="
+            + str(til_y)
+            + "&TILECOL="
+            + str(til_x)
+        )
+    if not request_headers:
+        if "fake_headers" in provider:
+            request_headers = provider["fake_headers"]
+        else:
+            request_headers = request_headers_generic
+    return (url, request_headers)
+
+
+################################################################################
+
+################################################################################
+def upsample_part(image, til_x_orig, til_y_orig, down_sample, width, height):
+    # part of a lower ZL tile covering the requested tile, resized to the
+    # size of the latter
+    til_x = til_x_orig // 2 ** down_sample
+    til_y = til_y_orig // 2 ** down_sample
+    x0 = (til_x_orig - 2 ** down_sample * til_x) * width // (2 ** down_sample)
+    y0 = (til_y_orig - 2 ** down_sample * til_y) * height // (2 ** down_sample)
+    x1 = x0 + width // (2 ** down_sample)
+    y1 = y0 + height // (2 ** down_sample)
+    return image.crop((x0, y0, x1, y1)).resize((width, height), Image.BICUBIC)
+
+
+################################################################################
+
+################################################################################
+def fetch_wmts_tile(tilematrix, til_x, til_y, provider, http_session):
+    width = height = provider["tile_size"]
+    cache_key = (provider["code"], tilematrix, til_x, til_y)
+    (success, data) = cached_image(cache_key)
+    if not success:
+        (url, request_headers) = wmts_request(
+            tilematrix, til_x, til_y, provider
+        )
+        (success, data) = http_request_to_image(
+            width, height, url, request_headers, http_session, cache_key
+        )
+    return (success, data)
+
+
+################################################################################
+
+################################################################################
+def memoized_parent(parents, key, fetch):
+    # Single flight memo of the lower ZL tiles used in place of missing ones :
+    # the first part of a texture asking for a parent tile fetches it, the
+    # siblings asking at the same time wait for that answer, and later ones
+    # reuse it. Not found answers are kept too, other failures are not kept
+    # for later callers.
+    with parents["lock"]:
+        entry = parents["tiles"].get(key)
+        fetcher = entry is None
+        if fetcher:
+            entry = parents["tiles"][key] = {"done": threading.Event()}
+    if not fetcher:
+        entry["done"].wait()
+        return entry["result"]
+    try:
+        entry["result"] = fetch()
+        if entry["result"][0]:
+            # decoded once here, parts are then cut from it concurrently
+            entry["result"][1].load()
+    except:
+        entry["result"] = (0, "Connection failure")
+    (success, data) = entry["result"]
+    if not success and "[404]" not in data:
+        with parents["lock"]:
+            parents["tiles"].pop(key, None)
+    entry["done"].set()
+    return entry["result"]
+
+
+################################################################################
+
+################################################################################
+def new_parents_memo():
+    return {"lock": threading.Lock(), "tiles": {}}
+
+
+################################################################################
+
+################################################################################
+def get_wmts_image(
+    tilematrix, til_x, til_y, provider, http_session, parents=None
+):
+    # parents : see memoized_parent, shared by the parts of one texture
     til_x_orig, til_y_orig = til_x, til_y
     down_sample = 0
     while True:
-        request_headers = None
-        if has_URL and provider["code"] in URL.custom_url_list:
-            (url, request_headers) = URL.custom_tms_request(
-                tilematrix, til_x, til_y, provider
-            )
-        elif provider["request_type"] == "tms":  # TMS
-            url = provider["url_template"].replace("{zoom}", str(tilematrix))
-            url = url.replace("{x}", str(til_x))
-            url = url.replace("{y}", str(til_y))
-            url = url.replace("{|y|}", str(abs(til_y) - 1))
-            url = url.replace("{-y}", str(2 ** tilematrix - 1 - til_y))
-            url = url.replace(
-                "{quadkey}", GEO.gtile_to_quadkey(til_x, til_y, tilematrix)
-            )
-            url = url.replace(
-                "{xcenter}",
-                str(
-                    (til_x + 0.5)
-                    * provider["resolutions"][tilematrix]
-                    * provider["tile_size"]
-                    + provider["top_left_corner"][tilematrix][0]
-                ),
-            )
-            url = url.replace(
-                "{ycenter}",
-                str(
-                    -1
-                    * (til_y + 0.5)
-                    * provider["resolutions"][tilematrix]
-                    * provider["tile_size"]
-                    + provider["top_left_corner"][tilematrix][1]
-                ),
-            )
-            url = url.replace(
-                "{size}",
-                str(
-                    int(
-                        provider["resolutions"][tilematrix]
-                        * provider["tile_size"]
-                    )
-                ),
-            )
-            if "{switch:" in url:
-                (url_0, tmp) = url.split("{switch:")
-                (tmp, url_2) = tmp.split("}")
-                server_list = tmp.split(",")
-                url_1 = random.choice(server_list).strip()
-                url = url_0 + url_1 + url_2
-        elif provider["request_type"] == "wmts":  # WMTS
-            url = (
-                provider["url_prefix"]
-                + "&SERVICE=WMTS&VERSION=1.0.0&REQUEST=GetTile&LAYER="
-                + provider["layers"]
-                + "&STYLE=&FORMAT=image/"
-                + provider["image_type"]
-                + "&TILEMATRIXSET="
-                + provider["tilematrixset"]["identifier"]
-                + "&TILEMATRIX="
-                + provider["tilematrixset"]["tilematrices"][tilematrix][
-                    "identifier"
-                ]
-                + "&TILEROW="
-                + str(til_y)
-                + "&TILECOL="
-                + str(til_x)
-            )
-        elif provider["request_type"] == "local_tms":  # LOCAL TMS
+        if provider["request_type"] == "local_tms" and not (
+            has_URL and provider["code"] in URL.custom_url_list
+        ):  # LOCAL TMS
             # ! Too much specific, needs to be changed by a
             # x,y-> file_name lambda fct
             url_local = provider["url_template"].replace(
@@ -1243,34 +1541,26 @@ def get_wmts_image(tilematrix, til_x, til_y, provider, http_session):
                         "white",
                     ),
                 )
-        if not request_headers:
-            if "fake_headers" in provider:
-                request_headers = provider["fake_headers"]
-            else:
-                request_headers = request_headers_generic
         width = height = provider["tile_size"]
-        (success, data) = http_request_to_image(
-            width, height, url, request_headers, http_session
-        )
+        if down_sample and parents is not None:
+            (success, data) = memoized_parent(
+                parents,
+                (tilematrix, til_x, til_y),
+                lambda: fetch_wmts_tile(
+                    tilematrix, til_x, til_y, provider, http_session
+                ),
+            )
+        else:
+            (success, data) = fetch_wmts_tile(
+                tilematrix, til_x, til_y, provider, http_session
+            )
         if success and not down_sample:
             return (success, data)
         elif success and down_sample:
-            x0 = (
-                (til_x_orig - 2 ** down_sample * til_x)
-                * width
-                // (2 ** down_sample)
-            )
-            y0 = (
-                (til_y_orig - 2 ** down_sample * til_y)
-                * height
-                // (2 ** down_sample)
-            )
-            x1 = x0 + width // (2 ** down_sample)
-            y1 = y0 + height // (2 ** down_sample)
             return (
                 success,
-                data.crop((x0, y0, x1, y1)).resize(
-                    (width, height), Image.BICUBIC
+                upsample_part(
+                    data, til_x_orig, til_y_orig, down_sample, width, height
                 ),
             )
         elif "[404]" in data:
@@ -1288,6 +1578,25 @@ def get_wmts_image(tilematrix, til_x, til_y, provider, http_session):
             return (0, Image.new("RGB", (width, height), "white"))
 
 
+################################################################################
+
+################################################################################
+def reduced_image(small_image, size):
+    # JPEGs are first decoded at the DCT scale (1/2, 1/4 or 1/8) closest to
+    # size but not below it, then only what remains is resized
+    size = (int(size[0]), int(size[1]))
+    if small_image.size == size:
+        return small_image
+    try:
+        small_image.draft(small_image.mode, size)
+    except:
+        # not a JPEG or already decoded
+        pass
+    if small_image.size != size:
+        small_image = small_image.resize(size, Image.BICUBIC)
+    return small_image
+
+
 ################################################################################
 
 ################################################################################
@@ -1297,7 +1606,8 @@ def get_and_paste_wms_part(
     (success, small_image) = get_wms_image(
         bbox, width, height, provider, http_session
     )
-    big_image.paste(small_image, (x0, y0))
+    # servers do not always answer with the size asked
+    big_image.paste(reduced_image(small_image, (width, height)), (x0, y0))
     return success
 
 
@@ -1314,30 +1624,39 @@ def get_and_paste_wmts_part(
     y0,
     http_session,
     subt_size=None,
+    parents=None,
 ):
     (success, small_image) = get_wmts_image(
-        tilematrix, til_x, til_y, provider, http_session
+        tilematrix, til_x, til_y, provider, http_session, parents
     )
     if not subt_size:
         big_image.paste(small_image, (x0, y0))
     else:
-        big_image.paste(small_image.resize(subt_size, Image.BICUBIC), (x0, y0))
+        big_image.paste(reduced_image(small_image, subt_size), (x0, y0))
     return success
 
 
 ################################################################################
 
 ################################################################################
-def build_texture_from_tilbox(tilbox, zoomlevel, provider, progress=None):
+def build_texture_from_tilbox(
+    tilbox, zoomlevel, provider, progress=None, failed_cells=None
+):
     # less general than the next build_texture_from_bbox_and_size but
-    # probably slightly quicker
+    # probably slightly quicker, the (til_x, til_y) of the parts filled with
+    # white are appended to failed_cells if given.
+    if download_engine == "asyncio" and AIO.supports(provider):
+        return AIO.build_texture_from_tilbox(
+            tilbox, zoomlevel, provider, progress, failed_cells
+        )
     (til_x_min, til_y_min, til_x_max, til_y_max) = tilbox
     parts_x = til_x_max - til_x_min
     parts_y = til_y_max - til_y_min
     width = height = provider["tile_size"]
     big_image = Image.new("RGB", (width * parts_x, height * parts_y))
     # we set-up the queue of downloads
-    http_session = requests.Session()
+    http_session = HTTP.get_session(provider)
+    parents = new_parents_memo()
     download_queue = queue.Queue()
     for monty in range(0, parts_y):
         for montx in range(0, parts_x):
@@ -1352,6 +1671,8 @@ def build_texture_from_tilbox(tilbox, zoomlevel, provider, progress=None):
                 x0,
                 y0,
                 http_session,
+                None,
+                parents,
             )
             download_queue.put(fargs)
     # then the number of workers
@@ -1360,8 +1681,15 @@ def build_texture_from_tilbox(tilbox, zoomlevel, provider, progress=None):
     else:
         max_threads = 16
     # and finally activate them
+    def get_and_paste_cell(*fargs):
+        if get_and_paste_wmts_part(*fargs):
+            return 1
+        if failed_cells is not None:
+            failed_cells.append((fargs[1], fargs[2]))
+        return 0
+
     success = parallel_execute(
-        get_and_paste_wmts_part, download_queue, max_threads, progress
+        get_and_paste_cell, download_queue, max_threads, progress
     )
     # once out big_image has been filled and we return it
     return (success, big_image)
@@ -1452,13 +1780,18 @@ def build_texture_from_bbox_and_size(t_bbox, t_epsg, t_size, provider):
             - 1
         )
         if downscale >= 1:
-            width /= 2 ** downscale
-            height /= 2 ** downscale
+            width //= 2 ** downscale
+            height //= 2 ** downscale
             subt_size = (width, height)
+            if crop_needed:
+                (crop_x0, crop_y0, crop_x1, crop_y1) = [
+                    int(round(p / 2 ** downscale))
+                    for p in (crop_x0, crop_y0, crop_x1, crop_y1)
+                ]
         else:
             subt_size = None
     big_image = Image.new("RGB", (width * parts_x, height * parts_y))
-    http_session = requests.Session()
+    http_session = HTTP.get_session(provider)
     download_queue = queue.Queue()
     for monty in range(0, parts_y):
         for montx in range(0, parts_x):
@@ -1532,6 +1865,23 @@ def build_texture_from_bbox_and_size(t_bbox, t_epsg, t_size, provider):
     return (success, big_image)
 
 
+################################################################################
+
+################################################################################
+def file_lock(file_path):
+    with file_locks_lock:
+        return file_locks.setdefault(file_path, threading.Lock())
+
+
+################################################################################
+
+################################################################################
+def save_atomically(image, file_path):
+    # other texture builders never see a partially written orthophoto
+    image.save(file_path + ".part", format="JPEG")
+    os.replace(file_path + ".part", file_path)
+
+
 ################################################################################
 
 ################################################################################
@@ -1552,13 +1902,25 @@ def download_jpeg_ortho(
         if zoomlevel > max_zl:
             super_resol_factor = 2 ** (max_zl - zoomlevel)
     width = height = int(4096 * super_resol_factor)
+    # failed sub-tiles, a None header means that they are not known
+    cells_header = None
+    failed_cells = []
     # we treat first the case of webmercator grid type servers
     if "grid_type" in provider and provider["grid_type"] == "webmercator":
         tilbox = [til_x_left, til_y_top, til_x_left + 16, til_y_top + 16]
         tilbox_mod = [int(round(p * super_resol_factor)) for p in tilbox]
         zoom_shift = round(log(super_resol_factor) / log(2))
         (success, big_image) = build_texture_from_tilbox(
-            tilbox_mod, zoomlevel + zoom_shift, provider
+            tilbox_mod,
+            zoomlevel + zoom_shift,
+            provider,
+            failed_cells=failed_cells,
+        )
+        cells_header = (
+            zoomlevel + zoom_shift,
+            tilbox_mod[0],
+            tilbox_mod[1],
+            int(provider["tile_size"] / super_resol_factor),
         )
     # if not we are in the world of epsg:3857 bboxes
     else:
@@ -1582,21 +1944,135 @@ def download_jpeg_ortho(
             "could not be obtained ",
             "(even at lower ZL), it was filled with white there.",
         )
-        tile_coords = file_dir.split('/')[-2]
-        incomplete_imgs.setdefault(tile_coords, []).append(file_name)
+        record_incomplete_img(file_dir.split('/')[-2], file_name)
+        if not failed_cells:
+            cells_header = None
     if not os.path.exists(file_dir):
-        os.makedirs(file_dir)
+        os.makedirs(file_dir, exist_ok=True)
     try:
-        if super_resol_factor == 1:
-            big_image.save(os.path.join(file_dir, file_name))
-        else:
-            big_image.resize(
+        if super_resol_factor != 1:
+            big_image = big_image.resize(
                 (
                     int(width / super_resol_factor),
                     int(height / super_resol_factor),
                 ),
                 Image.BICUBIC,
-            ).save(os.path.join(file_dir, file_name))
+            )
+        save_atomically(big_image, os.path.join(file_dir, file_name))
+        write_failed_cells(
+            os.path.join(file_dir, file_name),
+            cells_header,
+            failed_cells if not success else None,
+        )
+    except Exception as e:
+        UI.lvprint(
+            0,
+            "OS Error : could not save orthophoto on disk, ",
+            "received message :",
+            e,
+        )
+        return 0
+    return 1
+
+
+################################################################################
+
+################################################################################
+def record_incomplete_img(tile_coords, file_name):
+    with incomplete_imgs_lock:
+        file_names = incomplete_imgs.setdefault(tile_coords, [])
+        if file_name not in file_names:
+            file_names.append(file_name)
+
+
+################################################################################
+
+################################################################################
+def write_failed_cells(file_path, cells_header, failed_cells):
+    # The sub-tiles filled with white are kept in a small text file next to
+    # the orthophoto : a first line with their zoomlevel, the grid origin and
+    # their size in pixels in the orthophoto, then one til_x til_y line per
+    # sub-tile. A first line 'all' asks for the whole orthophoto again (the
+    # failed parts are not known), no file at all means a complete one.
+    cells_file = FNAMES.failed_cells_file(file_path)
+    if failed_cells is None:
+        if os.path.exists(cells_file):
+            os.remove(cells_file)
+        return
+    with open(cells_file + ".tmp", "w") as f:
+        if cells_header is None:
+            f.write("all\n")
+        else:
+            f.write(" ".join(str(x) for x in cells_header) + "\n")
+            for (til_x, til_y) in sorted(failed_cells):
+                f.write(str(til_x) + " " + str(til_y) + "\n")
+    os.replace(cells_file + ".tmp", cells_file)
+
+
+################################################################################
+
+################################################################################
+def read_failed_cells(file_path):
+    # (cells_header, failed_cells), cells_header is None for 'all'
+    try:
+        with open(FNAMES.failed_cells_file(file_path), "r") as f:
+            lines = [line.split() for line in f if line.strip()]
+        cells_header = tuple(int(x) for x in lines[0])
+        failed_cells = [(int(line[0]), int(line[1])) for line in lines[1:]]
+        return (cells_header, failed_cells)
+    except:
+        return (None, [])
+
+
+################################################################################
+
+################################################################################
+def repair_jpeg_ortho(
+    file_dir, file_name, til_x_left, til_y_top, zoomlevel, provider_code
+):
+    # Only the sub-tiles listed next to the orthophoto are asked again and
+    # pasted into it, the whole orthophoto if they are not known.
+    file_path = os.path.join(file_dir, file_name)
+    (cells_header, failed_cells) = read_failed_cells(file_path)
+    if cells_header is None:
+        UI.vprint(1, "   Downloading again incomplete orthophoto " + file_name)
+        return download_jpeg_ortho(
+            file_dir, file_name, til_x_left, til_y_top, zoomlevel, provider_code
+        )
+    (cells_zl, til_x_min, til_y_min, cell_size) = cells_header
+    UI.vprint(
+        1,
+        "   Repairing",
+        len(failed_cells),
+        "missing part(s) of orthophoto " + file_name,
+    )
+    provider = providers_dict[provider_code]
+    http_session = HTTP.get_session(provider)
+    big_image = Image.open(file_path).convert("RGB")
+    still_failed = []
+    for (til_x, til_y) in failed_cells:
+        (success, small_image) = get_wmts_image(
+            cells_zl, til_x, til_y, provider, http_session
+        )
+        if UI.red_flag:
+            return 0
+        if not success:
+            still_failed.append((til_x, til_y))
+            continue
+        if small_image.size != (cell_size, cell_size):
+            small_image = small_image.resize(
+                (cell_size, cell_size), Image.BICUBIC
+            )
+        big_image.paste(
+            small_image,
+            ((til_x - til_x_min) * cell_size, (til_y - til_y_min) * cell_size),
+        )
+    try:
+        if len(still_failed) < len(failed_cells):
+            save_atomically(big_image, file_path)
+        write_failed_cells(
+            file_path, cells_header, still_failed if still_failed else None
+        )
     except Exception as e:
         UI.lvprint(
             0,
@@ -1605,9 +2081,82 @@ def download_jpeg_ortho(
             e,
         )
         return 0
+    if still_failed:
+        UI.lvprint(
+            1,
+            "Part of image",
+            file_name,
+            "could still not be obtained, it was left white there.",
+        )
+        record_incomplete_img(file_dir.split('/')[-2], file_name)
     return 1
 
 
+################################################################################
+
+################################################################################
+def derive_jpeg_ortho(
+    tile, file_dir, file_name, til_x_left, til_y_top, zoomlevel, provider_code
+):
+    # The orthophoto is built from the ones of the same provider at ZL+1 (4)
+    # or ZL+2 (16) when they are all on disk and complete, by area averaging,
+    # without any request. Returns 0 when it could not be done.
+    provider = providers_dict[provider_code]
+    for depth in (1, 2):
+        if "max_zl" in provider and zoomlevel + depth > int(provider["max_zl"]):
+            break
+        factor = 2 ** depth
+        child_dir = FNAMES.jpeg_file_dir_from_attributes(
+            tile.lat, tile.lon, zoomlevel + depth, provider
+        )
+        children = []
+        for j in range(factor):
+            for i in range(factor):
+                child_path = os.path.join(
+                    child_dir,
+                    FNAMES.jpeg_file_name_from_attributes(
+                        factor * til_x_left + 16 * i,
+                        factor * til_y_top + 16 * j,
+                        zoomlevel + depth,
+                        provider_code,
+                    ),
+                )
+                if not os.path.isfile(child_path) or os.path.isfile(
+                    FNAMES.failed_cells_file(child_path)
+                ):
+                    break
+                children.append((i, j, child_path))
+        if len(children) < factor ** 2:
+            continue
+        UI.vprint(
+            1,
+            "   Deriving orthophoto " + file_name + " from",
+            factor ** 2,
+            "orthophotos at ZL" + str(zoomlevel + depth) + ".",
+        )
+        part = 4096 // factor
+        big_image = Image.new("RGB", (4096, 4096))
+        try:
+            for (i, j, child_path) in children:
+                child_image = Image.open(child_path).convert("RGB")
+                # area average of each factor x factor block
+                if child_image.size == (4096, 4096):
+                    child_image = child_image.reduce(factor)
+                else:
+                    child_image = child_image.resize((part, part), Image.BOX)
+                big_image.paste(child_image, (i * part, j * part))
+                if UI.red_flag:
+                    return 0
+            if not os.path.exists(file_dir):
+                os.makedirs(file_dir, exist_ok=True)
+            save_atomically(big_image, os.path.join(file_dir, file_name))
+        except Exception as e:
+            UI.vprint(1, "   Could not derive orthophoto", file_name, ":", e)
+            return 0
+        return 1
+    return 0
+
+
 ################################################################################
 
 ################################################################################
@@ -1666,30 +2215,59 @@ def build_jpeg_ortho(
                     true_zl,
                     providers_dict[rlayer["layer_code"]],
                 )
-                if not os.path.isfile(
-                    os.path.join(true_file_dir, true_file_name)
-                ):
-                    UI.vprint(
-                        1,
-                        "   Downloading missing orthophoto "
-                        + true_file_name
-                        + " (for combining in "
-                        + provider_code
-                        + ")",
-                    )
-                    if not download_jpeg_ortho(
-                        true_file_dir, true_file_name, *true_texture_attributes
+                true_file_path = os.path.join(true_file_dir, true_file_name)
+                with file_lock(true_file_path):
+                    if not os.path.isfile(true_file_path):
+                        if not (
+                            derive_lower_zl
+                            and derive_jpeg_ortho(
+                                tile,
+                                true_file_dir,
+                                true_file_name,
+                                *true_texture_attributes
+                            )
+                        ):
+                            UI.vprint(
+                                1,
+                                "   Downloading missing orthophoto "
+                                + true_file_name
+                                + " (for combining in "
+                                + provider_code
+                                + ")",
+                            )
+                            if not download_jpeg_ortho(
+                                true_file_dir,
+                                true_file_name,
+                                *true_texture_attributes
+                            ):
+                                return 0
+                    elif os.path.isfile(
+                        FNAMES.failed_cells_file(true_file_path)
                     ):
-                        return 0
-                else:
-                    UI.vprint(
-                        2,
-                        "   The orthophoto "
-                        + true_file_name
-                        + " (for combining in "
-                        + provider_code
-                        + ") "
-                        + "is already present.",
+                        if not repair_jpeg_ortho(
+                            true_file_dir,
+                            true_file_name,
+                            *true_texture_attributes
+                        ):
+                            return 0
+                    else:
+                        UI.vprint(
+                            2,
+                            "   The orthophoto "
+                            + true_file_name
+                            + " (for combining in "
+                            + provider_code
+                            + ") "
+                            + "is already present.",
+                        )
+                if os.path.isfile(FNAMES.failed_cells_file(true_file_path)):
+                    # the combined texture has to be converted again once
+                    # the layer is repaired
+                    record_incomplete_img(
+                        FNAMES.short_latlon(tile.lat, tile.lon),
+                        FNAMES.jpeg_file_name_from_attributes(
+                            *texture_attributes
+                        ),
                     )
         if not data_found:
             UI.lvprint(
@@ -1719,9 +2297,11 @@ def build_jpeg_ortho(
                 tile, til_x_left, til_y_top, zoomlevel, provider_code
             )
             if not os.path.exists(file_dir):
-                os.makedirs(file_dir)
+                os.makedirs(file_dir, exist_ok=True)
             try:
-                big_img.convert("RGB").save(os.path.join(file_dir, file_name))
+                save_atomically(
+                    big_img.convert("RGB"), os.path.join(file_dir, file_name)
+                )
             except Exception as e:
                 UI.lvprint(
                     0,
@@ -1737,16 +2317,32 @@ def build_jpeg_ortho(
         file_dir = FNAMES.jpeg_file_dir_from_attributes(
             tile.lat, tile.lon, zoomlevel, providers_dict[provider_code]
         )
-        if not os.path.isfile(os.path.join(file_dir, file_name)):
-            UI.vprint(1, "   Downloading missing orthophoto " + file_name)
-            if not download_jpeg_ortho(
-                file_dir, file_name, *texture_attributes
-            ):
-                return 0
-        else:
-            UI.vprint(
-                2, "   The orthophoto " + file_name + " is already present."
-            )
+        file_path = os.path.join(file_dir, file_name)
+        with file_lock(file_path):
+            if not os.path.isfile(file_path):
+                if not (
+                    derive_lower_zl
+                    and derive_jpeg_ortho(
+                        tile, file_dir, file_name, *texture_attributes
+                    )
+                ):
+                    UI.vprint(
+                        1, "   Downloading missing orthophoto " + file_name
+                    )
+                    if not download_jpeg_ortho(
+                        file_dir, file_name, *texture_attributes
+                    ):
+                        return 0
+            elif os.path.isfile(FNAMES.failed_cells_file(file_path)):
+                if not repair_jpeg_ortho(
+                    file_dir, file_name, *texture_attributes
+                ):
+                    return 0
+            else:
+                UI.vprint(
+                    2,
+                    "   The orthophoto " + file_name + " is already present.",
+                )
     else:
         (tlat, tlon) = GEO.gtile_to_wgs84(
             til_x_left + 8, til_y_top + 8, zoomlevel
@@ -2085,56 +2681,80 @@ def gdalwarp_alternative(s_bbox, s_epsg, s_im, t_bbox, t_epsg, t_size):
     return s_im.transform(t_size, Image.MESH, meshes, Image.BICUBIC)
 
 
+################################################################################
+
+################################################################################
+# Color filters are compiled once per filter code : consecutive per channel
+# point operations (brightness-contrast, levels) are folded into a single
+# 3x256 lookup table, obtained by running them on a 256 pixels ramp, so that
+# an RGB texture goes through one Image.point for all of them. Saturation,
+# sharpness and blur remain separate steps.
+point_filters = ("brightness-contrast", "levels")
+image_filters = ("saturation", "sharpness", "blur")
+
+
+def compile_color_filters(color_filters):
+    ramp = Image.merge(
+        "RGB", [Image.frombytes("L", (256, 1), bytes(range(256)))] * 3
+    )
+    steps = []
+    lut_im = None
+    for color_filter in color_filters:
+        if color_filter[0] in point_filters:
+            try:
+                lut_im = apply_color_filter(
+                    lut_im if lut_im else ramp, color_filter
+                )
+                continue
+            except:
+                # color_transform stops at the first failing filter
+                break
+        if color_filter[0] not in image_filters:
+            continue
+        if lut_im:
+            steps.append(("lut", lut_im.tobytes("raw", "RGB")))
+            lut_im = None
+        steps.append(("filter", color_filter))
+    if lut_im:
+        steps.append(("lut", lut_im.tobytes("raw", "RGB")))
+    return steps
+
+
+################################################################################
+
+################################################################################
+def apply_compiled_color_filters(im, steps):
+    for (kind, step) in steps:
+        try:
+            if kind == "lut":
+                # planar r, g and b tables as expected by Image.point
+                im = im.point(
+                    list(step[0::3]) + list(step[1::3]) + list(step[2::3])
+                )
+            else:
+                im = apply_color_filter(im, step)
+        except:
+            break
+    return im
+
+
 ################################################################################
 
 ################################################################################
 def color_transform(im, color_code):
+    # RGB images go through the compiled filters, other modes (where point
+    # operations could also touch the alpha band) through the filters
+    if im.mode == "RGB" and color_code in color_filters_dict:
+        if color_code not in compiled_color_filters:
+            compiled_color_filters[color_code] = compile_color_filters(
+                color_filters_dict[color_code]
+            )
+        return apply_compiled_color_filters(
+            im, compiled_color_filters[color_code]
+        )
     try:
         for color_filter in color_filters_dict[color_code]:
-            # both range from -127 to 127,
-            # http://gimp.sourcearchive.com/documentation/2.6.1/\
-            # gimpbrightnesscontrastconfig_8c-source.html
-            if color_filter[0] == "brightness-contrast":
-                (brightness, contrast) = color_filter[1:3]
-                if brightness >= 0:
-                    im = im.point(
-                        lambda i: 128
-                        + tan(pi / 4 * (1 + contrast / 128))
-                        * (brightness + (255 - brightness) / 255 * i - 128)
-                    )
-                else:
-                    im = im.point(
-                        lambda i: 128
-                        + tan(pi / 4 * (1 + contrast / 128))
-                        * ((255 + brightness) / 255 * i - 128)
-                    )
-            elif color_filter[0] == "saturation":
-                saturation = color_filter[1]
-                im = ImageEnhance.Color(im).enhance(1 + saturation / 100)
-            elif color_filter[0] == "sharpness":
-                im = ImageEnhance.Sharpness(im).enhance(color_filter[1])
-            elif color_filter[0] == "blur":
-                im = im.filter(ImageFilter.GaussianBlur(color_filter[1]))
-            # levels range between 0 and 255, gamma is neutral at 1
-            # https://pippin.gimp.org/image-processing/chap_point.html
-            elif color_filter[0] == "levels":
-                bands = im.split()
-                for j in [0, 1, 2]:
-                    in_min, gamma, in_max, out_min, out_max = color_filter[
-                        5 * j + 1 : 5 * j + 6
-                    ]
-                    bands[j].paste(
-                        bands[j].point(
-                            lambda i: out_min
-                            + (out_max - out_min)
-                            * (
-                                (max(in_min, min(i, in_max)) - in_min)
-                                / (in_max - in_min)
-                            )
-                            ** (1 / gamma)
-                        )
-                    )
-                im = Image.merge(im.mode, bands)
+            im = apply_color_filter(im, color_filter)
         return im
     except:
         return im
@@ -2142,9 +2762,125 @@ def color_transform(im, color_code):
 
 ################################################################################
 
+################################################################################
+def apply_color_filter(im, color_filter):
+    # both range from -127 to 127,
+    # http://gimp.sourcearchive.com/documentation/2.6.1/\
+    # gimpbrightnesscontrastconfig_8c-source.html
+    if color_filter[0] == "brightness-contrast":
+        (brightness, contrast) = color_filter[1:3]
+        if brightness >= 0:
+            im = im.point(
+                lambda i: 128
+                + tan(pi / 4 * (1 + contrast / 128))
+                * (brightness + (255 - brightness) / 255 * i - 128)
+            )
+        else:
+            im = im.point(
+                lambda i: 128
+                + tan(pi / 4 * (1 + contrast / 128))
+                * ((255 + brightness) / 255 * i - 128)
+            )
+    elif color_filter[0] == "saturation":
+        saturation = color_filter[1]
+        im = ImageEnhance.Color(im).enhance(1 + saturation / 100)
+    elif color_filter[0] == "sharpness":
+        im = ImageEnhance.Sharpness(im).enhance(color_filter[1])
+    elif color_filter[0] == "blur":
+        im = im.filter(ImageFilter.GaussianBlur(color_filter[1]))
+    # levels range between 0 and 255, gamma is neutral at 1
+    # https://pippin.gimp.org/image-processing/chap_point.html
+    elif color_filter[0] == "levels":
+        bands = im.split()
+        for j in [0, 1, 2]:
+            in_min, gamma, in_max, out_min, out_max = color_filter[
+                5 * j + 1 : 5 * j + 6
+            ]
+            bands[j].paste(
+                bands[j].point(
+                    lambda i: out_min
+                    + (out_max - out_min)
+                    * (
+                        (max(in_min, min(i, in_max)) - in_min)
+                        / (in_max - in_min)
+                    )
+                    ** (1 / gamma)
+                )
+            )
+        im = Image.merge(im.mode, bands)
+    return im
+
+
+################################################################################
+# Layers are blended into a single planar RGBA accumulator, strip by strip,
+# so that the temporaries (weights, white/black clipping, blending) never
+# exceed a few composite_strip_rows high strips whatever the number of layers.
+# The result is the same as the former Image.composite of each layer in turn.
+composite_strip_rows = 256
+
+
+def div255(values):
+    # exact rounding of values/255 as done by PIL when pasting with a mask
+    values += 128
+    values += values >> 8
+    values >>= 8
+    return values
+
+
+################################################################################
+
+################################################################################
+def composite_layer(big_array, mask_weight_below, true_im, mask_im, priority):
+    # big_array is the planar (4, height, width) uint8 RGBA accumulator
+    if true_im.mode not in ("RGB", "RGBA"):
+        true_im = true_im.convert("RGB")
+    (width, height) = true_im.size
+    for row0 in range(0, height, composite_strip_rows):
+        row1 = min(row0 + composite_strip_rows, height)
+        mask = numpy.array(mask_im.crop((0, row0, width, row1)), numpy.uint16)
+        bands = [
+            numpy.asarray(band)
+            for band in true_im.crop((0, row0, width, row1)).split()
+        ]
+        weight_below = mask_weight_below[row0:row1]
+        # in case the smoothing of the extent mask was too strong we remove
+        # the mask (where it is nor 0 nor 255) the pixels for which the
+        # true_im is all white or all black
+        sum_arr = bands[0].astype(numpy.uint16)
+        for band in bands[1:]:
+            sum_arr += band
+        mask[
+            ((sum_arr >= 735) | (sum_arr <= 35)) & (mask >= 1) & (mask <= 253)
+        ] = 0
+        if priority == "low":
+            # low priority layers, do not increase mask_weight_below
+            # (0/0 is left as 0)
+            mask = 255 * mask // numpy.maximum(weight_below + mask, 1)
+        elif priority in ["high", "mask"]:
+            weight_below += mask
+        elif priority == "medium":
+            weight_below += mask
+            mask = 255 * mask // numpy.maximum(weight_below, 1)
+            # undecided about the next two lines
+            # was_zero=mask_weight_below==0
+            # mask[was_zero]=255
+        if not mask.any():
+            continue
+        # out = (true_im * mask + out * (255 - mask)) / 255, on all four
+        # channels, the alpha of an RGB layer being 255
+        inv_mask = 255 - mask
+        if len(bands) == 3:
+            bands.append(255)
+        for (channel, band) in enumerate(bands):
+            out = big_array[channel, row0:row1]
+            blended = out * inv_mask
+            blended += band * mask
+            out[:] = div255(blended)
+
+
 ################################################################################
 def combine_textures(tile, til_x_left, til_y_top, zoomlevel, provider_code):
-    big_image = Image.new("RGBA", (4096, 4096))
+    big_array = numpy.zeros((4, 4096, 4096), dtype=numpy.uint8)
     (y0, x0) = GEO.gtile_to_wgs84(til_x_left, til_y_top, zoomlevel)
     (y1, x1) = GEO.gtile_to_wgs84(til_x_left + 16, til_y_top + 16, zoomlevel)
     mask_weight_below = numpy.zeros((4096, 4096), dtype=numpy.uint16)
@@ -2210,8 +2946,6 @@ def combine_textures(tile, til_x_left, til_y_top, zoomlevel, provider_code):
         )
         if not mask:
             continue
-        # we turn the image mask into an array
-        mask = numpy.array(mask, dtype=numpy.uint16)
         true_til_x_left = til_x_left
         true_til_y_top = til_y_top
         true_zl = zoomlevel
@@ -2257,36 +2991,44 @@ def combine_textures(tile, til_x_left, til_y_top, zoomlevel, provider_code):
             true_im = true_im.crop((pixx0, pixy0, pixx1, pixy1)).resize(
                 (4096, 4096), Image.BICUBIC
             )
-        # in case the smoothing of the extent mask was too strong we remove the
-        # the mask (where it is nor 0 nor 255) the pixels for which the true_im
-        # is all white or all black
-        true_arr = numpy.array(true_im).astype(numpy.uint16)
-        mask[
-            (numpy.sum(true_arr, axis=2) >= 735) * (mask >= 1) * (mask <= 253)
-        ] = 0
-        mask[
-            (numpy.sum(true_arr, axis=2) <= 35) * (mask >= 1) * (mask <= 253)
-        ] = 0
-        if rlayer["priority"] == "low":
-            # low priority layers, do not increase mask_weight_below
-            wasnt_zero = (mask_weight_below + mask) != 0
-            mask[wasnt_zero] = (
-                255 * mask[wasnt_zero] / (mask_weight_below + mask)[wasnt_zero]
-            )
-        elif rlayer["priority"] in ["high", "mask"]:
-            mask_weight_below += mask
-        elif rlayer["priority"] == "medium":
-            not_zero = mask != 0
-            mask_weight_below += mask
-            mask[not_zero] = 255 * mask[not_zero] / mask_weight_below[not_zero]
-            # undecided about the next two lines
-            # was_zero=mask_weight_below==0
-            # mask[was_zero]=255
-        # we turn back the array mask into an image
-        mask = Image.fromarray(mask.astype(numpy.uint8))
-        big_image = Image.composite(true_im, big_image, mask)
+        composite_layer(
+            big_array, mask_weight_below, true_im, mask, rlayer["priority"]
+        )
     UI.vprint(2, "Finished imprinting", til_x_left, til_y_top)
-    return big_image
+    return Image.merge("RGBA", [Image.fromarray(band) for band in big_array])
+
+
+################################################################################
+
+################################################################################
+def texture_mask(tile, til_x_left, til_y_top, zoomlevel, provider_code):
+    # The mask saved for the texture by the DSF build. It is a part of one
+    # of the masks of the tile, cut from it when that one is still in the
+    # cache and not newer, and read from its own file otherwise. None when
+    # there is no mask.
+    mask_file = os.path.join(
+        tile.build_dir,
+        "textures",
+        FNAMES.mask_file(til_x_left, til_y_top, zoomlevel, provider_code),
+    )
+    source_file = MASK.mask_name_for_texture(
+        tile, til_x_left, til_y_top, zoomlevel
+    )
+    try:
+        if os.path.getmtime(source_file) <= os.path.getmtime(mask_file):
+            mask = MASK.cached_mask(source_file)
+            if mask is not None:
+                return Image.fromarray(
+                    MASK.mask_crop(tile, mask, til_x_left, til_y_top, zoomlevel)
+                )
+    except OSError:
+        pass
+    try:
+        mask_im = Image.open(mask_file)
+        mask_im.load()
+    except OSError:
+        return None
+    return mask_im if mask_im.mode == "L" else mask_im.convert("L")
 
 
 ################################################################################
@@ -2318,6 +3060,8 @@ def convert_texture(
     erase_tmp_png = False
     erase_tmp_tif = False
     dxt5 = False
+    # the built-in encoder takes the image straight from memory
+    in_memory = type == "dds" and dds_encoder == "numpy"
     masked_texture = False
     if tile.imprint_masks_to_dds and type == "dds":
         masked_texture = os.path.exists(
@@ -2330,34 +3074,25 @@ def convert_texture(
             )
         )
         if masked_texture:
-            mask_im = Image.open(
-                os.path.join(
-                    tile.build_dir,
-                    "textures",
-                    FNAMES.mask_file(
-                        til_x_left, til_y_top, zoomlevel, provider_code
-                    ),
-                )
-            ).convert("L")
+            mask_im = texture_mask(
+                tile, til_x_left, til_y_top, zoomlevel, provider_code
+            )
+            masked_texture = mask_im is not None
     elif tile.imprint_masks_to_dds:  # type = 'tif'
         if int(zoomlevel) >= tile.mask_zl:
-            factor = 2 ** (zoomlevel - tile.mask_zl)
-            m_til_x = (int(til_x_left / factor) // 16) * 16
-            m_til_y = (int(til_y_top / factor) // 16) * 16
-            rx = int((til_x_left - factor * m_til_x) / 16)
-            ry = int((til_y_top - factor * m_til_y) / 16)
-            mask_file = os.path.join(
-                FNAMES.mask_dir(tile.lat, tile.lon),
-                FNAMES.legacy_mask(m_til_x, m_til_y),
+            mask_file = MASK.mask_name_for_texture(
+                tile, til_x_left, til_y_top, zoomlevel
             )
-            if os.path.isfile(mask_file):
-                big_img = Image.open(mask_file)
-                x0 = int(rx * 4096 / factor)
-                y0 = int(ry * 4096 / factor)
-                mask_im = big_img.crop(
-                    (x0, y0, x0 + 4096 // factor, y0 + 4096 // factor)
+            mask = None
+            if MASK.may_need_mask(
+                tile, mask_file, til_x_left, til_y_top, zoomlevel
+            ):
+                mask = MASK.read_mask(mask_file)
+            if mask is not None:
+                small_array = MASK.mask_crop(
+                    tile, mask, til_x_left, til_y_top, zoomlevel
                 )
-                small_array = numpy.array(mask_im, dtype=numpy.uint8)
+                mask_im = Image.fromarray(small_array)
                 if small_array.max() > 30:
                     masked_texture = True
 
@@ -2392,9 +3127,12 @@ def convert_texture(
                 except:
                     pass
             dxt5 = True
-        file_to_convert = os.path.join(FNAMES.resource_path("tmp"), png_file_name)
-        erase_tmp_png = True
-        big_image.save(file_to_convert)
+        if not in_memory:
+            file_to_convert = os.path.join(
+                FNAMES.resource_path("tmp"), png_file_name
+            )
+            erase_tmp_png = True
+            big_image.save(file_to_convert)
         # If one wanted to distribute jpegs instead of dds, uncomment the
         # next line.
         # big_image.convert('RGB').save(os.path.join(tile.build_dir,
@@ -2428,13 +3166,35 @@ def convert_texture(
                 except:
                     pass
             dxt5 = True
-        file_to_convert = os.path.join(FNAMES.resource_path("tmp"), png_file_name)
-        erase_tmp_png = True
-        big_image.save(file_to_convert)
+        if not in_memory:
+            file_to_convert = os.path.join(
+                FNAMES.resource_path("tmp"), png_file_name
+            )
+            erase_tmp_png = True
+            big_image.save(file_to_convert)
     # finally if nothing needs to be done prior to the conversion
+    elif in_memory:
+        big_image = Image.open(os.path.join(file_dir, jpeg_file_name)).convert(
+            "RGB"
+        )
     else:
         file_to_convert = os.path.join(file_dir, jpeg_file_name)
     # eventually the dds conversion
+    if in_memory:
+        try:
+            DDS.write_dds(
+                big_image,
+                os.path.join(tile.build_dir, "textures", out_file_name),
+                dxt5,
+            )
+        except Exception as e:
+            UI.lvprint(
+                1,
+                "ERROR: Could not convert texture",
+                os.path.join(tile.build_dir, "textures", out_file_name),
+                str(e),
+            )
+        return
     if type == "dds":
         if not dxt5:
             conv_cmd = [
@@ -2562,6 +3322,51 @@ def convert_texture(
     return
 
 
+################################################################################
+
+################################################################################
+def convert_worker_state():
+    return worker_state(
+        sys.modules[__name__],
+        "IMG",
+        (
+            "providers_dict",
+            "combined_providers_dict",
+            "local_combined_providers_dict",
+            "extents_dict",
+            "color_filters_dict",
+        ),
+        {
+            UI: {"verbosity": UI.verbosity},
+            FNAMES: {"Imagery_dir": FNAMES.Imagery_dir},
+            # the conversion processes already keep all cores busy
+            DDS: {"nbr_workers": 1},
+        },
+    )
+
+
+################################################################################
+
+################################################################################
+def convert_texture_job(tile, til_x_left, til_y_top, zoomlevel, provider_code):
+    # runs in a conversion process, returns None or the reason of the failure
+    try:
+        convert_texture(tile, til_x_left, til_y_top, zoomlevel, provider_code)
+    except Exception as e:
+        return str(e) or e.__class__.__name__
+    if not os.path.isfile(
+        os.path.join(
+            tile.build_dir,
+            "textures",
+            FNAMES.dds_file_name_from_attributes(
+                til_x_left, til_y_top, zoomlevel, provider_code
+            ),
+        )
+    ):
+        return "no texture was written"
+    return None
+
+
 ################################################################################
 
 ################################################################################
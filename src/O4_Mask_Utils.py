@@ -1,7 +1,9 @@
 import os
 import sys
+import threading
 import time
 import queue
+from collections import OrderedDict
 from math import atan, ceil, floor
 import numpy
 from PIL import Image, ImageDraw, ImageFilter, ImageOps
@@ -19,6 +21,146 @@ from O4_Parallel_Utils import parallel_execute
 mask_altitude_above = 0.5
 masks_build_slots = 4
 
+# Decoded masks of the tile (those of mask_dir which needs_mask crops the
+# masks of the textures from), shared by the DSF build and the conversion of
+# the textures, keyed by file name and only valid for the mtime and size of
+# the file they were read from. The least recently used ones are dropped
+# above mask_cache_size. A coverage summary of each of them (the max of each
+# block of summary_block x summary_block pixels) is kept aside, it tells
+# most textures they need no mask without decoding it again.
+mask_cache_size = 128  # in MB
+mask_cache = OrderedDict()
+mask_summaries = {}
+mask_cache_lock = threading.Lock()
+mask_cache_stats = {"decodes": 0, "hits": 0}
+summary_block = 16
+
+################################################################################
+def mask_cache_key(mask_file):
+    stat = os.stat(mask_file)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+################################################################################
+
+################################################################################
+def cache_mask(mask_file, key, mask):
+    mask.flags.writeable = False
+    (height, width) = mask.shape
+    summary = (
+        mask[
+            : height - height % summary_block, : width - width % summary_block
+        ]
+        .reshape(
+            height // summary_block,
+            summary_block,
+            width // summary_block,
+            summary_block,
+        )
+        .max(axis=(1, 3))
+    )
+    with mask_cache_lock:
+        mask_summaries[mask_file] = (key, summary)
+        mask_cache[mask_file] = (key, mask)
+        mask_cache.move_to_end(mask_file)
+        total = sum(array.nbytes for (_, array) in mask_cache.values())
+        while total > mask_cache_size * 1024 ** 2 and mask_cache:
+            total -= mask_cache.popitem(last=False)[1][1].nbytes
+
+
+################################################################################
+
+################################################################################
+def read_mask(mask_file):
+    # The mask as a (read only) uint8 array, decoded only if it is not in
+    # the cache already, or None if there is no such file.
+    try:
+        key = mask_cache_key(mask_file)
+    except OSError:
+        return None
+    with mask_cache_lock:
+        entry = mask_cache.get(mask_file)
+        if entry is not None and entry[0] == key:
+            mask_cache.move_to_end(mask_file)
+            mask_cache_stats["hits"] += 1
+            return entry[1]
+    img = Image.open(mask_file)
+    mask = numpy.array(img if img.mode == "L" else img.convert("L"))
+    with mask_cache_lock:
+        mask_cache_stats["decodes"] += 1
+    cache_mask(mask_file, key, mask)
+    return mask
+
+
+################################################################################
+
+################################################################################
+def cached_mask(mask_file):
+    # The mask if it is in the cache and still valid, None otherwise.
+    try:
+        key = mask_cache_key(mask_file)
+    except OSError:
+        return None
+    with mask_cache_lock:
+        entry = mask_cache.get(mask_file)
+        if entry is None or entry[0] != key:
+            return None
+        mask_cache.move_to_end(mask_file)
+        mask_cache_stats["hits"] += 1
+        return entry[1]
+
+
+################################################################################
+
+################################################################################
+def mask_box(tile, til_x_left, til_y_top, zl):
+    # The top left corner and the size of the part of the mask at
+    # tile.mask_zl which lies below the texture.
+    factor = 2 ** (zl - tile.mask_zl)
+    m_til_x = (int(til_x_left / factor) // 16) * 16
+    m_til_y = (int(til_y_top / factor) // 16) * 16
+    rx = int((til_x_left - factor * m_til_x) / 16)
+    ry = int((til_y_top - factor * m_til_y) / 16)
+    return (int(rx * 4096 / factor), int(ry * 4096 / factor), 4096 // factor)
+
+
+################################################################################
+
+################################################################################
+def mask_crop(tile, mask, til_x_left, til_y_top, zl):
+    (x0, y0, size) = mask_box(tile, til_x_left, til_y_top, zl)
+    return mask[y0 : y0 + size, x0 : x0 + size]
+
+
+################################################################################
+
+################################################################################
+def may_need_mask(tile, mask_file, til_x_left, til_y_top, zl):
+    # False when the coverage summary of the mask (read once if need be)
+    # shows that the part below the texture is dry, None when there is no
+    # mask at all, True otherwise.
+    try:
+        key = mask_cache_key(mask_file)
+    except OSError:
+        return None
+    with mask_cache_lock:
+        entry = mask_summaries.get(mask_file)
+    if entry is None or entry[0] != key:
+        if read_mask(mask_file) is None:
+            return None
+        with mask_cache_lock:
+            entry = mask_summaries[mask_file]
+    (x0, y0, size) = mask_box(tile, til_x_left, til_y_top, zl)
+    block = summary_block
+    blocks = entry[1][
+        y0 // block : -(-(y0 + size) // block),
+        x0 // block : -(-(x0 + size) // block),
+    ]
+    return bool(blocks.size) and blocks.max() > 30
+
+
+################################################################################
+
 ################################################################################
 def mask_name_for_texture(tile, til_x_left, til_y_top, zl, *args):
     if int(zl) < tile.mask_zl:
@@ -38,28 +180,17 @@ def mask_name_for_texture(tile, til_x_left, til_y_top, zl, *args):
 def needs_mask(tile, til_x_left, til_y_top, zl, *args):
     if int(zl) < tile.mask_zl:
         return False
-    factor = 2 ** (zl - tile.mask_zl)
-    m_til_x = (int(til_x_left / factor) // 16) * 16
-    m_til_y = (int(til_y_top / factor) // 16) * 16
-    rx = int((til_x_left - factor * m_til_x) / 16)
-    ry = int((til_y_top - factor * m_til_y) / 16)
-    mask_file = os.path.join(
-        FNAMES.mask_dir(tile.lat, tile.lon),
-        FNAMES.legacy_mask(m_til_x, m_til_y)
-        )
-    if not os.path.isfile(mask_file):
+    mask_file = mask_name_for_texture(tile, til_x_left, til_y_top, zl, *args)
+    if not may_need_mask(tile, mask_file, til_x_left, til_y_top, zl):
         return False
-    big_img = Image.open(mask_file)
-    x0 = int(rx * 4096 / factor)
-    y0 = int(ry * 4096 / factor)
-    small_img = big_img.crop((x0, y0, x0 + 4096 // factor, y0 + 4096 // factor))
-    small_array = numpy.array(small_img, dtype=numpy.uint8)
+    mask = read_mask(mask_file)
+    if mask is None:
+        return False
+    small_array = mask_crop(tile, mask, til_x_left, til_y_top, zl)
     if small_array.max() <= 30:
         return False
     else:
-        return small_img
-################################################################################
-
+        return Image.fromarray(small_array)
 ################################################################################
 def build_masks(tile, for_imagery=False):
     
@@ -1,3 +1,5 @@
+import concurrent.futures
+import multiprocessing
 import time
 import os
 import shutil
@@ -5,12 +7,16 @@ import sys
 import subprocess
 import O4_File_Names as FNAMES
 import O4_UI_Utils as UI
+from O4_Parallel_Utils import init_worker, worker_state
 
 # the following is meant to be modified directly by users who need it (in the 
 # config window, not here!)
 ovl_exclude_pol = [0]
 ovl_exclude_net = []
 
+# number of processes extracting the overlays of a batch of tiles
+max_overlay_slots = 4
+
 # the following is meant to be modified by the CFG module at run time
 custom_overlay_src = ""
 custom_overlay_src_alternate = ""
@@ -31,9 +37,10 @@ else:
     dsftool_cmd = os.path.join(FNAMES.Utils_dir, "lin", "DSFTool ")
 
 ################################################################################
-def build_overlay(lat, lon):
+def build_overlay(lat, lon, tmp_dir=None):
     if UI.is_working:
         return 0
+    tmp_dir = tmp_dir or FNAMES.Tmp_dir
     UI.is_working = 1
     timer = time.time()
     UI.logprint("Step 4 for tile lat=", lat, ", lon=", lon, ": starting.")
@@ -63,7 +70,7 @@ def build_overlay(lat, lon):
         )
         return 0
     file_to_sniff_loc = os.path.join(
-        FNAMES.Tmp_dir, FNAMES.short_latlon(lat, lon) + ".dsf"
+        tmp_dir, FNAMES.short_latlon(lat, lon) + ".dsf"
     )
     UI.vprint(1, "-> Making a copy of the original overlay DSF in tmp dir")
     try:
@@ -80,7 +87,7 @@ def build_overlay(lat, lon):
     if dsfid == "7z":
         UI.vprint(1, "-> The original DSF is a 7z archive, uncompressing...")
         os.replace(file_to_sniff_loc, file_to_sniff_loc + ".7z")
-        subprocess.run([unzip_cmd, "e", f"-o{FNAMES.Tmp_dir}", f"{file_to_sniff_loc}.7z"])
+        subprocess.run([unzip_cmd, "e", f"-o{tmp_dir}", f"{file_to_sniff_loc}.7z"])
         os.remove(file_to_sniff_loc + ".7z")
     UI.vprint(1, "-> Converting the copy to text format")
     dsfconvertcmd = [
@@ -88,7 +95,7 @@ def build_overlay(lat, lon):
         " -dsf2text ".strip(),
         file_to_sniff_loc,
         os.path.join(
-            FNAMES.Tmp_dir, FNAMES.short_latlon(lat, lon) + "_tmp_dsf.txt"
+            tmp_dir, FNAMES.short_latlon(lat, lon) + "_tmp_dsf.txt"
         ),
     ]
     fingers_crossed = subprocess.Popen(
@@ -106,13 +113,13 @@ def build_overlay(lat, lon):
     UI.vprint(1, "-> Selecting overlays for copy/paste")
     f = open(
         os.path.join(
-            FNAMES.Tmp_dir, FNAMES.short_latlon(lat, lon) + "_tmp_dsf.txt"
+            tmp_dir, FNAMES.short_latlon(lat, lon) + "_tmp_dsf.txt"
         ),
         "r",
     )
     g = open(
         os.path.join(
-            FNAMES.Tmp_dir,
+            tmp_dir,
             FNAMES.short_latlon(lat, lon) + "_tmp_dsf_without_mesh.txt",
         ),
         "w",
@@ -183,11 +190,11 @@ def build_overlay(lat, lon):
         dsftool_cmd.strip(),
         " -text2dsf ".strip(),
         os.path.join(
-            FNAMES.Tmp_dir,
+            tmp_dir,
             FNAMES.short_latlon(lat, lon) + "_tmp_dsf_without_mesh.txt",
         ),
         os.path.join(
-            FNAMES.Tmp_dir,
+            tmp_dir,
             FNAMES.short_latlon(lat, lon) + "_tmp_dsf_without_mesh.dsf",
         ),
     ]
@@ -215,43 +222,157 @@ def build_overlay(lat, lon):
             return 0
     shutil.copy(
         os.path.join(
-            FNAMES.Tmp_dir,
+            tmp_dir,
             FNAMES.short_latlon(lat, lon) + "_tmp_dsf_without_mesh.dsf",
         ),
         os.path.join(dest_dir, FNAMES.short_latlon(lat, lon) + ".dsf"),
     )
     os.remove(
         os.path.join(
-            FNAMES.Tmp_dir,
+            tmp_dir,
             FNAMES.short_latlon(lat, lon) + "_tmp_dsf_without_mesh.dsf",
         )
     )
     os.remove(
         os.path.join(
-            FNAMES.Tmp_dir,
+            tmp_dir,
             FNAMES.short_latlon(lat, lon) + "_tmp_dsf_without_mesh.txt",
         )
     )
     os.remove(
         os.path.join(
-            FNAMES.Tmp_dir, FNAMES.short_latlon(lat, lon) + "_tmp_dsf.txt"
+            tmp_dir, FNAMES.short_latlon(lat, lon) + "_tmp_dsf.txt"
         )
     )
     os.remove(file_to_sniff_loc)
     try:
         os.remove(
             os.path.join(
-                FNAMES.Tmp_dir,
+                tmp_dir,
                 FNAMES.short_latlon(lat, lon) + "_tmp_dsf.txt.elevation.raw",
             )
         )
         os.remove(
             os.path.join(
-                FNAMES.Tmp_dir,
+                tmp_dir,
                 FNAMES.short_latlon(lat, lon) + "_tmp_dsf.txt.sea_level.raw",
             )
         )
     except:
         pass
     UI.timings_and_bottom_line(timer)
-    return 1
\ No newline at end of file
+    return 1
+
+
+################################################################################
+
+################################################################################
+def overlay_worker_state():
+    return worker_state(
+        sys.modules[__name__],
+        "OVL",
+        ("unzip_cmd", "dsftool_cmd"),
+        {
+            UI: {"verbosity": UI.verbosity, "gui": None},
+            FNAMES: {
+                "Tmp_dir": FNAMES.Tmp_dir,
+                "Overlay_dir": FNAMES.Overlay_dir,
+            },
+        },
+    )
+
+
+################################################################################
+
+################################################################################
+def build_overlay_job(lat, lon):
+    # Runs in an overlay process, with a tmp dir of its own so that the
+    # tiles do not collide. Returns the time it took and None or the reason
+    # of the failure.
+    timer = time.time()
+    tmp_dir = os.path.join(
+        FNAMES.Tmp_dir, "Overlay_" + FNAMES.short_latlon(lat, lon)
+    )
+    UI.is_working = False
+    try:
+        os.makedirs(tmp_dir, exist_ok=True)
+        if build_overlay(lat, lon, tmp_dir):
+            error = None
+        else:
+            error = "overlay extraction failed (see above)"
+    except Exception as e:
+        error = str(e) or e.__class__.__name__
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    return (time.time() - timer, error)
+
+
+################################################################################
+
+################################################################################
+def build_overlays(list_lat_lon):
+    # Extracts the overlays of a batch of tiles, max_overlay_slots at a
+    # time. Returns the (time, error) of each tile done, error being None
+    # when it went well.
+    timer = time.time()
+    nbr_workers = max(1, min(max_overlay_slots, len(list_lat_lon)))
+    UI.lvprint(
+        0,
+        "Overlay extraction launched for",
+        len(list_lat_lon),
+        "tiles, with",
+        nbr_workers,
+        "processes.",
+    )
+    # spawned, forking a process which runs threads is not safe
+    executor = concurrent.futures.ProcessPoolExecutor(
+        nbr_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(overlay_worker_state(),),
+    )
+    jobs = {
+        executor.submit(build_overlay_job, lat, lon): (lat, lon)
+        for (lat, lon) in list_lat_lon
+    }
+    results = {}
+    pending = set(jobs)
+    while pending and not UI.red_flag:
+        (done, pending) = concurrent.futures.wait(
+            pending, timeout=0.2, return_when=concurrent.futures.FIRST_COMPLETED
+        )
+        for job in done:
+            (lat, lon) = jobs[job]
+            try:
+                (elapsed, error) = job.result()
+            except Exception as e:
+                # e.g. an overlay process died
+                (elapsed, error) = (None, str(e) or e.__class__.__name__)
+            results[(lat, lon)] = (elapsed, error)
+            if error:
+                UI.lvprint(
+                    0,
+                    "ERROR: Overlay of tile",
+                    FNAMES.short_latlon(lat, lon),
+                    "not extracted :",
+                    error,
+                )
+            else:
+                UI.lvprint(
+                    1,
+                    "   Overlay of tile",
+                    FNAMES.short_latlon(lat, lon),
+                    "extracted in",
+                    UI.nicer_timer(elapsed),
+                )
+    # on a stop, the tiles not yet started are dropped
+    executor.shutdown(wait=True, cancel_futures=True)
+    UI.lvprint(
+        0,
+        "Overlays of",
+        sum(1 for (_, error) in results.values() if not error),
+        "out of",
+        len(list_lat_lon),
+        "tiles extracted in",
+        UI.nicer_timer(time.time() - timer),
+    )
+    return results
@@ -1,4 +1,6 @@
+import importlib
 import threading
+import O4_Cfg_Vars as CFG
 import O4_UI_Utils as UI
 
 ################################################################################
@@ -61,4 +63,29 @@ def parallel_launch(task, queue, nbr_workers, progress=None):
 ################################################################################
 def parallel_join(workers):
     for worker in workers:
-        worker.join()
\ No newline at end of file
+        worker.join()
+
+################################################################################
+def worker_state(module, alias, module_vars, other_vars):
+    # What a worker process needs to know of this one, it may well not have
+    # inherited it (spawn start method) : the config variables of module
+    # (alias is its module in O4_Cfg_Vars) along with its module_vars, and
+    # the values other_vars gives to variables of other modules.
+    values = {
+        var: getattr(module, var)
+        for var in CFG.cfg_app_vars
+        if CFG.cfg_app_vars[var].get("module") == alias
+    }
+    values.update((var, getattr(module, var)) for var in module_vars)
+    state = {module.__name__: values}
+    for (other_module, other_values) in other_vars.items():
+        state.setdefault(other_module.__name__, {}).update(other_values)
+    return state
+
+################################################################################
+def init_worker(state):
+    # the initializer of the worker processes, state is from worker_state
+    for (module_name, values) in state.items():
+        module = importlib.import_module(module_name)
+        for (var, value) in values.items():
+            setattr(module, var, value)
@@ -1,4 +1,9 @@
+import concurrent.futures
+import copy
+import heapq
+import itertools
 import logging
+import multiprocessing
 import os
 import time
 import shutil
@@ -6,38 +11,318 @@ import queue
 import threading
 import O4_UI_Utils as UI
 import O4_File_Names as FNAMES
+import O4_Async_Utils as AIO
 import O4_Imagery_Utils as IMG
+import O4_DDS_Utils as DDS
+import O4_Http_Utils as HTTP
+import O4_Cache_Utils as CACHE
 import O4_Vector_Map as VMAP
 import O4_Mesh_Utils as MESH
 import O4_Mask_Utils as MASK
 import O4_DSF_Utils as DSF
 import O4_Overlay_Utils as OVL
-from O4_Parallel_Utils import parallel_launch, parallel_join
+from O4_Parallel_Utils import init_worker, parallel_launch, parallel_join
 
 max_convert_slots = 4
+max_download_slots = 2
+convert_engine = "threads"
+download_order = "hilbert"
 skip_downloads = False
 skip_converts = False
 
+# when the first texture of the current tile was on disk, and converted
+timings = {"start": None, "download": None, "convert": None}
+timings_lock = threading.Lock()
+
+################################################################################
+def hilbert_index(x, y, order=20):
+    # position of (x, y) along the Hilbert curve filling [0, 2**order)**2
+    n = 1 << order
+    index = 0
+    s = n >> 1
+    while s:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        index += s * s * ((3 * rx) ^ ry)
+        if not ry:
+            if rx:
+                (x, y) = (n - 1 - x, n - 1 - y)
+            (x, y) = (y, x)
+        s >>= 1
+    return index
+
+
+################################################################################
+
+################################################################################
+def hilbert_key(tile, til_x_left, til_y_top, zoomlevel, provider_code):
+    # the center of the texture, at ZL20 whatever its own ZL
+    zoomlevel = int(zoomlevel)
+    return hilbert_index(
+        ((til_x_left + 8) << 20) >> zoomlevel,
+        ((til_y_top + 8) << 20) >> zoomlevel,
+    )
+
+
+################################################################################
+
+################################################################################
+def fifo_order(tile, *texture_attributes):
+    return ()
+
+
+################################################################################
+
+################################################################################
+def hilbert_order(tile, *texture_attributes):
+    # neighbour textures are downloaded one after the other, which is what
+    # caches of the providers (and the local tile cache) like best
+    return (hilbert_key(tile, *texture_attributes),)
+
+
+################################################################################
+
+################################################################################
+def masks_order(tile, *texture_attributes):
+    # textures with a mask first, their conversion needs it and takes longer
+    mask_file = MASK.mask_name_for_texture(tile, *texture_attributes)
+    has_mask = bool(mask_file) and os.path.isfile(mask_file)
+    return (not has_mask, hilbert_key(tile, *texture_attributes))
+
+
+################################################################################
+
+################################################################################
+def airports_order(tile, *texture_attributes):
+    # textures above the default ZL first (airports and custom zones)
+    zoomlevel = texture_attributes[2]
+    return (
+        -int(zoomlevel) if int(zoomlevel) > tile.default_zl else 0,
+        hilbert_key(tile, *texture_attributes),
+    )
+
+
+# key functions of the download orders, textures with the smaller keys
+# are downloaded first, and in the order they were queued for equal keys
+download_orders = {
+    "fifo": fifo_order,
+    "hilbert": hilbert_order,
+    "masks": masks_order,
+    "airports": airports_order,
+}
+
+################################################################################
+class DownloadQueue(queue.Queue):
+    """Queue of the textures to download, served in download_order."""
+
+    def __init__(self, tile, order=None):
+        self.tile = tile
+        self.order = download_orders[order or download_order]
+        super().__init__()
+
+    def _init(self, maxsize):
+        self.queue = []
+        self.counter = itertools.count()
+
+    def _qsize(self):
+        return len(self.queue)
+
+    def _put(self, item):
+        if isinstance(item, str):
+            # "quit" once there is no texture left
+            key = (1,)
+        else:
+            key = (0, *self.order(self.tile, *item))
+        heapq.heappush(self.queue, (key, next(self.counter), item))
+
+    def _get(self):
+        return heapq.heappop(self.queue)[-1]
+
+
+################################################################################
+
+################################################################################
+def reset_timings():
+    with timings_lock:
+        timings["start"] = time.time()
+        timings["download"] = timings["convert"] = None
+
+
+################################################################################
+
+################################################################################
+def record_first(event):
+    with timings_lock:
+        if timings["start"] is not None and timings[event] is None:
+            timings[event] = time.time() - timings["start"]
+
+
+################################################################################
+
+################################################################################
+def print_timings():
+    with timings_lock:
+        if timings["download"] is None:
+            return
+        UI.vprint(
+            1,
+            "     Download order",
+            download_order,
+            ": first texture on disk after",
+            round(timings["download"], 1),
+            "s"
+            + (
+                ", first converted after "
+                + str(round(timings["convert"], 1))
+                + "s."
+                if timings["convert"] is not None
+                else "."
+            ),
+        )
+
+
+################################################################################
+
+################################################################################
+def convert_texture(tile, til_x_left, til_y_top, zoomlevel, provider_code):
+    result = IMG.convert_texture(
+        tile, til_x_left, til_y_top, zoomlevel, provider_code
+    )
+    record_first("convert")
+    return result
+
+
+################################################################################
+
 ################################################################################
 def download_textures(tile, download_queue, convert_queue):
-    UI.vprint(1, "-> Opening download queue.")
-    done = 0
+    nbr_workers = max(1, max_download_slots)
+    UI.vprint(
+        1,
+        "-> Opening download queue and",
+        nbr_workers,
+        "download workers.",
+    )
+    # textures are built concurrently, a texture is only handed to the
+    # convert queue once its orthophoto is entirely on disk.
+    progress = {"done": 0, "lock": threading.Lock()}
+    workers = [
+        threading.Thread(
+            target=download_worker,
+            args=[tile, download_queue, convert_queue, progress],
+        )
+        for _ in range(nbr_workers)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    if UI.red_flag:
+        UI.vprint(1, "Download process interrupted.")
+        return 0
+    UI.progress_bar(2, 100)
+    if progress["done"]:
+        UI.vprint(1, " *Download of textures completed.")
+    return 1
+
+################################################################################
+def download_worker(tile, download_queue, convert_queue, progress):
     while True:
         texture_attributes = download_queue.get()
         if isinstance(texture_attributes, str) and texture_attributes == "quit":
-            UI.progress_bar(2, 100)
-            break
+            # put it back for the sibling workers
+            download_queue.put("quit")
+            return
         if IMG.build_jpeg_ortho(tile, *texture_attributes):
-            done += 1
-            UI.progress_bar(
-                2, int(100 * done / (done + download_queue.qsize()))
-            )
+            record_first("download")
+            with progress["lock"]:
+                progress["done"] += 1
+                UI.progress_bar(
+                    2,
+                    int(
+                        100
+                        * progress["done"]
+                        / (progress["done"] + download_queue.qsize())
+                    ),
+                )
             convert_queue.put((tile, *texture_attributes))
         if UI.red_flag:
-            UI.vprint(1, "Download process interrupted.")
-            return 0
-    if done:
-        UI.vprint(1, " *Download of textures completed.")
+            return
+
+################################################################################
+def convert_textures_in_processes(convert_queue, progress):
+    # Same job as the convert worker threads, but each texture is converted
+    # in its own process of a pool, only the texture attributes are sent.
+    # The processes are spawned, this one runs the download threads. They
+    # read the orthophotos from disk themselves: decoding one is a few % of
+    # its conversion, less than handing its pixels over through shared
+    # memory would cost (see tools/benchmark_convert.py).
+    nbr_workers = max(1, max_convert_slots)
+    executor = concurrent.futures.ProcessPoolExecutor(
+        nbr_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(IMG.convert_worker_state(),),
+    )
+    lock = threading.Lock()
+    jobs = []
+    light_tile = None
+
+    def job_done(job, texture_attributes):
+        if job.cancelled():
+            return
+        try:
+            error = job.result()
+        except Exception as e:
+            # e.g. a conversion process died
+            error = str(e) or e.__class__.__name__
+        record_first("convert")
+        with lock:
+            progress["done"] += 1
+            UI.progress_bar(
+                progress["bar"],
+                int(
+                    100
+                    * progress["done"]
+                    / (progress["done"] + convert_queue.qsize())
+                ),
+            )
+        if error:
+            file_name = FNAMES.jpeg_file_name_from_attributes(
+                *texture_attributes
+            )
+            UI.lvprint(
+                1, "ERROR: Could not convert texture", file_name, ":", error
+            )
+            with IMG.incomplete_imgs_lock:
+                IMG.incomplete_imgs.setdefault(
+                    FNAMES.short_latlon(light_tile.lat, light_tile.lon), []
+                ).append(file_name)
+
+    while True:
+        args = convert_queue.get()
+        if (isinstance(args, str) and args == "quit") or UI.red_flag:
+            break
+        if light_tile is None:
+            # the tile is sent with each job, not its elevation data
+            light_tile = copy.copy(args[0])
+            light_tile.dem = None
+        job = executor.submit(IMG.convert_texture_job, light_tile, *args[1:])
+        job.add_done_callback(
+            lambda job, texture_attributes=args[1:]: job_done(
+                job, texture_attributes
+            )
+        )
+        jobs.append(job)
+    while not UI.red_flag:
+        (_, pending) = concurrent.futures.wait(jobs, timeout=0.2)
+        if not pending:
+            break
+    # on a stop, the textures not yet started are dropped
+    executor.shutdown(wait=True, cancel_futures=True)
+    if UI.red_flag:
+        return 0
+    UI.progress_bar(progress["bar"], 100)
     return 1
 
 ################################################################################
@@ -109,7 +394,7 @@ def build_tile(tile):
         UI.exit_message_and_bottom_line("")
         return 0
 
-    download_queue = queue.Queue()
+    download_queue = DownloadQueue(tile)
     convert_queue = queue.Queue()
     
     download_launched = False
@@ -123,6 +408,8 @@ def build_tile(tile):
     )
     build_dsf_thread.start()
     if not skip_downloads:
+        HTTP.reset_coalesce_stats()
+        reset_timings()
         download_thread.start()
         download_launched = True
         if not skip_converts:
@@ -133,25 +420,39 @@ def build_tile(tile):
                 "conversion workers.",
             )
             dico_conv_progress = {"done": 0, "bar": 3}
-            convert_workers = parallel_launch(
-                IMG.convert_texture,
-                convert_queue,
-                max_convert_slots,
-                progress=dico_conv_progress,
-            )
+            if convert_engine == "processes":
+                convert_workers = [
+                    threading.Thread(
+                        target=convert_textures_in_processes,
+                        args=[convert_queue, dico_conv_progress],
+                    )
+                ]
+                convert_workers[0].start()
+            else:
+                convert_workers = parallel_launch(
+                    convert_texture,
+                    convert_queue,
+                    max_convert_slots,
+                    progress=dico_conv_progress,
+                )
             convert_launched = True
     build_dsf_thread.join()
     if download_launched:
         download_queue.put("quit")
         download_thread.join()
+        HTTP.print_statistics()
+        CACHE.print_statistics()
         if convert_launched:
             for _ in range(max_convert_slots):
                 convert_queue.put("quit")
             parallel_join(convert_workers)
+            # the encoding processes are not kept from one tile to the next
+            DDS.shutdown()
             if UI.red_flag:
                 UI.vprint(1, "DDS conversion process interrupted.")
             elif dico_conv_progress["done"] >= 1:
                 UI.vprint(1, " *DDS conversion of textures completed.")
+        print_timings()
     UI.vprint(1, " *Activating DSF file.")
     dsf_file_name = os.path.join(
         tile.build_dir,
@@ -227,6 +528,13 @@ def build_tile_list(
     UI.lvprint(
         0, "Batch build launched for a number of", len(list_lat_lon), "tiles."
     )
+    if do_ovl:
+        # the overlays do not depend on the other steps, they are extracted
+        # for all tiles at once in parallel
+        OVL.build_overlays(list_lat_lon)
+        if UI.red_flag:
+            UI.exit_message_and_bottom_line()
+            return 0
     k = 0
     for (lat, lon) in list_lat_lon:
         k += 1
@@ -271,15 +579,10 @@ def build_tile_list(
             _count = 0
             if tile_coords in IMG.incomplete_imgs and _count < 1:
                 UI.lvprint(1, f"Attempting to rebuild textures with white squares: {IMG.incomplete_imgs}")
-                delete_incomplete_imgs(IMG.incomplete_imgs)
+                reset_incomplete_textures(tile)
                 build_tile(tile)
                 _count += 1
 
-            if UI.red_flag:
-                UI.exit_message_and_bottom_line()
-                return 0
-        if do_ovl:
-            OVL.build_overlay(lat, lon)
             if UI.red_flag:
                 UI.exit_message_and_bottom_line()
                 return 0
@@ -293,6 +596,7 @@ def build_tile_list(
     UI.lvprint(
         0, "Batch process completed in", UI.nicer_timer(time.time() - timer)
     )
+    HTTP.print_statistics(1)
     if IMG.incomplete_imgs:
         UI.lvprint(
             0,
@@ -326,29 +630,31 @@ def remove_unwanted_textures(tile):
             except:
                 pass
 
-def delete_incomplete_imgs(errors):
-    """Delete orthophoto jpegs and dds that have white squares."""
-    for file_name_list in errors.values():
-        for file_name in file_name_list:
-            # Delete the orthophoto jpegs with white squares
-            for root, _, files in os.walk(FNAMES.Imagery_dir):
-                if file_name in files:
-                    file_path = os.path.join(root, file_name)
-                    os.remove(file_path)
-                    UI.lvprint(1, f"Deleted: {file_name}")
-                    # # Remove from errors which is the IMG.incomplete_imgs dictionary
-                    UI.lvprint(1, file_name_list)
-                    # file_name_list.remove(file_name)
-
-            # Delete the tile dds textures with white squares
-            # file_name has .jpg extension, so create a variable for .dds extension as well
-            base_name, _ = os.path.splitext(file_name)
-            file_name_dds = f"{base_name}.dds"
-
-            for root, _, files in os.walk(FNAMES.Tile_dir):
-                if file_name_dds in files:
-                    file_path = os.path.join(root, file_name_dds)
-                    os.remove(file_path)
-                    UI.lvprint(1, f"Deleted: {file_name_dds}")
-    
-    IMG.incomplete_imgs = {}
+def reset_incomplete_textures(tile):
+    """Delete the dds textures of the tile that have white squares.
+
+    Their orthophotos are kept, the next build of the tile converts these
+    textures again after asking only for the missing parts of them (see
+    IMG.repair_jpeg_ortho).
+    """
+    with IMG.incomplete_imgs_lock:
+        file_names = IMG.incomplete_imgs.pop(
+            FNAMES.short_latlon(tile.lat, tile.lon), []
+        )
+    for file_name in file_names:
+        file_name_dds = os.path.splitext(file_name)[0] + ".dds"
+        try:
+            os.remove(os.path.join(tile.build_dir, "textures", file_name_dds))
+            UI.lvprint(1, f"Deleted: {file_name_dds}")
+        except:
+            pass
+
+
+################################################################################
+
+################################################################################
+def shutdown():
+    # called when Ortho4XP exits, closes what is kept open between builds
+    AIO.shutdown()
+    HTTP.close_sessions()
+    DDS.shutdown()
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+DDS encoder tests for Ortho4XPDark
+==================================
+
+Checks the built-in DXT1/DXT5 encoder : headers and mipmap chain, quality
+of the decoded colors, exact alpha, and its use by convert_texture in place
+of nvcompress, from threads or from a pool of conversion processes.
+
+Author: Ortho4XPDark Team
+"""
+
+import io
+import os
+import queue
+import struct
+import sys
+import types
+from pathlib import Path
+
+import numpy
+import pytest
+
+# Add src directory to path for imports
+current_dir = Path(__file__).parent
+src_dir = current_dir / "src"
+sys.path.insert(0, str(src_dir))
+
+from PIL import Image, ImageFilter
+
+import O4_DDS_Utils as DDS
+import O4_File_Names as FNAMES
+import O4_Imagery_Utils as IMG
+import O4_Tile_Utils as TILE
+import O4_UI_Utils as UI
+
+
+def synthetic_texture(size=256, seed=0):
+    """Smooth random colors, closer to an orthophoto than pure noise."""
+    rng = numpy.random.default_rng(seed)
+    noise = rng.integers(0, 256, (size // 16, size // 16, 3), dtype=numpy.uint8)
+    return (
+        Image.fromarray(noise)
+        .resize((size, size), Image.BICUBIC)
+        .filter(ImageFilter.GaussianBlur(2))
+    )
+
+
+def psnr(a, b):
+    error = (
+        (numpy.asarray(a, dtype=float) - numpy.asarray(b, dtype=float)) ** 2
+    ).mean()
+    return 10 * numpy.log10(255 ** 2 / max(error, 1e-9))
+
+
+@pytest.fixture(autouse=True)
+def in_process(monkeypatch):
+    # a process pool per test run is slow to start, encode in this process
+    monkeypatch.setattr(DDS, "nbr_workers", 1)
+
+
+@pytest.mark.parametrize("dxt5", [False, True])
+def test_header_and_mipmaps(dxt5):
+    data = DDS.encode(synthetic_texture(256), dxt5)
+    (magic, size, flags, height, width) = struct.unpack("<4s4I", data[:20])
+    assert (magic, size, height, width) == (b"DDS ", 124, 256, 256)
+    assert struct.unpack("<I", data[28:32])[0] == 9
+    assert data[84:88] == (b"DXT5" if dxt5 else b"DXT1")
+    block_size = 16 if dxt5 else 8
+    blocks = sum(max(1, (256 >> k) // 4) ** 2 for k in range(9))
+    assert len(data) == 128 + block_size * blocks
+
+
+def test_dxt1_quality():
+    im = synthetic_texture(512)
+    decoded = Image.open(io.BytesIO(DDS.encode(im))).convert("RGB")
+    assert decoded.size == im.size
+    assert psnr(decoded, im) > 32
+
+
+def test_flat_blocks_are_exact():
+    im = Image.new("RGB", (64, 64), (8, 130, 255))
+    decoded = Image.open(io.BytesIO(DDS.encode(im))).convert("RGB")
+    # 565 quantization of the single color
+    assert (numpy.asarray(decoded) == (8, 130, 255)).all()
+
+
+def test_dxt5_alpha():
+    im = synthetic_texture(256)
+    rng = numpy.random.default_rng(1)
+    # masks are mostly opaque or transparent with short transitions
+    alpha = numpy.where(rng.random((16, 16)) > 0.5, 255, 0).astype(numpy.uint8)
+    alpha = Image.fromarray(alpha).resize((256, 256), Image.NEAREST)
+    im.putalpha(alpha)
+    decoded = Image.open(io.BytesIO(DDS.encode(im, dxt5=True)))
+    assert decoded.mode == "RGBA"
+    assert decoded.getchannel("A").tobytes() == alpha.tobytes()
+    assert psnr(decoded.convert("RGB"), im.convert("RGB")) > 32
+
+
+def test_broken_pool_is_replaced(monkeypatch):
+    monkeypatch.setattr(DDS, "nbr_workers", 2)
+    im = synthetic_texture(64)
+    executor = DDS.get_pool()
+    try:
+        # a worker which dies breaks the pool
+        with pytest.raises(DDS.BrokenProcessPool):
+            executor.submit(os._exit, 1).result()
+        data = DDS.encode(im)
+        assert DDS.pool is None
+        monkeypatch.setattr(DDS, "nbr_workers", 1)
+        assert data == DDS.encode(im)
+        monkeypatch.setattr(DDS, "nbr_workers", 2)
+        assert DDS.get_pool() not in (None, executor)
+        assert DDS.encode(im) == data
+    finally:
+        DDS.shutdown()
+    assert DDS.pool is None
+
+
+def test_only_pool_errors_fall_back(monkeypatch, capsys):
+    im = synthetic_texture(64)
+    expected = DDS.encode(im)
+    monkeypatch.setattr(DDS, "get_pool", lambda: object())
+    monkeypatch.setattr(DDS, "pool_error_shown", False)
+
+    def no_shared_memory(executor, levels):
+        raise PermissionError("/dev/shm is read only")
+
+    monkeypatch.setattr(DDS, "encode_in_pool", no_shared_memory)
+    assert DDS.encode(im) == DDS.encode(im) == expected
+    # said once
+    assert capsys.readouterr().out.count("/dev/shm is read only") == 1
+
+    def encoder_bug(executor, levels):
+        raise ValueError("encoder bug")
+
+    monkeypatch.setattr(DDS, "encode_in_pool", encoder_bug)
+    with pytest.raises(ValueError):
+        DDS.encode(im)
+
+
+@pytest.fixture
+def texture_setup(tmp_path, monkeypatch):
+    monkeypatch.setattr(IMG, "dds_encoder", "numpy")
+    # missing orthophotos are logged to Ortho4XP.log, in the working directory
+    monkeypatch.setattr(UI, "logprint", lambda *args: None)
+    monkeypatch.setattr(FNAMES, "Imagery_dir", str(tmp_path / "Imagery"))
+    provider = {
+        "code": "DDSTEST",
+        "imagery_dir": "normal",
+        "color_filters": "none",
+    }
+    monkeypatch.setitem(IMG.providers_dict, "DDSTEST", provider)
+    tile = types.SimpleNamespace(
+        lat=45, lon=6, build_dir=str(tmp_path), imprint_masks_to_dds=False
+    )
+    os.makedirs(tmp_path / "textures")
+    file_dir = FNAMES.jpeg_file_dir_from_attributes(45, 6, 16, provider)
+    os.makedirs(file_dir)
+    return (tile, file_dir)
+
+
+def save_ortho(file_dir, til_x_left, size=4096):
+    im = synthetic_texture(size, seed=til_x_left)
+    im.save(
+        os.path.join(
+            file_dir,
+            FNAMES.jpeg_file_name_from_attributes(
+                til_x_left, 22000, 16, "DDSTEST"
+            ),
+        ),
+        quality=95,
+    )
+    return im
+
+
+def test_convert_texture_in_memory(texture_setup, tmp_path):
+    (tile, file_dir) = texture_setup
+    im = save_ortho(file_dir, 34000)
+    IMG.convert_texture(tile, 34000, 22000, 16, "DDSTEST")
+    dds_file = tmp_path / "textures" / FNAMES.dds_file_name_from_attributes(
+        34000, 22000, 16, "DDSTEST"
+    )
+    decoded = Image.open(dds_file).convert("RGB")
+    assert decoded.size == (4096, 4096)
+    assert psnr(decoded, im) > 30
+    assert os.listdir(tmp_path / "textures") == [dds_file.name]
+
+
+def test_convert_in_processes(texture_setup, tmp_path, monkeypatch):
+    (tile, file_dir) = texture_setup
+    monkeypatch.setattr(IMG, "incomplete_imgs", {})
+    monkeypatch.setattr(TILE, "max_convert_slots", 2)
+    images = {
+        til_x_left: save_ortho(file_dir, til_x_left, 1024)
+        for til_x_left in (34000, 34016)
+    }
+    convert_queue = queue.Queue()
+    # the third orthophoto is missing, its failure comes back to this process
+    for til_x_left in (34000, 34016, 34032):
+        convert_queue.put((tile, til_x_left, 22000, 16, "DDSTEST"))
+    convert_queue.put("quit")
+    progress = {"done": 0, "bar": 3}
+    assert TILE.convert_textures_in_processes(convert_queue, progress)
+    assert progress["done"] == 3
+    for (til_x_left, im) in images.items():
+        decoded = Image.open(
+            tmp_path
+            / "textures"
+            / FNAMES.dds_file_name_from_attributes(
+                til_x_left, 22000, 16, "DDSTEST"
+            )
+        ).convert("RGB")
+        assert psnr(decoded, im) > 30
+    assert IMG.incomplete_imgs == {
+        FNAMES.short_latlon(45, 6): [
+            FNAMES.jpeg_file_name_from_attributes(34032, 22000, 16, "DDSTEST")
+        ]
+    }
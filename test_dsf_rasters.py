@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Global Scenery rasters tests for Ortho4XPDark
+=============================================
+
+Extracts the elevation and bathymetry rasters of a synthetic Global
+Scenery DSF, and checks that later builds read them back from the cache
+until that DSF changes.
+
+Author: Ortho4XPDark Team
+"""
+
+import os
+import shutil
+import struct
+import sys
+from pathlib import Path
+
+import numpy
+import pytest
+
+# Add src directory to path for imports
+current_dir = Path(__file__).parent
+src_dir = current_dir / "src"
+sys.path.insert(0, str(src_dir))
+
+import O4_DSF_Utils as DSF
+import O4_File_Names as FNAMES
+import O4_Overlay_Utils as OVL
+
+LAT, LON = 45, 6
+
+
+def atom(tag, data):
+    return struct.pack("<4sI", tag, 8 + len(data)) + data
+
+
+def global_scenery_dsf(elevation, bathymetry):
+    """An uncompressed DSF with the atoms we read: DEMN in DEFN, and the
+    DEMI/DEMD pairs in DEMS."""
+    defn = atom(b"TRET", b"terrain_Water\0") + atom(b"NMED", b"elev\0bathy\0")
+    dems = b""
+    for raster in (elevation, bathymetry):
+        dems += atom(b"IMED", struct.pack("<BBHII", 1, 2, 0, 4, 4))
+        dems += atom(b"DMED", raster.astype("<i2").tobytes())
+    data = (
+        b"XPLNEDSF"
+        + struct.pack("<I", 1)
+        + atom(b"DAEH", atom(b"PORP", b"sim/west\0" + b"6\0"))
+        + atom(b"NFED", defn)
+        + atom(b"SMED", dems)
+    )
+    return data + bytes(16)
+
+
+@pytest.fixture
+def gs_dir(tmp_path, monkeypatch):
+    rng = numpy.random.default_rng(0)
+    (elevation, bathymetry) = rng.integers(-100, 1000, (2, 64, 64))
+    gs_dir = tmp_path / "Global Scenery"
+    os.makedirs(gs_dir / "Earth nav data" / FNAMES.round_latlon(LAT, LON))
+    dsf_file = gs_dir / "Earth nav data" / (FNAMES.long_latlon(LAT, LON) + ".dsf")
+    dsf_file.write_bytes(global_scenery_dsf(elevation, bathymetry))
+    os.makedirs(tmp_path / "tmp")
+    monkeypatch.setattr(FNAMES, "Tmp_dir", str(tmp_path / "tmp"))
+    monkeypatch.setattr(FNAMES, "Cache_dir", str(tmp_path / "Cache"))
+    monkeypatch.setattr(OVL, "custom_overlay_src", str(gs_dir))
+    monkeypatch.setattr(DSF, "cache_gs_rasters", True)
+    return (dsf_file, elevation, bathymetry)
+
+
+def test_rasters_are_extracted_then_cached(gs_dir, monkeypatch):
+    (dsf_file, elevation, bathymetry) = gs_dir
+    (bDEMN, bDEMS) = DSF.extract_elevation_and_bathymetry_data(LAT, LON)
+    assert bDEMN == b"elev\0bathy\0"
+    # bathymetry is kept 2m below the elevation
+    rasters = [
+        numpy.frombuffer(bDEMS[offset : offset + 8192], dtype="<i2")
+        for offset in (28, 28 + 8192 + 28)
+    ]
+    assert numpy.array_equal(rasters[0], elevation.ravel())
+    assert numpy.array_equal(
+        rasters[1], numpy.minimum(bathymetry, elevation - 2).ravel()
+    )
+    # the next builds neither copy nor parse the DSF
+    copy = shutil.copy
+    monkeypatch.setattr(shutil, "copy", None)
+    assert DSF.extract_elevation_and_bathymetry_data(LAT, LON) == (
+        bDEMN,
+        bDEMS,
+    )
+    # until it changes
+    monkeypatch.setattr(shutil, "copy", copy)
+    dsf_file.write_bytes(global_scenery_dsf(elevation + 1, bathymetry))
+    os.utime(dsf_file, ns=(0, os.stat(dsf_file).st_mtime_ns + 10 ** 9))
+    (_, bDEMS) = DSF.extract_elevation_and_bathymetry_data(LAT, LON)
+    assert numpy.array_equal(
+        numpy.frombuffer(bDEMS[28:8220], dtype="<i2"), elevation.ravel() + 1
+    )
+
+
+def test_interrupted_cache_is_not_used(gs_dir, monkeypatch):
+    (dsf_file, elevation, bathymetry) = gs_dir
+    expected = DSF.extract_elevation_and_bathymetry_data(LAT, LON)
+    cache_dir = DSF.raster_cache_dir(LAT, LON)
+    os.remove(os.path.join(cache_dir, "DEMS_1.npy"))
+    assert DSF.read_cached_rasters(LAT, LON, str(dsf_file)) is None
+    assert DSF.extract_elevation_and_bathymetry_data(LAT, LON) == expected
+    assert DSF.read_cached_rasters(LAT, LON, str(dsf_file)) == expected
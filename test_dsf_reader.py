@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+DSF reader tests for Ortho4XPDark
+=================================
+
+Reads back the pools, patches, rasters and statistics of the DSFs written
+by write_dsf, and checks the triangle strips and fans it turns into
+triangles.
+
+Author: Ortho4XPDark Team
+"""
+
+import struct
+import sys
+from pathlib import Path
+
+import numpy
+import pytest
+
+# Add src directory to path for imports
+current_dir = Path(__file__).parent
+src_dir = current_dir / "src"
+sys.path.insert(0, str(src_dir))
+
+import O4_DSF_Reader as DSFR
+import O4_DSF_Utils as DSF
+from test_dsf_texturing import synthetic_dsf
+
+
+@pytest.fixture(params=["raw", "smallest"])
+def written_dsf(tmp_path, monkeypatch, request):
+    monkeypatch.setattr(DSF, "pool_encoding", request.param)
+    arguments = list(synthetic_dsf(20000, seed=3))
+    # no pools but ours
+    arguments[-1] = 0
+    assert DSF.write_dsf(str(tmp_path / "test.dsf"), *arguments)
+    return (str(tmp_path / "test.dsf.tmp"), arguments)
+
+
+@pytest.mark.parametrize("use_mmap", [True, False])
+def test_pools_and_rasters_read_back(written_dsf, use_mmap):
+    (dsf_file, arguments) = written_dsf
+    (tile, atoms, dsf_pools, dsf_pool_length, dsf_pool_plane, pool_param) = (
+        arguments[:6]
+    )
+    used = numpy.flatnonzero(dsf_pool_length)
+    with DSFR.DSF_Reader(dsf_file, use_mmap) as dsf:
+        assert dsf.check_md5()
+        assert dsf.properties() == {"sim/west": "-10", "sim/south": "45"}
+        assert len(dsf.terrains()) == len(arguments[6])
+        assert [atom.id for atom in dsf.atoms()] == [
+            "HEAD",
+            "DEFN",
+            "GEOD",
+            "CMDS",
+            "DEMS",
+        ]
+        assert dsf.nbr_pools() == len(used)
+        assert dsf.nbr_pools(bits=32) == 0
+        for (i, k) in enumerate(used):
+            planes = numpy.frombuffer(dsf_pools[k], numpy.uint16).reshape(
+                -1, dsf_pool_plane[k]
+            )
+            assert numpy.array_equal(dsf.pool(i), planes.T)
+            params = numpy.array(pool_param[k % len(pool_param)], numpy.float32)
+            scale = dsf.scale(i)
+            assert numpy.array_equal(
+                scale.ravel(), params[: 2 * dsf_pool_plane[k]]
+            )
+            assert numpy.allclose(
+                dsf.pool_coordinates(i)[:, 0],
+                planes[0] / 65535 * scale[:, 0] + scale[:, 1],
+            )
+        ((header, values),) = dsf.rasters()
+        assert (header["width"], header["height"], header["bpp"]) == (31, 21, 2)
+        assert values.dtype == numpy.int16
+        assert values.tobytes() == atoms["DEMS"][-values.nbytes :]
+
+
+def test_patches_and_statistics(written_dsf):
+    (dsf_file, arguments) = written_dsf
+    (textured_tris, overlay_terrains) = arguments[6:8]
+    dsf_pool_length = arguments[3]
+    # position in the DSF of the pools written
+    new_pool = numpy.cumsum(dsf_pool_length != 0) - 1
+    with DSFR.DSF_Reader(dsf_file) as dsf:
+        patches = list(dsf.patches())
+        statistics = dsf.statistics()
+    expected = []
+    for terrain_idx in textured_tris:
+        for (pool, tris) in textured_tris[terrain_idx].items():
+            tris = numpy.frombuffer(tris, numpy.uint16).astype(numpy.int64)
+            if pool == "cross-pool":
+                vertices = tris.reshape(-1, 2).copy()
+                vertices[:, 0] = new_pool[vertices[:, 0]]
+            else:
+                vertices = numpy.stack(
+                    (numpy.full(len(tris), new_pool[pool]), tris), axis=1
+                )
+            expected.append((terrain_idx, vertices.reshape(-1, 3, 2)))
+    assert len(patches) == len(expected) == statistics["nbr_patches"]
+    for (patch, (terrain_idx, triangles)) in zip(patches, expected):
+        assert patch.terrain == terrain_idx
+        if terrain_idx in overlay_terrains:
+            assert (patch.flags, patch.far) == (2, 25000)
+        else:
+            assert (patch.flags, patch.far) == (1, -1)
+        assert numpy.array_equal(patch.triangles, triangles)
+    assert statistics["nbr_triangles"] == sum(
+        len(triangles) for (_, triangles) in expected
+    )
+    assert statistics["triangles"]["terrain/0.ter"] == sum(
+        len(triangles) for (idx, triangles) in expected if idx == 0
+    )
+    assert statistics["pool_fill"] == [
+        length / 65536 for length in dsf_pool_length if length
+    ]
+
+
+def test_strips_and_fans():
+    vertices = numpy.stack((numpy.zeros(5, int), numpy.arange(5)), axis=1)
+    strip = DSFR.triangles_of(26, vertices)[:, :, 1]
+    assert strip.tolist() == [[0, 1, 2], [1, 3, 2], [2, 3, 4]]
+    fan = DSFR.triangles_of(29, vertices)[:, :, 1]
+    assert fan.tolist() == [[0, 1, 2], [0, 2, 3], [0, 3, 4]]
+    assert DSFR.triangles_of(29, vertices[:2]).shape == (0, 3, 2)
+
+
+def test_corrupted_files_are_refused(tmp_path):
+    dsf_file = tmp_path / "bad.dsf"
+    dsf_file.write_bytes(b"7z\xbc\xaf\x27\x1c" + bytes(40))
+    with pytest.raises(ValueError):
+        DSFR.DSF_Reader(str(dsf_file))
+    # an atom size smaller than its header
+    dsf_file.write_bytes(
+        b"XPLNEDSF" + struct.pack("<I4sI", 1, b"DAEH", 4) + bytes(16)
+    )
+    with DSFR.DSF_Reader(str(dsf_file)) as dsf:
+        with pytest.raises(ValueError):
+            dsf.atoms()
@@ -0,0 +1,475 @@
+#!/usr/bin/env python3
+"""
+DSF texturing tests for Ortho4XPDark
+====================================
+
+Builds the DSF of synthetic meshes with both texturing engines (the
+triangle by triangle loop and its numpy version) and checks that they
+write the very same file, queue the same textures and create the same
+terrains. Also checks the point pools quadtree, and that the bulk DSF
+writer writes what the former value by value one did.
+
+Author: Ortho4XPDark Team
+"""
+
+import array
+import hashlib
+import os
+import queue
+import struct
+import sys
+import types
+from pathlib import Path
+
+import numpy
+import pytest
+
+# Add src directory to path for imports
+current_dir = Path(__file__).parent
+src_dir = current_dir / "src"
+sys.path.insert(0, str(src_dir))
+
+from PIL import Image
+
+import O4_Bathymetry as BATHY
+import O4_DSF_Reader as DSFR
+import O4_DSF_Utils as DSF
+import O4_File_Names as FNAMES
+import O4_Geo_Utils as GEO
+import O4_Mask_Utils as MASK
+import O4_Mesh_Utils as MESH
+
+LAT, LON = 45, 6
+
+
+class LegacyWriter(DSF.DSF_Writer):
+    """The former writer : one struct.pack per value, and the md5 of the
+    file read back once it is written."""
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.f = open(file_name, "wb")
+
+    def write(self, data):
+        self.f.write(data)
+
+    def pool_atom(self, planes, encodings):
+        (nbr_planes, length) = planes.shape
+        pool = planes.T.ravel()
+        self.f.write(b"LOOP")
+        self.f.write(
+            struct.pack("<I", 13 + nbr_planes + 2 * nbr_planes * length)
+        )
+        self.f.write(struct.pack("<I", length))
+        self.f.write(struct.pack("<B", nbr_planes))
+        for l in range(nbr_planes):
+            self.f.write(struct.pack("<B", 0))
+            for m in range(length):
+                self.f.write(struct.pack("<H", pool[nbr_planes * m + l]))
+
+    def scal_atom(self, params, nbr_planes):
+        self.f.write(b"LACS")
+        self.f.write(struct.pack("<I", 8 + 8 * nbr_planes))
+        for l in range(2 * nbr_planes):
+            self.f.write(struct.pack("<f", params[l]))
+
+    def patch_triangles(self, command, coords, width):
+        nbr_coords = len(coords) // width
+        for j in range(0, nbr_coords, 255):
+            count = min(255, nbr_coords - j)
+            self.f.write(struct.pack("<B", command))
+            self.f.write(struct.pack("<B", count))
+            for k in range(width * j, width * (j + count)):
+                self.f.write(struct.pack("<H", coords[k]))
+
+    def close(self):
+        self.f.close()
+        with open(self.file_name, "rb") as f:
+            md5sum = hashlib.md5(f.read()).digest()
+        with open(self.file_name, "ab") as f:
+            f.write(md5sum)
+
+
+def synthetic_dsf(nbr_tris, seed=0):
+    """write_dsf arguments (but the file name) for random pools and
+    patches holding about nbr_tris triangles."""
+    rng = numpy.random.default_rng(seed)
+    pool_nbr = nbr_tris // 20000 + 2
+    dsf_pool_plane = numpy.array([7] * pool_nbr + [9] * pool_nbr + [7] * pool_nbr)
+    dsf_pool_length = rng.integers(1, 20000, 3 * pool_nbr)
+    # a few pools left empty
+    dsf_pool_length[rng.random(3 * pool_nbr) < 0.2] = 0
+    dsf_pools = {}
+    for (k, (length, planes)) in enumerate(zip(dsf_pool_length, dsf_pool_plane)):
+        dsf_pools[k] = array.array("H")
+        dsf_pools[k].frombytes(
+            rng.integers(0, 65536, length * planes, dtype=numpy.uint16).tobytes()
+        )
+    pool_param = [tuple(rng.uniform(-10, 10, 18).tolist()) for _ in range(pool_nbr)]
+    used = numpy.flatnonzero(dsf_pool_length)
+    textured_tris = {}
+    nbr_terrains = nbr_tris // 50000 + 5
+    for terrain_idx in range(nbr_terrains):
+        textured_tris[terrain_idx] = {}
+        for pool in rng.choice(used, min(len(used), 3), replace=False).tolist():
+            size = 3 * int(rng.integers(1, 2 * nbr_tris // (3 * nbr_terrains) + 2))
+            textured_tris[terrain_idx][pool] = array.array(
+                "H",
+                rng.integers(0, dsf_pool_length[pool], size, dtype=numpy.uint16)
+                .tobytes(),
+            )
+        pools = rng.choice(used, 3 * int(rng.integers(1, 400)))
+        cross = numpy.empty(2 * len(pools), dtype=numpy.uint16)
+        cross[0::2] = pools
+        cross[1::2] = rng.integers(0, dsf_pool_length[pools])
+        textured_tris[terrain_idx]["cross-pool"] = array.array(
+            "H", cross.tobytes()
+        )
+    textured_tris[nbr_terrains] = {}
+    atoms = {name: b"" for name in ("OBJT", "POLY", "NETW", "DEMN", "GEOD")}
+    atoms["PROP"] = b"sim/west\x00-10\x00sim/south\x0045\x00"
+    atoms["TERT"] = b"".join(
+        b"terrain/" + str(k).encode() + b".ter\x00"
+        for k in range(nbr_terrains + 1)
+    )
+    # a 16 bits signed elevation raster
+    raster = rng.integers(-500, 5000, (21, 31), dtype=numpy.int16)
+    atoms["DEMS"] = (
+        struct.pack("<4sIBBHIIff", b"IMED", 28, 1, 2, 1, 31, 21, 1.0, 0.0)
+        + struct.pack("<4sI", b"DMED", 8 + raster.nbytes)
+        + raster.astype("<i2").tobytes()
+    )
+    atoms["CMDS"] = b""
+    return (
+        types.SimpleNamespace(overlay_lod=25000),
+        atoms,
+        dsf_pools,
+        dsf_pool_length,
+        dsf_pool_plane,
+        pool_param,
+        textured_tris,
+        set(range(0, nbr_terrains, 3)),
+        2,
+    )
+
+
+def synthetic_mesh(size=41, seed=0):
+    """A jittered grid over the tile with sea, a lake, land, and a few
+    slivers whose vertices snap to the same pool point."""
+    rng = numpy.random.default_rng(seed)
+    (x, y) = numpy.meshgrid(
+        numpy.linspace(0, 1, size), numpy.linspace(0, 1, size)
+    )
+    jitter = rng.uniform(-0.3, 0.3, (2, size, size)) / (size - 1)
+    jitter[:, [0, -1], :] = 0
+    jitter[:, :, [0, -1]] = 0
+    lons = (LON + x + jitter[0]).ravel()
+    lats = (LAT + y + jitter[1]).ravel()
+    tris = []
+    for j in range(size - 1):
+        for i in range(size - 1):
+            a = j * size + i
+            tris += [(a, a + 1, a + size + 1), (a, a + size + 1, a + size)]
+    # twins of a few nodes, 1e-8 degree away
+    twinned = rng.choice(len(lons) - 1, 12, replace=False)
+    for (k, a) in enumerate(twinned):
+        tris.append((int(a), len(lons) + k, int(a) + 1))
+    lons = numpy.concatenate((lons, lons[twinned] + 1e-8))
+    lats = numpy.concatenate((lats, lats[twinned]))
+    nbr_nodes = len(lons)
+    node_coords = numpy.zeros(5 * nbr_nodes)
+    node_coords[0::5] = lons
+    node_coords[1::5] = lats
+    node_coords[2::5] = rng.uniform(0, 900, nbr_nodes)
+    node_coords[3::5] = rng.uniform(-0.2, 0.2, nbr_nodes)
+    node_coords[4::5] = rng.uniform(-0.2, 0.2, nbr_nodes)
+    tri_idx = numpy.array(tris, dtype=numpy.uint32).ravel()
+    # sea in the south west corner, a lake, and some random water
+    centers = node_coords[0::5][tri_idx].reshape(-1, 3).mean(axis=1) - LON
+    middles = node_coords[1::5][tri_idx].reshape(-1, 3).mean(axis=1) - LAT
+    tri_types = numpy.zeros(len(tris), dtype=numpy.uint32)
+    tri_types[centers + middles < 0.7] = 4
+    tri_types[(centers - 0.7) ** 2 + (middles - 0.6) ** 2 < 0.03] = 1
+    tri_types[rng.random(len(tris)) < 0.02] = 2
+    return (1.3, nbr_nodes, node_coords, len(tris), tri_idx, tri_types)
+
+
+def make_tile(build_dir, water_tech, imprint_masks_to_dds):
+    os.makedirs(
+        os.path.join(build_dir, "Earth nav data", FNAMES.round_latlon(LAT, LON))
+    )
+    os.makedirs(os.path.join(build_dir, "textures"))
+    return types.SimpleNamespace(
+        lat=LAT,
+        lon=LON,
+        build_dir=build_dir,
+        mesh_zl=19,
+        default_zl=16,
+        default_website="BI",
+        # a ZL17 zone over part of the tile
+        zone_list=[
+            (
+                [
+                    LAT + 0.3,
+                    LON + 0.3,
+                    LAT + 0.3,
+                    LON + 0.7,
+                    LAT + 0.7,
+                    LON + 0.7,
+                    LAT + 0.7,
+                    LON + 0.3,
+                    LAT + 0.3,
+                    LON + 0.3,
+                ],
+                17,
+                "GO2",
+            )
+        ],
+        cover_airports_with_highres="False",
+        cover_zl=18,
+        cover_extent=1,
+        use_masks_for_inland=False,
+        water_tech=water_tech,
+        imprint_masks_to_dds=imprint_masks_to_dds,
+        normal_map_strength=0.3,
+        ratio_water=0.2,
+        ratio_bathy=0.7,
+        overlay_lod=25000,
+        mask_zl=14,
+        use_decal_on_terrain=False,
+        terrain_casts_shadows=True,
+    )
+
+
+@pytest.fixture
+def synthetic_tile(tmp_path, monkeypatch):
+    mesh = synthetic_mesh()
+    # the transition texture copied along the inland water terrains
+    os.makedirs(tmp_path / "Utils")
+    Image.new("RGBA", (4, 4)).save(tmp_path / "Utils" / "water_transition.png")
+    monkeypatch.setattr(FNAMES, "Utils_dir", str(tmp_path / "Utils"))
+    monkeypatch.setattr(
+        MESH,
+        "read_mesh_file",
+        lambda mesh_file: tuple(
+            x.copy() if isinstance(x, numpy.ndarray) else x for x in mesh
+        ),
+    )
+    monkeypatch.setattr(
+        BATHY,
+        "compute_depth_ratio_bounds_from_masks",
+        lambda nbr_nodes, node_coords, node_types, tile: numpy.random.default_rng(
+            1
+        ).integers(0, 256, nbr_nodes, dtype=numpy.uint8),
+    )
+    # every other texture column has a sea mask
+    monkeypatch.setattr(
+        MASK,
+        "needs_mask",
+        lambda tile, til_x_left, *args: (til_x_left // 16) % 2
+        and Image.new("L", (64, 64), 128),
+    )
+    monkeypatch.setattr(
+        DSF, "extract_elevation_and_bathymetry_data", lambda lat, lon: (b"", b"")
+    )
+
+
+def build(tmp_path, engine, water_tech, imprint_masks_to_dds, monkeypatch):
+    monkeypatch.setattr(DSF, "texturing_engine", engine)
+    build_dir = str(tmp_path / engine)
+    tile = make_tile(build_dir, water_tech, imprint_masks_to_dds)
+    download_queue = queue.Queue()
+    assert DSF.build_dsf(tile, download_queue)
+    queued = [download_queue.get() for _ in range(download_queue.qsize())]
+    dsf_file = os.path.join(
+        build_dir,
+        "Earth nav data",
+        FNAMES.long_latlon(LAT, LON) + ".dsf.tmp",
+    )
+    with open(dsf_file, "rb") as f:
+        data = f.read()
+    terrains = {}
+    for name in sorted(os.listdir(os.path.join(build_dir, "terrain"))):
+        with open(os.path.join(build_dir, "terrain", name)) as f:
+            terrains[name] = f.read()
+    return (data, queued, terrains, sorted(os.listdir(build_dir + "/textures")))
+
+
+@pytest.mark.parametrize(
+    "water_tech, imprint_masks_to_dds",
+    [("XP12", True), ("XP12", False), ("XP11 + bathy", True)],
+)
+def test_numpy_texturing_writes_the_same_dsf(
+    synthetic_tile, tmp_path, monkeypatch, water_tech, imprint_masks_to_dds
+):
+    (data, queued, terrains, textures) = build(
+        tmp_path, "python", water_tech, imprint_masks_to_dds, monkeypatch
+    )
+    # the mesh does cover land, lakes, masked and unmasked sea
+    assert any(name.endswith("_water_overlay.ter") for name in terrains)
+    assert any("_sea" in name for name in terrains)
+    assert any(name.endswith("_GO217.ter") for name in terrains)
+    assert queued[-1] == "quit"
+    assert (data, queued, terrains, textures) == build(
+        tmp_path, "numpy", water_tech, imprint_masks_to_dds, monkeypatch
+    )
+
+
+def test_vectorized_geo_matches_scalar():
+    rng = numpy.random.default_rng(2)
+    # random points and points right on the cell borders
+    (til_x, til_y) = (
+        rng.integers(34000, 34200, 500) // 16 * 16,
+        rng.integers(22000, 22200, 500) // 16 * 16,
+    )
+    borders = numpy.array(
+        [GEO.gtile_to_wgs84(x, y, 19) for (x, y) in zip(til_x, til_y)]
+    )
+    lats = numpy.concatenate((rng.uniform(44, 46, 2000), borders[:, 0]))
+    lons = numpy.concatenate((rng.uniform(5, 7, 2000), borders[:, 1]))
+    (cell_x, cell_y) = DSF.orthogrid_cells(lats, lons, 19)
+    assert list(zip(cell_x.tolist(), cell_y.tolist())) == [
+        GEO.wgs84_to_orthogrid(lat, lon, 19) for (lat, lon) in zip(lats, lons)
+    ]
+    textures = numpy.array(
+        [
+            GEO.wgs84_to_orthogrid(lat, lon, zl) + (zl,)
+            for (lat, lon, zl) in zip(lats, lons, rng.integers(14, 19, len(lats)))
+        ]
+    )
+    (s, t) = DSF.st_icoords(
+        lats, lons, textures[:, 0], textures[:, 1], textures[:, 2]
+    )
+    expected = [
+        GEO.st_coord(lat, lon, *texture, None)
+        for (lat, lon, texture) in zip(lats, lons, textures.tolist())
+    ]
+    assert s.tolist() == [int(round(x * 65535)) for (x, _) in expected]
+    assert t.tolist() == [int(round(y * 65535)) for (_, y) in expected]
+
+
+def test_pools_follow_the_quadtree():
+    rng = numpy.random.default_rng(3)
+    # uniform nodes plus a dense cluster, which needs deep cells
+    lons = numpy.concatenate((rng.random(2000), 0.3 + 1e-4 * rng.random(2000)))
+    lats = numpy.concatenate((rng.random(2000), 0.6 + 1e-5 * rng.random(2000)))
+    lons[:5] = 1
+    node_coords = numpy.zeros(5 * len(lons))
+    node_coords[0::5] = LON + lons
+    node_coords[1::5] = LAT + lats
+    node_coords[2::5] = rng.uniform(0, 3000, len(lons))
+    tile = types.SimpleNamespace(lat=LAT, lon=LON, normal_map_strength=0.3)
+    capacity = 100
+    (pool_nbr, node_pool, node_icoords, pool_param) = DSF.build_pools(
+        tile, len(lons), node_coords, capacity
+    )
+    sizes = numpy.bincount(node_pool, minlength=pool_nbr)
+    assert sizes.min() > 0 and sizes.max() <= capacity
+    # pools in Morton order, deeper ones for the cluster
+    (_, _, codes) = DSF.morton_codes(lons, lats)
+    assert numpy.all(numpy.diff(node_pool[numpy.argsort(codes)]) >= 0)
+    levels = [-numpy.log2(param[0]) for param in pool_param]
+    assert min(levels) == DSF.quad_init_level and max(levels) > 10
+    for pool in range(pool_nbr):
+        (scal_x, lon0, scal_y, lat0, scale_z, altmin) = pool_param[pool][:6]
+        level = round(-numpy.log2(scal_x))
+        nodes = numpy.flatnonzero(node_pool == pool)
+        # the nodes of a pool lie in its cell, the parent one overflowed
+        assert numpy.all(
+            (lons[nodes] + LON >= lon0) & (lons[nodes] + LON <= lon0 + scal_x)
+        )
+        assert numpy.all(
+            (lats[nodes] + LAT >= lat0) & (lats[nodes] + LAT <= lat0 + scal_y)
+        )
+        if level > DSF.quad_init_level:
+            in_parent = (
+                numpy.floor(lons / (2 * scal_x))
+                == numpy.floor((lon0 - LON) / (2 * scal_x))
+            ) & (
+                numpy.floor(lats / (2 * scal_y))
+                == numpy.floor((lat0 - LAT) / (2 * scal_y))
+            )
+            assert in_parent.sum() > capacity
+        assert altmin == numpy.floor(node_coords[2::5][nodes].min())
+        # same bits as the 24 bits strings of the former quadtree
+        for node in nodes[:20]:
+            bits = numpy.binary_repr(
+                min(int(16777216 * lons[node]), 16777215)
+            ).zfill(24)
+            assert node_icoords[5 * node] == int(bits[level : level + 16], 2)
+
+
+def test_bulk_writer_writes_the_same_dsf(tmp_path, monkeypatch):
+    # the former writer only knew raw pools
+    monkeypatch.setattr(DSF, "pool_encoding", "raw")
+    arguments = synthetic_dsf(30000)
+    assert DSF.write_dsf(str(tmp_path / "bulk.dsf"), *arguments)
+    monkeypatch.setattr(DSF, "DSF_Writer", LegacyWriter)
+    assert DSF.write_dsf(str(tmp_path / "legacy.dsf"), *arguments)
+    data = (tmp_path / "bulk.dsf.tmp").read_bytes()
+    assert data == (tmp_path / "legacy.dsf.tmp").read_bytes()
+    assert data[-16:] == hashlib.md5(data[:-16]).digest()
+
+
+def test_plane_encodings_round_trip():
+    rng = numpy.random.default_rng(4)
+    planes = [
+        numpy.zeros(0, dtype=numpy.uint16),
+        numpy.array([7], dtype=numpy.uint16),
+        numpy.array([7, 7], dtype=numpy.uint16),
+        numpy.full(1000, 65535, dtype=numpy.uint16),
+        rng.integers(0, 65536, 1000, dtype=numpy.uint16),
+        numpy.sort(rng.integers(0, 65536, 1000, dtype=numpy.uint16)),
+        numpy.arange(0, 3000, 3, dtype=numpy.uint16),
+        numpy.repeat(rng.integers(0, 4, 300), rng.integers(1, 300, 300)).astype(
+            numpy.uint16
+        ),
+    ]
+    for values in planes:
+        sizes = {}
+        for encoding in range(4):
+            data = bytes([encoding]) + DSF.encode_plane(values, encoding).tobytes()
+            sizes[encoding] = len(data) - 1
+            (decoded, offset) = DSFR.decode_plane(b"xx" + data + b"yy", 2, len(values))
+            assert offset == len(data) + 2
+            assert decoded.dtype == numpy.uint16
+            assert numpy.array_equal(decoded, values)
+        assert DSF.plane_encoding(values)[1] == min(sizes.values())
+        assert sizes[DSF.plane_encoding(values)[0]] == min(sizes.values())
+    # runs and ramps are where it pays
+    assert DSF.plane_encoding(planes[3]) == (2, 24)
+    assert DSF.plane_encoding(planes[6])[0] == 3
+    assert DSF.plane_encoding(planes[4])[0] == 0
+
+
+def read_pools(build_dir):
+    """The decoded planes of the POOL atoms of the DSF built in build_dir."""
+    dsf_file = os.path.join(
+        build_dir,
+        "numpy",
+        "Earth nav data",
+        FNAMES.long_latlon(LAT, LON) + ".dsf.tmp",
+    )
+    with DSFR.DSF_Reader(dsf_file) as dsf:
+        return [dsf.pool(i).copy() for i in range(dsf.nbr_pools())]
+
+
+@pytest.mark.parametrize("water_tech", ["XP12", "XP11 + bathy"])
+def test_encoded_pools_decode_to_the_raw_ones(
+    synthetic_tile, tmp_path, monkeypatch, water_tech
+):
+    monkeypatch.setattr(DSF, "pool_encoding", "raw")
+    raw = build(tmp_path / "raw", "numpy", water_tech, True, monkeypatch)[0]
+    monkeypatch.setattr(DSF, "pool_encoding", "smallest")
+    encoded = build(tmp_path / "smallest", "numpy", water_tech, True, monkeypatch)[0]
+    assert len(encoded) < len(raw)
+    assert encoded[-16:] == hashlib.md5(encoded[:-16]).digest()
+    (raw_pools, encoded_pools) = (
+        read_pools(tmp_path / "raw"),
+        read_pools(tmp_path / "smallest"),
+    )
+    assert len(raw_pools) == len(encoded_pools)
+    for (raw_pool, encoded_pool) in zip(raw_pools, encoded_pools):
+        assert numpy.array_equal(raw_pool, encoded_pool)
+    # the rest of the file is untouched
+    assert encoded[-200:-16] == raw[-200:-16]
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Color filter tests for Ortho4XPDark
+===================================
+
+Checks that compiled color filters (point operations folded into a single
+lookup table) give the very same images as applying each filter in turn.
+
+Author: Ortho4XPDark Team
+"""
+
+import sys
+from pathlib import Path
+
+import pytest
+
+# Add src directory to path for imports
+current_dir = Path(__file__).parent
+src_dir = current_dir / "src"
+sys.path.insert(0, str(src_dir))
+
+import numpy
+from math import pi, tan
+from PIL import Image, ImageEnhance, ImageFilter
+
+import O4_Imagery_Utils as IMG
+
+
+color_filters_chains = {
+    "bc_only": [["brightness-contrast", 10, 20]],
+    "dark": [["brightness-contrast", -15, 5], ["saturation", 20]],
+    "mixed": [
+        ["brightness-contrast", 5, 10],
+        ["levels", 10, 1.2, 240, 0, 255, 5, 0.9, 250, 3, 250, 0, 1, 255, 0, 255],
+        ["saturation", -10],
+        ["brightness-contrast", -3, 4],
+        ["sharpness", 1.5],
+        ["levels", 0, 1.1, 255, 0, 255, 0, 1, 255, 0, 255, 0, 0.8, 255, 0, 255],
+        ["blur", 0.7],
+    ],
+    # the second levels divides by zero, the filters stop there
+    "broken": [
+        ["brightness-contrast", 5, 10],
+        ["levels", 0, 1, 100, 0, 255, 0, 1, 255, 0, 255, 0, 1, 255, 0, 255],
+        ["levels", 50, 1, 50, 0, 255, 0, 1, 255, 0, 255, 0, 1, 255, 0, 255],
+        ["saturation", 50],
+    ],
+}
+
+
+def legacy_color_transform(im, color_code):
+    # color_transform as it was, every filter applied in turn
+    try:
+        for color_filter in IMG.color_filters_dict[color_code]:
+            # both range from -127 to 127,
+            # http://gimp.sourcearchive.com/documentation/2.6.1/\
+            # gimpbrightnesscontrastconfig_8c-source.html
+            if color_filter[0] == "brightness-contrast":
+                (brightness, contrast) = color_filter[1:3]
+                if brightness >= 0:
+                    im = im.point(
+                        lambda i: 128
+                        + tan(pi / 4 * (1 + contrast / 128))
+                        * (brightness + (255 - brightness) / 255 * i - 128)
+                    )
+                else:
+                    im = im.point(
+                        lambda i: 128
+                        + tan(pi / 4 * (1 + contrast / 128))
+                        * ((255 + brightness) / 255 * i - 128)
+                    )
+            elif color_filter[0] == "saturation":
+                saturation = color_filter[1]
+                im = ImageEnhance.Color(im).enhance(1 + saturation / 100)
+            elif color_filter[0] == "sharpness":
+                im = ImageEnhance.Sharpness(im).enhance(color_filter[1])
+            elif color_filter[0] == "blur":
+                im = im.filter(ImageFilter.GaussianBlur(color_filter[1]))
+            # levels range between 0 and 255, gamma is neutral at 1
+            # https://pippin.gimp.org/image-processing/chap_point.html
+            elif color_filter[0] == "levels":
+                bands = im.split()
+                for j in [0, 1, 2]:
+                    in_min, gamma, in_max, out_min, out_max = color_filter[
+                        5 * j + 1 : 5 * j + 6
+                    ]
+                    bands[j].paste(
+                        bands[j].point(
+                            lambda i: out_min
+                            + (out_max - out_min)
+                            * (
+                                (max(in_min, min(i, in_max)) - in_min)
+                                / (in_max - in_min)
+                            )
+                            ** (1 / gamma)
+                        )
+                    )
+                im = Image.merge(im.mode, bands)
+        return im
+    except:
+        return im
+
+
+def synthetic_texture(size, seed=0):
+    rng = numpy.random.default_rng(seed)
+    return Image.fromarray(
+        rng.integers(0, 256, (size, size, 3), dtype=numpy.uint8)
+    )
+
+
+@pytest.fixture
+def texture():
+    return synthetic_texture(256)
+
+
+@pytest.mark.parametrize("color_code", sorted(color_filters_chains))
+def test_compiled_filters_match(texture, color_code, monkeypatch):
+    monkeypatch.setitem(
+        IMG.color_filters_dict, color_code, color_filters_chains[color_code]
+    )
+    monkeypatch.setattr(IMG, "compiled_color_filters", {})
+    expected = legacy_color_transform(texture, color_code)
+    assert IMG.color_transform(texture, color_code).tobytes() == (
+        expected.tobytes()
+    )
+
+
+def test_point_filters_are_folded():
+    steps = IMG.compile_color_filters(color_filters_chains["mixed"])
+    assert [kind for (kind, _) in steps] == [
+        "lut",
+        "filter",
+        "lut",
+        "filter",
+        "lut",
+        "filter",
+    ]
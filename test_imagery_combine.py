@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Texture compositing tests for Ortho4XPDark
+==========================================
+
+Checks that the strip-wise blending of combined provider layers gives the
+very same RGBA texture as the former per layer Image.composite.
+
+Author: Ortho4XPDark Team
+"""
+
+import sys
+from pathlib import Path
+
+import pytest
+
+# Add src directory to path for imports
+current_dir = Path(__file__).parent
+src_dir = current_dir / "src"
+sys.path.insert(0, str(src_dir))
+
+import numpy
+from PIL import Image, ImageFilter
+
+import O4_Imagery_Utils as IMG
+
+
+def synthetic_layers(size, priorities, seed=0):
+    # noisy imagery with white and black patches, and blurred random masks
+    rng = numpy.random.default_rng(seed)
+    layers = []
+    for priority in priorities:
+        true_arr = rng.integers(0, 256, (size, size, 3), dtype=numpy.uint8)
+        true_arr[: size // 8] = 255
+        true_arr[-size // 8 :] = 3
+        mask_arr = (rng.random((size // 16, size // 16)) > 0.5) * 255
+        mask_im = (
+            Image.fromarray(mask_arr.astype(numpy.uint8))
+            .resize((size, size), Image.NEAREST)
+            .filter(ImageFilter.GaussianBlur(size / 64))
+        )
+        layers.append((Image.fromarray(true_arr), mask_im, priority))
+    return layers
+
+
+def legacy_composite(layers, size):
+    # combine_textures as it was, one Image.composite per layer
+    big_image = Image.new("RGBA", (size, size))
+    mask_weight_below = numpy.zeros((size, size), dtype=numpy.uint16)
+    for (true_im, mask_im, priority) in layers:
+        mask = numpy.array(mask_im, dtype=numpy.uint16)
+        true_arr = numpy.array(true_im).astype(numpy.uint16)
+        mask[
+            (numpy.sum(true_arr, axis=2) >= 735) * (mask >= 1) * (mask <= 253)
+        ] = 0
+        mask[
+            (numpy.sum(true_arr, axis=2) <= 35) * (mask >= 1) * (mask <= 253)
+        ] = 0
+        if priority == "low":
+            wasnt_zero = (mask_weight_below + mask) != 0
+            mask[wasnt_zero] = (
+                255 * mask[wasnt_zero] / (mask_weight_below + mask)[wasnt_zero]
+            )
+        elif priority in ["high", "mask"]:
+            mask_weight_below += mask
+        elif priority == "medium":
+            not_zero = mask != 0
+            mask_weight_below += mask
+            mask[not_zero] = 255 * mask[not_zero] / mask_weight_below[not_zero]
+        mask = Image.fromarray(mask.astype(numpy.uint8))
+        big_image = Image.composite(true_im, big_image, mask)
+    return big_image
+
+
+def fused_composite(layers, size):
+    big_array = numpy.zeros((4, size, size), dtype=numpy.uint8)
+    mask_weight_below = numpy.zeros((size, size), dtype=numpy.uint16)
+    for (true_im, mask_im, priority) in layers:
+        IMG.composite_layer(
+            big_array, mask_weight_below, true_im, mask_im, priority
+        )
+    return Image.merge("RGBA", [Image.fromarray(band) for band in big_array])
+
+
+@pytest.mark.parametrize(
+    "priorities",
+    [
+        ["high", "medium", "low"],
+        ["mask", "low", "medium", "medium", "high"],
+        ["low", "low"],
+    ],
+)
+def test_composite_matches_legacy(priorities, monkeypatch):
+    # strips which do not divide the texture size
+    monkeypatch.setattr(IMG, "composite_strip_rows", 100)
+    layers = synthetic_layers(512, priorities)
+    assert (
+        fused_composite(layers, 512).tobytes()
+        == legacy_composite(layers, 512).tobytes()
+    )
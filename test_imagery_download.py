@@ -0,0 +1,740 @@
+#!/usr/bin/env python3
+"""
+Imagery download tests for Ortho4XPDark
+=======================================
+
+Runs the texture download code against a local fake tile server, so that
+connection reuse and the other download engines can be checked (and timed)
+without hitting a real imagery provider.
+
+Author: Ortho4XPDark Team
+"""
+
+import io
+import os
+import queue
+import sys
+import threading
+import time
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import numpy
+import pytest
+
+# Add src directory to path for imports
+current_dir = Path(__file__).parent
+src_dir = current_dir / "src"
+sys.path.insert(0, str(src_dir))
+
+from PIL import Image
+
+import O4_Async_Utils as AIO
+import O4_Cache_Utils as CACHE
+import O4_File_Names as FNAMES
+import O4_Geo_Utils as GEO
+import O4_Http_Utils as HTTP
+import O4_Imagery_Utils as IMG
+import O4_Tile_Utils as TILE
+import O4_UI_Utils as UI
+
+
+class FakeTileServer(ThreadingHTTPServer):
+    """Serves 256px JPEG tiles whose colour is a function of (zl, x, y)."""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeTileHandler)
+        self.lock = threading.Lock()
+        self.nbr_requests = 0
+        self.nbr_connections = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.delay = 0
+        self.missing = set()
+        self.forbidden = set()
+        # tiles whose answer waits for their event to be set
+        self.held = {}
+        self.arrived = threading.Event()
+        # answer 429 to the requests above that many in flight
+        self.throttle_above = None
+        self.nbr_throttled = 0
+        # tiles of a smooth picture of the whole world instead of flat ones
+        self.geographic = False
+
+    @property
+    def url_template(self):
+        return "http://127.0.0.1:%d/{zoom}/{x}/{y}.jpg" % self.server_port
+
+
+def tile_color(zoomlevel, til_x, til_y):
+    return ((37 * til_x) % 256, (53 * til_y) % 256, (11 * zoomlevel) % 256)
+
+
+def geographic_picture(zoomlevel, til_x, til_y, nbr_tiles=1):
+    # the same picture at every zoomlevel, one period per ZL16 texture
+    pixels = (numpy.arange(256 * nbr_tiles) + 0.5) / (256 * 2 ** zoomlevel)
+    u = 2 * numpy.pi * 2 ** 12 * (til_x / 2 ** zoomlevel + pixels)
+    v = 2 * numpy.pi * 2 ** 12 * (til_y / 2 ** zoomlevel + pixels)
+    picture = numpy.empty((len(v), len(u), 3), dtype=numpy.uint8)
+    picture[:, :, 0] = (128 + 100 * numpy.sin(u)).round()[None, :]
+    picture[:, :, 1] = (128 + 100 * numpy.cos(v)).round()[:, None]
+    # sin(2u + 2v), from outer products
+    picture[:, :, 2] = (
+        128
+        + 100 * numpy.cos(2 * v)[:, None] * numpy.sin(2 * u)[None, :]
+        + 100 * numpy.sin(2 * v)[:, None] * numpy.cos(2 * u)[None, :]
+    ).round()
+    return Image.fromarray(picture)
+
+
+class FakeTileHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.nbr_connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.nbr_requests += 1
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(
+                self.server.max_in_flight, self.server.in_flight
+            )
+            throttled = (
+                self.server.throttle_above is not None
+                and self.server.in_flight > self.server.throttle_above
+            )
+            self.server.nbr_throttled += throttled
+        try:
+            tile = tuple(
+                int(x) for x in self.path.split(".")[0].strip("/").split("/")
+            )
+            if tile in self.server.held:
+                self.server.arrived.set()
+                self.server.held[tile].wait(10)
+            time.sleep(self.server.delay)
+            if throttled:
+                self.send_response(429)
+                self.send_header("Retry-After", "0.1")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.answer()
+        finally:
+            with self.server.lock:
+                self.server.in_flight -= 1
+
+    def answer(self):
+        (zoomlevel, til_x, til_y) = [
+            int(x) for x in self.path.split(".")[0].strip("/").split("/")
+        ]
+        if (zoomlevel, til_x, til_y) in self.server.forbidden:
+            self.send_response(403)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if (zoomlevel, til_x, til_y) in self.server.missing:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        buf = io.BytesIO()
+        if self.server.geographic:
+            small_image = geographic_picture(zoomlevel, til_x, til_y)
+        else:
+            small_image = Image.new(
+                "RGB", (256, 256), tile_color(zoomlevel, til_x, til_y)
+            )
+        small_image.save(buf, "JPEG", quality=95)
+        data = buf.getvalue()
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+@pytest.fixture(autouse=True)
+def no_log(monkeypatch):
+    # failed downloads are logged to Ortho4XP.log, in the working directory
+    monkeypatch.setattr(UI, "logprint", lambda *args: None)
+
+
+@pytest.fixture
+def tile_server():
+    server = FakeTileServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def provider(tile_server):
+    provider = {
+        "code": "FAKE" + str(tile_server.server_port),
+        "request_type": "tms",
+        "grid_type": "webmercator",
+        "url_template": tile_server.url_template,
+        "tile_size": 256,
+        "max_threads": 4,
+        "imagery_dir": "normal",
+        "color_filters": "none",
+        "extent": "global",
+        "epsg_code": "3857",
+        "top_left_corner": [[-20037508.34, 20037508.34] for i in range(21)],
+        "resolutions": numpy.array(
+            [20037508.34 / (128 * 2 ** i) for i in range(21)]
+        ),
+    }
+    IMG.providers_dict[provider["code"]] = provider
+    yield provider
+    IMG.providers_dict.pop(provider["code"], None)
+    HTTP.sessions.pop(provider["code"], None)
+    HTTP.limiters.pop(provider["code"], None)
+    AIO.close_sessions()
+
+
+def test_connections_reused_across_textures(tile_server, provider, tmp_path):
+    for til_x_left in (34000, 34016):
+        file_name = FNAMES.jpeg_file_name_from_attributes(
+            til_x_left, 22000, 16, provider["code"]
+        )
+        assert IMG.download_jpeg_ortho(
+            str(tmp_path), file_name, til_x_left, 22000, 16, provider["code"]
+        )
+        assert os.path.isfile(tmp_path / file_name)
+    stats = HTTP.connection_statistics(provider["code"])[provider["code"]]
+    assert stats["requests"] == 2 * 256 == tile_server.nbr_requests
+    # at most one connection per download thread, kept for the second texture
+    assert tile_server.nbr_connections <= provider["max_threads"]
+    assert stats["connections"] == tile_server.nbr_connections
+    assert stats["reused"] == stats["requests"] - stats["connections"]
+    # until Ortho4XP exits
+    TILE.shutdown()
+    assert not HTTP.sessions
+
+
+@pytest.mark.skipif(not AIO.has_aiohttp, reason="aiohttp is not installed")
+def test_asyncio_engine_matches_threads(tile_server, provider, monkeypatch):
+    tilbox = (34000, 22000, 34004, 22004)
+    # one missing tile, to go through the lower ZL fallback as well
+    tile_server.missing.add((16, 34001, 22002))
+    monkeypatch.setattr(IMG, "download_engine", "threads")
+    (success, threads_image) = IMG.build_texture_from_tilbox(
+        tilbox, 16, provider
+    )
+    assert success
+    monkeypatch.setattr(IMG, "download_engine", "asyncio")
+    (success, asyncio_image) = IMG.build_texture_from_tilbox(
+        tilbox, 16, provider
+    )
+    assert success
+    assert threads_image.tobytes() == asyncio_image.tobytes()
+    loop_thread = AIO.loop_thread
+    TILE.shutdown()
+    assert AIO.loop is None and not AIO.providers_state
+    assert not loop_thread.is_alive()
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_parent_tiles_fetched_once(tile_server, provider, monkeypatch, engine):
+    if engine == "asyncio" and not AIO.has_aiohttp:
+        pytest.skip("aiohttp is not installed")
+    monkeypatch.setattr(IMG, "download_engine", engine)
+    tile_server.delay = 0.01
+    # a 4x4 box whose tiles and ZL15 parents are all missing, they all come
+    # from a single ZL14 tile
+    tilbox = (34000, 22000, 34004, 22004)
+    for til_y in range(22000, 22004):
+        for til_x in range(34000, 34004):
+            tile_server.missing.add((16, til_x, til_y))
+            tile_server.missing.add((15, til_x // 2, til_y // 2))
+    (success, big_image) = IMG.build_texture_from_tilbox(tilbox, 16, provider)
+    assert success
+    assert tile_server.nbr_requests == 16 + 4 + 1
+    assert big_image.getpixel((512, 512)) == pytest.approx(
+        tile_color(14, 8500, 5500), abs=3
+    )
+
+
+def test_reduced_image_decodes_at_dct_scale():
+    buf = io.BytesIO()
+    Image.effect_mandelbrot((256, 256), (-2, -1.5, 1, 1.5), 100).convert(
+        "RGB"
+    ).save(buf, "JPEG", quality=95)
+    reference = (
+        Image.open(io.BytesIO(buf.getvalue())).resize((48, 48), Image.BICUBIC)
+    )
+    small_image = Image.open(io.BytesIO(buf.getvalue()))
+    reduced = IMG.reduced_image(small_image, (48, 48))
+    # decoded at 1/4 scale (64px), then resized
+    assert small_image.size == (64, 64)
+    assert reduced.size == (48, 48)
+    error = numpy.abs(
+        numpy.asarray(reduced, dtype=int) - numpy.asarray(reference, dtype=int)
+    )
+    assert error.mean() < 4
+
+
+def test_downscaled_bbox_texture(tile_server, provider):
+    # a provider without webmercator grid goes through the bbox code, a
+    # small preview of one ZL16 tile then comes from a reduced ZL13 tile
+    del provider["grid_type"]
+    provider["epsg_code"] = "3857"
+    (latmax, lonmin) = GEO.gtile_to_wgs84(34000, 22000, 16)
+    (latmin, lonmax) = GEO.gtile_to_wgs84(34001, 22001, 16)
+    (xmin, ymax) = GEO.geo_to_webm(lonmin, latmax)
+    (xmax, ymin) = GEO.geo_to_webm(lonmax, latmin)
+    (success, big_image) = IMG.build_texture_from_bbox_and_size(
+        (xmin, ymax, xmax, ymin), "3857", (32, 32), provider
+    )
+    assert success
+    assert big_image.size == (32, 32)
+    # (plus possibly a neighbour touched by rounding at the bbox edge)
+    assert tile_server.nbr_requests <= 2
+    assert big_image.getpixel((16, 16)) == pytest.approx(
+        tile_color(13, 34000 // 8, 22000 // 8), abs=3
+    )
+
+
+@pytest.mark.skipif(not AIO.has_aiohttp, reason="aiohttp is not installed")
+def test_asyncio_engine_caps_requests(tile_server, provider, monkeypatch):
+    monkeypatch.setattr(IMG, "download_engine", "asyncio")
+    provider["max_requests"] = 12
+    tile_server.delay = 0.02
+    results = {}
+
+    def build(til_x_left):
+        results[til_x_left] = IMG.build_texture_from_tilbox(
+            (til_x_left, 22000, til_x_left + 8, 22008), 16, provider
+        )
+
+    # two textures at once share the provider cap
+    threads = [
+        threading.Thread(target=build, args=(til_x_left,))
+        for til_x_left in (34000, 34016)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert tile_server.nbr_requests == 2 * 64
+    # more requests in flight than the provider has download threads, but
+    # never more than its cap
+    assert provider["max_threads"] < tile_server.max_in_flight <= 12
+    for (til_x_left, (success, big_image)) in results.items():
+        assert success
+        for (x, y) in ((0, 0), (3, 5), (7, 7)):
+            assert big_image.getpixel((256 * x + 128, 256 * y + 128)) == (
+                pytest.approx(tile_color(16, til_x_left + x, 22000 + y), abs=2)
+            )
+
+
+def test_rate_limiter_aimd():
+    limiter = HTTP.RateLimiter("AIMD", 4, 8)
+    for _ in range(4):
+        assert limiter.try_acquire() == 0
+    # the window is full
+    assert limiter.try_acquire() is None
+    for _ in range(4):
+        limiter.release(200, 0.01)
+    assert 4 < limiter.window <= 5
+    assert limiter.rate is None
+    assert limiter.try_acquire() == 0
+    limiter.release(429, 0.01, "0.5")
+    assert limiter.window == pytest.approx(2.5, abs=0.5)
+    # a rate cap from then on, and nothing before Retry-After has elapsed
+    assert limiter.rate is not None
+    assert 0.4 < limiter.try_acquire() <= 0.5
+    assert limiter.stats == {"requests": 5, "throttled": 1, "decreases": 1}
+
+
+def test_rate_limiter_caps(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(
+        HTTP, "time", types.SimpleNamespace(monotonic=lambda: clock[0])
+    )
+    limiter = HTTP.RateLimiter("CAPS", 4, 8, rate=2)
+    limiter.release(503, 0.1)
+    assert limiter.rate == 1
+    # one increase per round trip, however many answers it brings
+    for _ in range(50):
+        limiter.in_flight += 1
+        limiter.release(200, 0.1)
+    assert limiter.rate == 2
+    # and never above max_rps
+    for _ in range(200):
+        clock[0] += 0.6
+        limiter.in_flight += 1
+        limiter.release(200, 0.1)
+    assert limiter.rate <= 2
+    # the widest cap asked for is kept, whichever engine asks last
+    provider = {"code": "CAPS", "max_threads": 4}
+    monkeypatch.setitem(HTTP.limiters, "CAPS", HTTP.RateLimiter("CAPS", 4, 4))
+    assert HTTP.get_limiter(provider).max_window == 4
+    assert HTTP.get_limiter(provider, 32).max_window == 32
+    assert HTTP.get_limiter(provider).max_window == 32
+    provider["max_requests"] = 6
+    monkeypatch.setitem(HTTP.limiters, "CAPS", HTTP.RateLimiter("CAPS", 4, 6))
+    assert HTTP.get_limiter(provider, 32).max_window == 6
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_throttling_provider(tile_server, provider, monkeypatch, engine):
+    if engine == "asyncio" and not AIO.has_aiohttp:
+        pytest.skip("aiohttp is not installed")
+    monkeypatch.setattr(IMG, "download_engine", engine)
+    provider["max_threads"] = 8
+    tile_server.delay = 0.01
+    tile_server.throttle_above = 3
+    (success, big_image) = IMG.build_texture_from_tilbox(
+        (34000, 22000, 34008, 22008), 16, provider
+    )
+    # every tile made it in the end
+    assert success
+    for (x, y) in ((0, 0), (3, 5), (7, 7)):
+        assert big_image.getpixel((256 * x + 128, 256 * y + 128)) == (
+            pytest.approx(tile_color(16, 34000 + x, 22000 + y), abs=2)
+        )
+    limiter = HTTP.limiters[provider["code"]]
+    assert limiter.stats["throttled"] == tile_server.nbr_throttled > 0
+    assert limiter.stats["decreases"] > 0
+    assert limiter.rate is not None
+    assert limiter.in_flight == 0
+
+
+def test_download_queue_orders():
+    tile = types.SimpleNamespace(lat=45, lon=6, default_zl=16, mask_zl=14)
+    textures = [
+        (34000 + 16 * i, 22000 + 16 * j, 16, "FAKE")
+        for j in range(4)
+        for i in range(4)
+    ]
+    download_queue = TILE.DownloadQueue(tile, "hilbert")
+    for texture_attributes in textures:
+        download_queue.put(texture_attributes)
+    download_queue.put("quit")
+    ordered = [download_queue.get() for _ in range(17)]
+    assert ordered[-1] == "quit"
+    assert sorted(ordered[:-1]) == sorted(textures)
+    # each texture is a neighbour of the previous one
+    for (a, b) in zip(ordered[:-2], ordered[1:-1]):
+        assert abs(a[0] - b[0]) + abs(a[1] - b[1]) == 16
+    download_queue = TILE.DownloadQueue(tile, "fifo")
+    for texture_attributes in textures:
+        download_queue.put(texture_attributes)
+    assert [download_queue.get() for _ in range(16)] == textures
+    # the airport texture at ZL18 jumps the queue
+    download_queue = TILE.DownloadQueue(tile, "airports")
+    for texture_attributes in textures + [(136032, 88032, 18, "FAKE")]:
+        download_queue.put(texture_attributes)
+    assert download_queue.get() == (136032, 88032, 18, "FAKE")
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_overlapping_textures_share_requests(
+    tile_server, provider, monkeypatch, engine
+):
+    if engine == "asyncio" and not AIO.has_aiohttp:
+        pytest.skip("aiohttp is not installed")
+    monkeypatch.setattr(IMG, "download_engine", engine)
+    HTTP.reset_coalesce_stats()
+    tile_server.delay = 0.005
+    results = []
+
+    def build(tilbox):
+        results.append(IMG.build_texture_from_tilbox(tilbox, 16, provider))
+
+    # The answer to a tile of the overlap is held until the second texture
+    # asks for it too, so that the two requests overlap whatever the timing.
+    release = threading.Event()
+    tile_server.held[(16, 34000, 22000)] = release
+    threads = [
+        threading.Thread(target=build, args=(tilbox,))
+        for tilbox in (
+            (34000, 22000, 34008, 22004),
+            (34000, 22000, 34008, 22008),
+        )
+    ]
+    threads[0].start()
+    assert tile_server.arrived.wait(10)
+    threads[1].start()
+    deadline = time.time() + 10
+    while not HTTP.coalesce_stats["coalesced"] and time.time() < deadline:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert all(success for (success, _) in results)
+    assert HTTP.coalesce_stats["requests"] == 96
+    # the held tile at least, at most the 32 tiles of the overlap
+    assert 1 <= HTTP.coalesce_stats["coalesced"] <= 32
+    assert tile_server.nbr_requests == 96 - HTTP.coalesce_stats["coalesced"]
+    # nothing left behind
+    assert not HTTP.inflight and not AIO.inflight
+
+
+def test_requests_are_shared_per_provider_and_headers():
+    url = "http://tiles.test/16/34000/22000.jpg"
+    keys = [
+        HTTP.request_key(url, "A", {"Referer": "a"}),
+        HTTP.request_key(url, "A", {"Referer": "b"}),
+        HTTP.request_key(url, "B", {"Referer": "a"}),
+        HTTP.request_key(url, "A", {"Referer": "a"}),
+    ]
+    release = threading.Event()
+    fetched = []
+
+    def fetch(key):
+        fetched.append(key)
+        release.wait(10)
+        return key
+
+    results = {}
+    threads = [
+        threading.Thread(
+            target=lambda k=k: results.__setitem__(
+                k, HTTP.coalesced(keys[k], lambda: fetch(keys[k]))[0]
+            )
+        )
+        for k in range(len(keys))
+    ]
+    HTTP.reset_coalesce_stats()
+    for thread in threads:
+        thread.start()
+    deadline = time.time() + 10
+    while HTTP.coalesce_stats["requests"] < 4 and time.time() < deadline:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join()
+    # only the same provider with the same headers shares an answer
+    assert len(fetched) == 3 and set(fetched) == set(keys)
+    assert [results[k] for k in range(len(keys))] == keys
+    assert HTTP.coalesce_stats["coalesced"] == 1
+    assert not HTTP.inflight
+
+
+def test_parallel_texture_builders(
+    tile_server, provider, tmp_path, monkeypatch
+):
+    monkeypatch.setattr(FNAMES, "Imagery_dir", str(tmp_path))
+    monkeypatch.setattr(IMG, "download_engine", "threads")
+    monkeypatch.setattr(TILE, "max_download_slots", 3)
+    tile_server.delay = 0.005
+    tile = types.SimpleNamespace(lat=45, lon=6)
+    download_queue = queue.Queue()
+    convert_queue = queue.Queue()
+    textures = [(34000 + 16 * i, 22000, 16, provider["code"]) for i in range(3)]
+    # the same texture twice is only downloaded once
+    for texture_attributes in textures + textures[:1]:
+        download_queue.put(texture_attributes)
+    download_queue.put("quit")
+    assert TILE.download_textures(tile, download_queue, convert_queue)
+    assert tile_server.nbr_requests == 3 * 256
+    # the textures share the provider budget of max_threads requests
+    assert tile_server.max_in_flight <= provider["max_threads"]
+    converted = [convert_queue.get()[1:] for _ in range(convert_queue.qsize())]
+    assert sorted(converted) == sorted(textures + textures[:1])
+    file_dir = FNAMES.jpeg_file_dir_from_attributes(45, 6, 16, provider)
+    assert sorted(os.listdir(file_dir)) == sorted(
+        FNAMES.jpeg_file_name_from_attributes(*texture_attributes)
+        for texture_attributes in textures
+    )
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_repair_only_failed_cells(
+    tile_server, provider, tmp_path, monkeypatch, engine
+):
+    if engine == "asyncio" and not AIO.has_aiohttp:
+        pytest.skip("aiohttp is not installed")
+    monkeypatch.setattr(FNAMES, "Imagery_dir", str(tmp_path / "Imagery"))
+    monkeypatch.setattr(IMG, "download_engine", engine)
+    monkeypatch.setattr(IMG, "incomplete_imgs", {})
+    tile = types.SimpleNamespace(lat=45, lon=6, build_dir=str(tmp_path))
+    texture_attributes = (34000, 22000, 16, provider["code"])
+    file_path = os.path.join(
+        FNAMES.jpeg_file_dir_from_attributes(45, 6, 16, provider),
+        FNAMES.jpeg_file_name_from_attributes(*texture_attributes),
+    )
+    tile_server.forbidden |= {(16, 34003, 22001), (16, 34010, 22015)}
+    assert IMG.build_jpeg_ortho(tile, *texture_attributes)
+    assert tile_server.nbr_requests == 256
+    with open(FNAMES.failed_cells_file(file_path)) as f:
+        assert f.read().split("\n") == [
+            "16 34000 22000 256",
+            "34003 22001",
+            "34010 22015",
+            "",
+        ]
+    assert IMG.incomplete_imgs == {
+        "+45+006": [os.path.basename(file_path)]
+    }
+    # only the DDS of the texture goes, the orthophoto is kept
+    os.makedirs(tmp_path / "textures")
+    dds_file = tmp_path / "textures" / FNAMES.dds_file_name_from_attributes(
+        *texture_attributes
+    )
+    dds_file.write_bytes(b"DDS ")
+    TILE.reset_incomplete_textures(tile)
+    assert not dds_file.exists() and os.path.isfile(file_path)
+    assert IMG.incomplete_imgs == {}
+    # one sub-tile is still refused, the other one is repaired
+    tile_server.forbidden.discard((16, 34003, 22001))
+    assert IMG.build_jpeg_ortho(tile, *texture_attributes)
+    assert tile_server.nbr_requests == 258
+    with open(FNAMES.failed_cells_file(file_path)) as f:
+        assert f.read().split("\n")[1:] == ["34010 22015", ""]
+    big_image = Image.open(file_path)
+    assert big_image.getpixel((3 * 256 + 128, 256 + 128)) == pytest.approx(
+        tile_color(16, 34003, 22001), abs=3
+    )
+    assert big_image.getpixel((10 * 256 + 128, 15 * 256 + 128)) == (
+        255,
+        255,
+        255,
+    )
+    tile_server.forbidden.clear()
+    assert IMG.build_jpeg_ortho(tile, *texture_attributes)
+    assert tile_server.nbr_requests == 259
+    assert not os.path.exists(FNAMES.failed_cells_file(file_path))
+    # and a complete orthophoto is left alone
+    assert IMG.build_jpeg_ortho(tile, *texture_attributes)
+    assert tile_server.nbr_requests == 259
+
+
+@pytest.mark.parametrize("depth", [1, 2])
+def test_derive_lower_zl_from_children(
+    tile_server, provider, tmp_path, monkeypatch, depth
+):
+    monkeypatch.setattr(FNAMES, "Imagery_dir", str(tmp_path / "Imagery"))
+    tile_server.geographic = True
+    tile = types.SimpleNamespace(lat=45, lon=6, build_dir=str(tmp_path))
+    # the orthophotos at ZL16+depth, as the provider would give them
+    factor = 2 ** depth
+    child_dir = FNAMES.jpeg_file_dir_from_attributes(
+        45, 6, 16 + depth, provider
+    )
+    os.makedirs(child_dir)
+    for j in range(factor):
+        for i in range(factor):
+            (til_x, til_y) = (factor * 34000 + 16 * i, factor * 22000 + 16 * j)
+            geographic_picture(16 + depth, til_x, til_y, 16).save(
+                os.path.join(
+                    child_dir,
+                    FNAMES.jpeg_file_name_from_attributes(
+                        til_x, til_y, 16 + depth, provider["code"]
+                    ),
+                ),
+                quality=95,
+            )
+    nbr_requests = tile_server.nbr_requests
+    monkeypatch.setattr(IMG, "derive_lower_zl", True)
+    assert IMG.build_jpeg_ortho(tile, 34000, 22000, 16, provider["code"])
+    assert tile_server.nbr_requests == nbr_requests
+    file_name = FNAMES.jpeg_file_name_from_attributes(
+        34000, 22000, 16, provider["code"]
+    )
+    derived = numpy.asarray(
+        Image.open(
+            os.path.join(
+                FNAMES.jpeg_file_dir_from_attributes(45, 6, 16, provider),
+                file_name,
+            )
+        ),
+        dtype=float,
+    )
+    # the same texture straight from the provider
+    assert IMG.download_jpeg_ortho(
+        str(tmp_path), file_name, 34000, 22000, 16, provider["code"]
+    )
+    downloaded = numpy.asarray(
+        Image.open(tmp_path / file_name), dtype=float
+    )
+    assert numpy.abs(derived - downloaded).mean() < 3
+
+
+@pytest.fixture
+def tile_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(CACHE, "tile_cache", True)
+    monkeypatch.setattr(CACHE, "cache_file", str(tmp_path / "tiles.sqlite"))
+    return CACHE
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_tile_cache_serves_rebuilds(
+    tile_server, provider, tile_cache, monkeypatch, engine
+):
+    if engine == "asyncio" and not AIO.has_aiohttp:
+        pytest.skip("aiohttp is not installed")
+    monkeypatch.setattr(IMG, "download_engine", engine)
+    tilbox = (34000, 22000, 34004, 22004)
+    tile_server.missing.add((16, 34001, 22002))
+    (success, first_image) = IMG.build_texture_from_tilbox(
+        tilbox, 16, provider
+    )
+    assert success
+    nbr_requests = tile_server.nbr_requests
+    # 16 tiles, plus the 404 and the lower ZL tile used in its place
+    assert nbr_requests == 17
+    (success, second_image) = IMG.build_texture_from_tilbox(
+        tilbox, 16, provider
+    )
+    assert success
+    # only the missing tile is asked again
+    assert tile_server.nbr_requests == nbr_requests + 1
+    assert first_image.tobytes() == second_image.tobytes()
+
+
+def test_tile_cache_evicts_least_recently_used(tile_cache, monkeypatch):
+    data = bytes(100 * 1024)
+    for x in range(4):
+        tile_cache.put("TEST", 16, x, 0, data)
+    time.sleep(0.01)
+    assert tile_cache.get("TEST", 16, 0, 0) == data
+    tile_cache.flush_touches()
+    # room for about 4.5 tiles, the fifth one evicts the least recently used
+    monkeypatch.setattr(tile_cache, "tile_cache_size", 0.45)
+    tile_cache.put("TEST", 16, 4, 0, data)
+    assert tile_cache.get("TEST", 16, 0, 0) == data
+    assert tile_cache.get("TEST", 16, 1, 0) is None
+    assert tile_cache.get("TEST", 16, 4, 0) == data
+    assert tile_cache.total_size <= 0.9 * 0.45 * 1024 ** 2
+
+
+def test_cached_tiles_decode_at_dct_scale(tile_cache):
+    buf = io.BytesIO()
+    Image.new("RGB", (256, 256), (40, 120, 200)).save(buf, "JPEG")
+    tile_cache.put("TEST", 16, 0, 0, buf.getvalue())
+    # truncated, it does not decode
+    tile_cache.put("TEST", 16, 1, 0, buf.getvalue()[:-200])
+    (success, small_image) = IMG.cached_image(("TEST", 16, 0, 0))
+    assert success
+    # checked but not decoded yet, reduced_image still picks the scale
+    reduced = IMG.reduced_image(small_image, (64, 64))
+    assert small_image.size == reduced.size == (64, 64)
+    assert IMG.cached_image(("TEST", 16, 1, 0)) == (0, None)
+    with pytest.raises(OSError):
+        IMG.checked_image(buf.getvalue()[:-200])
+
+
+def test_tile_cache_counts_replaced_tiles_once(tile_cache):
+    tile_cache.put("TEST", 16, 0, 0, bytes(1000))
+    size = tile_cache.total_size
+    for _ in range(10):
+        tile_cache.put("TEST", 16, 0, 0, bytes(1500))
+    assert tile_cache.total_size == size + 500
+    tile_cache.evict_down()
+    assert tile_cache.total_size == size + 500
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+Extent coverage tests for Ortho4XPDark
+======================================
+
+Checks that has_data, which now works from decoded extents kept in memory
+and their integral images, gives the same answers and masks as the baseline
+has_data, which cropped the extent PNG read from disk, for every mask size,
+resampling, negative, global and mask layer case.
+
+Author: Ortho4XPDark Team
+"""
+
+import os
+import random
+import sys
+from pathlib import Path
+
+import pytest
+
+# Add src directory to path for imports
+current_dir = Path(__file__).parent
+src_dir = current_dir / "src"
+sys.path.insert(0, str(src_dir))
+
+import numpy
+from PIL import Image, ImageFilter, ImageOps
+
+import O4_File_Names as FNAMES
+import O4_Geo_Utils as GEO
+import O4_Imagery_Utils as IMG
+import O4_UI_Utils as UI
+
+
+def synthetic_extent(size):
+    # a blurred disc: fully covered, empty and partial areas
+    yy, xx = numpy.mgrid[0:size, 0:size]
+    disc = (xx - size / 2) ** 2 + (yy - size / 2) ** 2 < (size / 3) ** 2
+    im = Image.fromarray((255 * disc).astype(numpy.uint8))
+    return im.filter(ImageFilter.GaussianBlur(size / 50))
+
+
+def legacy_has_data(
+    bbox,
+    extent_code,
+    return_mask=False,
+    mask_size=(4096, 4096),
+    is_sharp_resize=False,
+    is_mask_layer=False,
+):
+    # has_data as it was, reading the extent PNG from disk at each call
+    (x0, y0, x1, y1) = bbox
+    try:
+        # global layers need special treatment
+        if extent_code == "global" and (not is_mask_layer or (x1 - x0) == 1):
+            return (not return_mask) or Image.new("L", mask_size, "white")
+        if extent_code[0] == "!":
+            extent_code = extent_code[1:]
+            negative = True
+        else:
+            negative = False
+        (xmin, ymin, xmax, ymax) = (
+            IMG.extents_dict[extent_code]["mask_bounds"]
+            if extent_code != "global"
+            else (-180, -90, 180, 90)
+        )
+        if x0 > xmax or x1 < xmin or y0 < ymin or y1 > ymax:
+            return negative
+        if (not is_mask_layer) or (x1 - x0) == 1:
+            mask_im = Image.open(
+                os.path.join(
+                    FNAMES.Extent_dir,
+                    IMG.extents_dict[extent_code]["dir"],
+                    IMG.extents_dict[extent_code]["code"] + ".png",
+                )
+            ).convert("L")
+            (sizex, sizey) = mask_im.size
+            pxx0 = int((x0 - xmin) / (xmax - xmin) * sizex)
+            pxx1 = int((x1 - xmin) / (xmax - xmin) * sizex)
+            pxy0 = int((ymax - y0) / (ymax - ymin) * sizey)
+            pxy1 = int((ymax - y1) / (ymax - ymin) * sizey)
+            if not return_mask:
+                pxx0 = max(-1, pxx0)
+                pxx1 = min(sizex, pxx1)
+                pxy0 = max(-1, pxy0)
+                pxy1 = min(sizey, pxy1)
+            mask_im = mask_im.crop((pxx0, pxy0, pxx1, pxy1))
+            if negative:
+                mask_im = ImageOps.invert(mask_im)
+            if not mask_im.getbbox():
+                return False
+            if not return_mask:
+                return True
+            if is_sharp_resize:
+                return mask_im.resize(mask_size)
+            else:
+                return mask_im.resize(mask_size, Image.BICUBIC)
+        else:
+            # following code only visited when is_mask_layer is True
+            # in which case it is passed as (lat,lon,mask_zl)
+            # check if sea mask file exists
+            (lat, lon, mask_zl) = is_mask_layer
+            (m_tilx, m_tily) = GEO.wgs84_to_orthogrid(
+                (y0 + y1) / 2, (x0 + x1) / 2, mask_zl
+            )
+            if os.path.isdir(
+                os.path.join(FNAMES.mask_dir(lat, lon), "Combined_imagery")
+            ):
+                check_dir = os.path.join(
+                    FNAMES.mask_dir(lat, lon), "Combined_imagery"
+                )
+            else:
+                check_dir = FNAMES.mask_dir(lat, lon)
+            if not os.path.isfile(
+                os.path.join(check_dir, FNAMES.legacy_mask(m_tilx, m_tily))
+            ):
+                return False
+            # build extent mask_im
+            if extent_code != "global":
+                mask_im = Image.open(
+                    os.path.join(
+                        FNAMES.Extent_dir,
+                        IMG.extents_dict[extent_code]["dir"],
+                        IMG.extents_dict[extent_code]["code"] + ".png",
+                    )
+                ).convert("L")
+                (sizex, sizey) = mask_im.size
+                pxx0 = int((x0 - xmin) / (xmax - xmin) * sizex)
+                pxx1 = int((x1 - xmin) / (xmax - xmin) * sizex)
+                pxy0 = int((ymax - y0) / (ymax - ymin) * sizey)
+                pxy1 = int((ymax - y1) / (ymax - ymin) * sizey)
+                mask_im = mask_im.crop((pxx0, pxy0, pxx1, pxy1))
+                if negative:
+                    mask_im = ImageOps.invert(mask_im)
+                if not mask_im.getbbox():
+                    return False
+                if is_sharp_resize:
+                    mask_im = mask_im.resize(mask_size)
+                else:
+                    mask_im = mask_im.resize(mask_size, Image.BICUBIC)
+            else:
+                mask_im = Image.new("L", mask_size, "white")
+            # build sea mask_im2
+            (ymax, xmin) = GEO.gtile_to_wgs84(m_tilx, m_tily, mask_zl)
+            (ymin, xmax) = GEO.gtile_to_wgs84(m_tilx + 16, m_tily + 16, mask_zl)
+            mask_im2 = Image.open(
+                os.path.join(check_dir, FNAMES.legacy_mask(m_tilx, m_tily))
+            ).convert("L")
+            (sizex, sizey) = mask_im2.size
+            pxx0 = int((x0 - xmin) / (xmax - xmin) * sizex)
+            pxx1 = int((x1 - xmin) / (xmax - xmin) * sizex)
+            pxy0 = int((ymax - y0) / (ymax - ymin) * sizey)
+            pxy1 = int((ymax - y1) / (ymax - ymin) * sizey)
+            mask_im2 = mask_im2.crop((pxx0, pxy0, pxx1, pxy1)).resize(
+                mask_size, Image.BICUBIC
+            )
+            # invert it
+            mask_array2 = 255 - numpy.array(mask_im2, dtype=numpy.uint8)
+            # let full sea down (if you wish to...)
+            # mask_array2[mask_array2==255]=0
+            #  combine (multiply) both
+            mask_array = numpy.array(mask_im, dtype=numpy.uint16)
+            mask_array = (mask_array * mask_array2 / 255).astype(numpy.uint8)
+            mask_im = Image.fromarray(mask_array).convert("L")
+            if not mask_im.getbbox():
+                return False
+            if not return_mask:
+                return True
+            return mask_im
+    except Exception as e:
+        UI.vprint(1, "Could not test coverage of ", extent_code, " !!!")
+        UI.vprint(2, e)
+        return False
+
+
+
+def same_result(result, legacy_result):
+    if isinstance(legacy_result, Image.Image):
+        return (
+            isinstance(result, Image.Image)
+            and result.size == legacy_result.size
+            and result.tobytes() == legacy_result.tobytes()
+        )
+    return result == legacy_result
+
+
+@pytest.fixture
+def extent(tmp_path, monkeypatch):
+    monkeypatch.setattr(FNAMES, "Extent_dir", str(tmp_path))
+    os.makedirs(tmp_path / "Test")
+    synthetic_extent(500).save(tmp_path / "Test" / "TEST.png")
+    monkeypatch.setitem(
+        IMG.extents_dict,
+        "TEST",
+        {"dir": "Test", "code": "TEST", "mask_bounds": [0, 0, 10, 10]},
+    )
+    IMG.extent_cache.clear()
+    yield "TEST"
+    IMG.extent_cache.clear()
+
+
+@pytest.fixture
+def sea_masks(tmp_path, monkeypatch):
+    # blurred random sea masks, written for the mask tiles asked for
+    monkeypatch.setattr(FNAMES, "Mask_dir", str(tmp_path / "Masks"))
+    rng = numpy.random.default_rng(0)
+
+    def make(lat, lon, m_tilx, m_tily, combined):
+        mask_dir = FNAMES.mask_dir(lat, lon)
+        if combined:
+            mask_dir = os.path.join(mask_dir, "Combined_imagery")
+        os.makedirs(mask_dir, exist_ok=True)
+        file_name = os.path.join(mask_dir, FNAMES.legacy_mask(m_tilx, m_tily))
+        if not os.path.isfile(file_name):
+            sea = (rng.random((16, 16)) > 0.6) * 255
+            Image.fromarray(sea.astype(numpy.uint8)).resize(
+                (256, 256), Image.NEAREST
+            ).filter(ImageFilter.GaussianBlur(8)).save(file_name)
+
+    return make
+
+
+@pytest.mark.parametrize("negative", [False, True])
+@pytest.mark.parametrize("mask_size", [(64, 64), (96, 40)])
+@pytest.mark.parametrize("is_sharp_resize", [False, True])
+def test_has_data_matches_legacy(extent, negative, mask_size, is_sharp_resize):
+    extent_code = "!" + extent if negative else extent
+    random.seed(1)
+    for _ in range(150):
+        x0 = random.uniform(-1, 10.5)
+        y1 = random.uniform(-1, 10.5)
+        width = random.choice([0.05, 0.3, 1, 3])
+        bbox = (x0, y1 + width, x0 + width, y1)
+        assert IMG.has_data(bbox, extent_code) == legacy_has_data(
+            bbox, extent_code
+        )
+        assert same_result(
+            IMG.has_data(bbox, extent_code, True, mask_size, is_sharp_resize),
+            legacy_has_data(bbox, extent_code, True, mask_size, is_sharp_resize),
+        )
+    # the extent was decoded only once
+    assert len(IMG.extent_cache) == 1
+
+
+@pytest.mark.parametrize("extent_code", ["TEST", "!TEST", "global"])
+@pytest.mark.parametrize("combined", [False, True])
+def test_mask_layers_match_legacy(extent, sea_masks, extent_code, combined):
+    random.seed(2)
+    mask_zl = 14
+    for _ in range(40):
+        (lat, lon) = (random.randint(0, 9), random.randint(0, 9))
+        (til_x, til_y) = GEO.wgs84_to_orthogrid(
+            lat + random.random(), lon + random.random(), 16
+        )
+        (y0, x0) = GEO.gtile_to_wgs84(til_x, til_y, 16)
+        (y1, x1) = GEO.gtile_to_wgs84(til_x + 16, til_y + 16, 16)
+        bbox = (x0, y0, x1, y1)
+        (m_tilx, m_tily) = GEO.wgs84_to_orthogrid(
+            (y0 + y1) / 2, (x0 + x1) / 2, mask_zl
+        )
+        # some textures are left without a sea mask
+        if random.random() < 0.8:
+            sea_masks(lat, lon, m_tilx, m_tily, combined)
+        is_mask_layer = (lat, lon, mask_zl)
+        for (return_mask, is_sharp_resize) in (
+            (False, False),
+            (True, False),
+            (True, True),
+        ):
+            assert same_result(
+                IMG.has_data(
+                    bbox,
+                    extent_code,
+                    return_mask,
+                    (64, 64),
+                    is_sharp_resize,
+                    is_mask_layer,
+                ),
+                legacy_has_data(
+                    bbox,
+                    extent_code,
+                    return_mask,
+                    (64, 64),
+                    is_sharp_resize,
+                    is_mask_layer,
+                ),
+            )
+
+
+@pytest.mark.parametrize("mask_size", [(64, 64), (96, 40)])
+def test_global_matches_legacy(mask_size):
+    for bbox in ((4, 6, 6, 4), (4, 5, 5, 4), (-200, 100, 200, -100)):
+        for is_mask_layer in (False, (4, 4, 14)):
+            assert IMG.has_data(
+                bbox, "global", is_mask_layer=is_mask_layer
+            ) == legacy_has_data(bbox, "global", is_mask_layer=is_mask_layer)
+    assert same_result(
+        IMG.has_data((4, 5, 5, 4), "global", True, mask_size),
+        legacy_has_data((4, 5, 5, 4), "global", True, mask_size),
+    )
+
+
+def test_extent_reloaded_when_rebuilt(extent):
+    bbox = (4, 6, 6, 4)
+    assert IMG.has_data(bbox, extent)
+    file_name = os.path.join(FNAMES.Extent_dir, "Test", "TEST.png")
+    Image.new("L", (500, 500), "black").save(file_name)
+    os.utime(file_name, (0, 0))
+    assert not IMG.has_data(bbox, extent)
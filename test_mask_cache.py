@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Mask cache tests for Ortho4XPDark
+=================================
+
+Checks that the masks are decoded once for all the textures they cover,
+that needs_mask answers as when it decoded the mask for each texture, that
+the cache follows the changes of the mask files and its size bound, that
+dry textures need no decode once a mask is out of the cache, and that the
+conversion cuts the masks of the textures from the cached masks.
+
+Author: Ortho4XPDark Team
+"""
+
+import os
+import sys
+import types
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy
+import pytest
+
+# Add src directory to path for imports
+current_dir = Path(__file__).parent
+src_dir = current_dir / "src"
+sys.path.insert(0, str(src_dir))
+
+from PIL import Image
+
+import O4_File_Names as FNAMES
+import O4_Mask_Utils as MASK
+
+M_TIL_X, M_TIL_Y = 8496, 5856  # ZL14
+
+
+@pytest.fixture
+def mask_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(FNAMES, "mask_dir", lambda lat, lon: str(tmp_path))
+    monkeypatch.setattr(MASK, "mask_cache", OrderedDict())
+    monkeypatch.setattr(MASK, "mask_summaries", {})
+    monkeypatch.setattr(MASK, "mask_cache_stats", {"decodes": 0, "hits": 0})
+    # water in the top left quarter only
+    mask = numpy.zeros((4096, 4096), dtype=numpy.uint8)
+    mask[:2048, :2048] = numpy.arange(2048, dtype=numpy.uint8)[:, None]
+    Image.fromarray(mask).save(tmp_path / FNAMES.legacy_mask(M_TIL_X, M_TIL_Y))
+    return tmp_path
+
+
+def legacy_needs_mask(big_img, tile, til_x_left, til_y_top, zl):
+    """needs_mask as it was, with PIL crops of the mask."""
+    factor = 2 ** (zl - tile.mask_zl)
+    rx = int((til_x_left - factor * M_TIL_X) / 16)
+    ry = int((til_y_top - factor * M_TIL_Y) / 16)
+    x0 = int(rx * 4096 / factor)
+    y0 = int(ry * 4096 / factor)
+    small_img = big_img.crop((x0, y0, x0 + 4096 // factor, y0 + 4096 // factor))
+    if numpy.array(small_img).max() <= 30:
+        return False
+    return small_img
+
+
+def test_masks_are_decoded_once(mask_dir):
+    tile = types.SimpleNamespace(lat=45, lon=6, mask_zl=14)
+    big_img = Image.open(mask_dir / FNAMES.legacy_mask(M_TIL_X, M_TIL_Y))
+    big_img.load()
+    for zl in (16, 17):
+        factor = 2 ** (zl - 14)
+        for til_y in range(M_TIL_Y * factor, (M_TIL_Y + 16) * factor, 16):
+            for til_x in range(M_TIL_X * factor, (M_TIL_X + 16) * factor, 16):
+                expected = legacy_needs_mask(big_img, tile, til_x, til_y, zl)
+                mask_im = MASK.needs_mask(tile, til_x, til_y, zl, "BI")
+                if expected is False:
+                    assert mask_im is False
+                else:
+                    assert mask_im.mode == "L"
+                    assert numpy.array_equal(
+                        numpy.array(mask_im), numpy.array(expected)
+                    )
+    # 16 textures at ZL16 and 64 at ZL17, one decode, the coverage summary
+    # answers for the dry ones and the 4 + 16 wet ones are cut from the mask
+    assert MASK.mask_cache_stats == {"decodes": 1, "hits": 20}
+    # no mask, no decode
+    assert MASK.needs_mask(tile, 0, 0, 16) is False
+    assert MASK.mask_cache_stats["decodes"] == 1
+
+
+def test_changed_files(mask_dir):
+    mask_file = str(mask_dir / "mask.png")
+    Image.new("L", (1024, 1024), 200).save(mask_file)
+    assert MASK.read_mask(mask_file).max() == 200
+    assert MASK.read_mask(mask_file).max() == 200
+    assert MASK.mask_cache_stats == {"decodes": 1, "hits": 1}
+    # a mask rebuilt meanwhile is read again
+    Image.fromarray(numpy.zeros((1024, 1024), dtype=numpy.uint8)).save(mask_file)
+    os.utime(mask_file, ns=(0, os.stat(mask_file).st_mtime_ns + 10 ** 9))
+    assert MASK.read_mask(mask_file).max() == 0
+    assert MASK.mask_cache_stats == {"decodes": 2, "hits": 1}
+    assert MASK.read_mask(str(mask_dir / "none.png")) is None
+
+
+def test_cache_size_bound(mask_dir, monkeypatch):
+    monkeypatch.setattr(MASK, "mask_cache_size", 3)
+    for i in range(5):
+        Image.new("L", (1024, 1024), i).save(mask_dir / (str(i) + ".png"))
+        MASK.read_mask(str(mask_dir / (str(i) + ".png")))
+    names = [str(mask_dir / (str(i) + ".png")) for i in range(5)]
+    # 1MB each, the last three are kept
+    assert list(MASK.mask_cache) == names[2:]
+    MASK.read_mask(names[2])
+    MASK.read_mask(names[0])
+    assert list(MASK.mask_cache) == [names[4], names[2], names[0]]
+    assert MASK.mask_cache_stats == {"decodes": 6, "hits": 1}
+
+
+def test_dry_textures_need_no_decode(mask_dir, monkeypatch):
+    # room for no mask at all, only the coverage summaries are kept
+    monkeypatch.setattr(MASK, "mask_cache_size", 0)
+    tile = types.SimpleNamespace(lat=45, lon=6, mask_zl=14)
+    wet = []
+    for til_y in range(M_TIL_Y * 4, (M_TIL_Y + 16) * 4, 16):
+        for til_x in range(M_TIL_X * 4, (M_TIL_X + 16) * 4, 16):
+            if MASK.needs_mask(tile, til_x, til_y, 16) is not False:
+                wet.append((til_x, til_y))
+    # water in the top left quarter only
+    assert len(wet) == 4
+    # one decode for the summary, then one for each wet texture
+    assert MASK.mask_cache_stats["decodes"] == 1 + 4
+
+
+def test_texture_masks_are_cut_from_the_cache(mask_dir, monkeypatch):
+    import O4_Imagery_Utils as IMG
+
+    tile = types.SimpleNamespace(
+        lat=45, lon=6, mask_zl=14, build_dir=str(mask_dir)
+    )
+    os.makedirs(mask_dir / "textures")
+    (til_x, til_y) = (M_TIL_X * 4 + 16, M_TIL_Y * 4 + 16)
+    mask_im = MASK.needs_mask(tile, til_x, til_y, 16)
+    mask_file = mask_dir / "textures" / FNAMES.mask_file(til_x, til_y, 16, "BI")
+    mask_im.save(mask_file)
+    decodes = MASK.mask_cache_stats["decodes"]
+    converted = IMG.texture_mask(tile, til_x, til_y, 16, "BI")
+    assert converted.tobytes() == mask_im.tobytes()
+    assert MASK.mask_cache_stats["decodes"] == decodes
+    # out of the cache, its own file is read
+    MASK.mask_cache.clear()
+    assert IMG.texture_mask(tile, til_x, til_y, 16, "BI").tobytes() == (
+        mask_im.tobytes()
+    )
+    os.remove(mask_file)
+    assert IMG.texture_mask(tile, til_x, til_y, 16, "BI") is None
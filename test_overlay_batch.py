@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Overlay extraction tests for Ortho4XPDark
+=========================================
+
+Extracts the overlays of a batch of tiles in parallel processes, through a
+stand-in for DSFTool, and checks that each tile gets its overlay DSF with
+the polygons and roads which are not excluded, and that the tiles without a
+Global Scenery DSF fail on their own.
+
+Author: Ortho4XPDark Team
+"""
+
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+# Add src directory to path for imports
+current_dir = Path(__file__).parent
+src_dir = current_dir / "src"
+sys.path.insert(0, str(src_dir))
+
+import O4_File_Names as FNAMES
+import O4_Overlay_Utils as OVL
+
+LAT, LON = 45, 6
+
+
+@pytest.fixture
+def gs_dir(tmp_path, monkeypatch):
+    gs_dir = tmp_path / "Global Scenery"
+    for (lat, lon) in ((LAT, LON), (LAT, LON + 1)):
+        os.makedirs(
+            gs_dir / "Earth nav data" / FNAMES.round_latlon(lat, lon),
+            exist_ok=True,
+        )
+        dsf_file = FNAMES.long_latlon(lat, lon) + ".dsf"
+        (gs_dir / "Earth nav data" / dsf_file).write_bytes(
+            b"XPLNEDSF" + bytes(24)
+        )
+    os.makedirs(tmp_path / "tmp")
+    monkeypatch.setattr(FNAMES, "Tmp_dir", str(tmp_path / "tmp"))
+    monkeypatch.setattr(FNAMES, "Overlay_dir", str(tmp_path / "yOrtho4XP_Overlays"))
+    monkeypatch.setattr(OVL, "custom_overlay_src", str(gs_dir))
+    # the overlay processes write Ortho4XP.log in their working directory
+    monkeypatch.chdir(tmp_path)
+    return gs_dir
+
+
+def overlay_file(lat, lon):
+    return os.path.join(
+        FNAMES.Overlay_dir,
+        "Earth nav data",
+        FNAMES.round_latlon(lat, lon),
+        FNAMES.short_latlon(lat, lon) + ".dsf",
+    )
+
+
+DSF_TEXT = """PROPERTY sim/west 6
+PROPERTY sim/south 45
+POLYGON_DEF lib/beach.bch
+POLYGON_DEF lib/forest.for
+NETWORK_DEF lib/g10/roads.net
+BEGIN_POLYGON 0 255 2
+BEGIN_WINDING
+POLYGON_POINT 6.1 45.1
+POLYGON_POINT 6.2 45.1
+END_WINDING
+END_POLYGON
+BEGIN_POLYGON 1 255 2
+BEGIN_WINDING
+POLYGON_POINT 6.3 45.3
+POLYGON_POINT 6.4 45.3
+END_WINDING
+END_POLYGON
+BEGIN_SEGMENT 0 22001 1 6.5 45.5 0
+END_SEGMENT 2 6.6 45.5 0
+BEGIN_SEGMENT 0 1 3 6.7 45.7 0
+END_SEGMENT 4 6.8 45.7 0
+"""
+
+
+@pytest.fixture
+def dsftool(tmp_path, monkeypatch):
+    # a stand-in for DSFTool: -dsf2text writes DSF_TEXT for any DSF, and
+    # -text2dsf copies the text as it is
+    script = tmp_path / "DSFTool"
+    script.write_text(
+        "#!" + sys.executable + "\n"
+        "import shutil, sys\n"
+        "(mode, src, dst) = sys.argv[1:4]\n"
+        "if mode == '-dsf2text':\n"
+        "    with open(src, 'rb') as f:\n"
+        "        assert f.read(8) == b'XPLNEDSF'\n"
+        "    with open(dst, 'w') as f:\n"
+        "        f.write(" + repr(DSF_TEXT) + ")\n"
+        "else:\n"
+        "    shutil.copy(src, dst)\n"
+        "print('DSFTool', mode, 'done')\n"
+    )
+    script.chmod(0o755)
+    monkeypatch.setattr(OVL, "dsftool_cmd", str(script) + " ")
+    return script
+
+
+def test_batch_of_overlays(gs_dir, dsftool, monkeypatch):
+    monkeypatch.setattr(OVL, "max_overlay_slots", 2)
+    monkeypatch.setattr(OVL, "ovl_exclude_pol", [0])
+    monkeypatch.setattr(OVL, "ovl_exclude_net", [22001])
+    # no Global Scenery DSF for the last tile
+    tiles = [(LAT, LON), (LAT, LON + 1), (LAT + 1, LON)]
+    results = OVL.build_overlays(tiles)
+    assert sorted(results) == sorted(tiles)
+    for (lat, lon) in tiles[:2]:
+        (elapsed, error) = results[(lat, lon)]
+        assert error is None and elapsed > 0
+        # the workers got the exclusions of this process
+        with open(overlay_file(lat, lon)) as f:
+            lines = f.read().splitlines()
+        assert lines[0] == "PROPERTY sim/overlay 1"
+        # the beach and the powerline are left aside
+        assert [l.split()[:3] for l in lines if "BEGIN_" in l] == [
+            ["BEGIN_POLYGON", "1", "255"],
+            ["BEGIN_WINDING"],
+            ["BEGIN_SEGMENT", "0", "1"],
+        ]
+    assert results[tiles[2]][1]
+    assert not os.path.exists(overlay_file(*tiles[2]))
+    # the tmp dirs of the tiles are gone
+    assert os.listdir(FNAMES.Tmp_dir) == []
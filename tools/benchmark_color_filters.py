@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Color filter benchmark
+======================
+
+Compares, for a few filter chains applied to a synthetic texture, the number
+of full image passes and the time spent when every filter is applied in
+turn and when the point operations are folded into lookup tables.
+
+Usage: python tools/benchmark_color_filters.py [texture_size]
+"""
+
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+import numpy
+from math import pi, tan
+from PIL import Image, ImageEnhance, ImageFilter
+
+import O4_Imagery_Utils as IMG
+
+
+color_filters_chains = {
+    "bc_only": [["brightness-contrast", 10, 20]],
+    "dark": [["brightness-contrast", -15, 5], ["saturation", 20]],
+    "mixed": [
+        ["brightness-contrast", 5, 10],
+        ["levels", 10, 1.2, 240, 0, 255, 5, 0.9, 250, 3, 250, 0, 1, 255, 0, 255],
+        ["saturation", -10],
+        ["brightness-contrast", -3, 4],
+        ["sharpness", 1.5],
+        ["levels", 0, 1.1, 255, 0, 255, 0, 1, 255, 0, 255, 0, 0.8, 255, 0, 255],
+        ["blur", 0.7],
+    ],
+    # the second levels divides by zero, the filters stop there
+    "broken": [
+        ["brightness-contrast", 5, 10],
+        ["levels", 0, 1, 100, 0, 255, 0, 1, 255, 0, 255, 0, 1, 255, 0, 255],
+        ["levels", 50, 1, 50, 0, 255, 0, 1, 255, 0, 255, 0, 1, 255, 0, 255],
+        ["saturation", 50],
+    ],
+}
+
+
+def legacy_color_transform(im, color_code):
+    # color_transform as it was, every filter applied in turn
+    try:
+        for color_filter in IMG.color_filters_dict[color_code]:
+            # both range from -127 to 127,
+            # http://gimp.sourcearchive.com/documentation/2.6.1/\
+            # gimpbrightnesscontrastconfig_8c-source.html
+            if color_filter[0] == "brightness-contrast":
+                (brightness, contrast) = color_filter[1:3]
+                if brightness >= 0:
+                    im = im.point(
+                        lambda i: 128
+                        + tan(pi / 4 * (1 + contrast / 128))
+                        * (brightness + (255 - brightness) / 255 * i - 128)
+                    )
+                else:
+                    im = im.point(
+                        lambda i: 128
+                        + tan(pi / 4 * (1 + contrast / 128))
+                        * ((255 + brightness) / 255 * i - 128)
+                    )
+            elif color_filter[0] == "saturation":
+                saturation = color_filter[1]
+                im = ImageEnhance.Color(im).enhance(1 + saturation / 100)
+            elif color_filter[0] == "sharpness":
+                im = ImageEnhance.Sharpness(im).enhance(color_filter[1])
+            elif color_filter[0] == "blur":
+                im = im.filter(ImageFilter.GaussianBlur(color_filter[1]))
+            # levels range between 0 and 255, gamma is neutral at 1
+            # https://pippin.gimp.org/image-processing/chap_point.html
+            elif color_filter[0] == "levels":
+                bands = im.split()
+                for j in [0, 1, 2]:
+                    in_min, gamma, in_max, out_min, out_max = color_filter[
+                        5 * j + 1 : 5 * j + 6
+                    ]
+                    bands[j].paste(
+                        bands[j].point(
+                            lambda i: out_min
+                            + (out_max - out_min)
+                            * (
+                                (max(in_min, min(i, in_max)) - in_min)
+                                / (in_max - in_min)
+                            )
+                            ** (1 / gamma)
+                        )
+                    )
+                im = Image.merge(im.mode, bands)
+        return im
+    except:
+        return im
+
+
+def synthetic_texture(size, seed=0):
+    rng = numpy.random.default_rng(seed)
+    return Image.fromarray(
+        rng.integers(0, 256, (size, size, 3), dtype=numpy.uint8)
+    )
+
+
+def legacy_passes(color_filters):
+    # levels is a split, three points and a merge
+    return sum(
+        5 if color_filter[0] == "levels" else 1
+        for color_filter in color_filters
+    )
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 4096
+    texture = synthetic_texture(size)
+    print("Texture of", size, "x", size, "pixels.")
+    for (color_code, color_filters) in sorted(color_filters_chains.items()):
+        IMG.color_filters_dict[color_code] = color_filters
+        timer = time.time()
+        legacy_color_transform(texture, color_code)
+        legacy_time = time.time() - timer
+        timer = time.time()
+        IMG.color_transform(texture, color_code)
+        compiled_time = time.time() - timer
+        print(
+            "  {:8s}: legacy {:2d} passes {:6.3f} s, "
+            "compiled {:2d} passes {:6.3f} s".format(
+                color_code,
+                legacy_passes(color_filters),
+                legacy_time,
+                len(IMG.compiled_color_filters[color_code]),
+                compiled_time,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Combined texture compositing benchmark
+======================================
+
+Times the blending of synthetic combined provider layers into one RGBA
+texture and reports the peak of the numpy memory allocated meanwhile (as
+traced by tracemalloc), for the strip-wise engine of combine_textures and
+for the former per layer Image.composite.
+
+Usage: python tools/benchmark_combine.py [texture_size] [nbr_layers]
+"""
+
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+import numpy
+from PIL import Image, ImageFilter
+
+import O4_Imagery_Utils as IMG
+
+
+def synthetic_layers(size, priorities, seed=0):
+    # noisy imagery with white and black patches, and blurred random masks
+    rng = numpy.random.default_rng(seed)
+    layers = []
+    for priority in priorities:
+        true_arr = rng.integers(0, 256, (size, size, 3), dtype=numpy.uint8)
+        true_arr[: size // 8] = 255
+        true_arr[-size // 8 :] = 3
+        mask_arr = (rng.random((size // 16, size // 16)) > 0.5) * 255
+        mask_im = (
+            Image.fromarray(mask_arr.astype(numpy.uint8))
+            .resize((size, size), Image.NEAREST)
+            .filter(ImageFilter.GaussianBlur(size / 64))
+        )
+        layers.append((Image.fromarray(true_arr), mask_im, priority))
+    return layers
+
+
+def legacy_composite(layers, size):
+    # combine_textures as it was, one Image.composite per layer
+    big_image = Image.new("RGBA", (size, size))
+    mask_weight_below = numpy.zeros((size, size), dtype=numpy.uint16)
+    for (true_im, mask_im, priority) in layers:
+        mask = numpy.array(mask_im, dtype=numpy.uint16)
+        true_arr = numpy.array(true_im).astype(numpy.uint16)
+        mask[
+            (numpy.sum(true_arr, axis=2) >= 735) * (mask >= 1) * (mask <= 253)
+        ] = 0
+        mask[
+            (numpy.sum(true_arr, axis=2) <= 35) * (mask >= 1) * (mask <= 253)
+        ] = 0
+        if priority == "low":
+            wasnt_zero = (mask_weight_below + mask) != 0
+            mask[wasnt_zero] = (
+                255 * mask[wasnt_zero] / (mask_weight_below + mask)[wasnt_zero]
+            )
+        elif priority in ["high", "mask"]:
+            mask_weight_below += mask
+        elif priority == "medium":
+            not_zero = mask != 0
+            mask_weight_below += mask
+            mask[not_zero] = 255 * mask[not_zero] / mask_weight_below[not_zero]
+        mask = Image.fromarray(mask.astype(numpy.uint8))
+        big_image = Image.composite(true_im, big_image, mask)
+    return big_image
+
+
+def fused_composite(layers, size):
+    big_array = numpy.zeros((4, size, size), dtype=numpy.uint8)
+    mask_weight_below = numpy.zeros((size, size), dtype=numpy.uint16)
+    for (true_im, mask_im, priority) in layers:
+        IMG.composite_layer(
+            big_array, mask_weight_below, true_im, mask_im, priority
+        )
+    return Image.merge("RGBA", [Image.fromarray(band) for band in big_array])
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 4096
+    nbr_layers = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    priorities = (["high", "medium", "low"] * nbr_layers)[:nbr_layers]
+    layers = synthetic_layers(size, priorities)
+    print("Texture of", size, "x", size, "pixels,", nbr_layers, "layers.")
+    for (name, composite) in (
+        ("legacy", legacy_composite),
+        ("fused", fused_composite),
+    ):
+        tracemalloc.start()
+        timer = time.time()
+        composite(layers, size)
+        elapsed = time.time() - timer
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(
+            "  {:8s}: {:7.3f} s, numpy peak {:7.1f} MB".format(
+                name, elapsed, peak / 1024 ** 2
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
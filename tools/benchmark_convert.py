@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Texture conversion handoff benchmark
+====================================
+
+Times, for a synthetic 4096x4096 orthophoto, what a conversion process
+spends reading and decoding the JPEG from disk, against what handing the
+decoded pixels over through multiprocessing.shared_memory would cost (the
+copy into the block by the downloading process, the attach by the
+conversion process), and against the whole conversion with the numpy DDS
+encoder.
+
+Usage: python tools/benchmark_convert.py [nbr_runs]
+"""
+
+import os
+import statistics
+import sys
+import tempfile
+import time
+import types
+from multiprocessing import shared_memory
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+import numpy
+from PIL import Image, ImageFilter
+
+import O4_File_Names as FNAMES
+import O4_Imagery_Utils as IMG
+import O4_UI_Utils as UI
+
+
+def synthetic_ortho(size, seed=0):
+    # smooth fields with some grain on top, about as compressible as aerial
+    # imagery
+    rng = numpy.random.default_rng(seed)
+    fields = Image.fromarray(
+        rng.integers(0, 256, (size // 64, size // 64, 3), dtype=numpy.uint8)
+    ).resize((size, size), Image.BICUBIC)
+    grain = rng.normal(0, 12, (size, size, 3))
+    arr = numpy.clip(numpy.array(fields, dtype=numpy.float32) + grain, 0, 255)
+    return Image.fromarray(arr.astype(numpy.uint8)).filter(
+        ImageFilter.GaussianBlur(0.6)
+    )
+
+
+def median_time(function, nbr_runs):
+    times = []
+    for _ in range(nbr_runs):
+        timer = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - timer)
+    return statistics.median(times)
+
+
+def shared_memory_handoff(im):
+    arr = numpy.asarray(im)
+    block = shared_memory.SharedMemory(create=True, size=arr.nbytes)
+    try:
+        numpy.ndarray(arr.shape, arr.dtype, block.buf)[:] = arr
+        attached = shared_memory.SharedMemory(name=block.name)
+        Image.frombuffer(
+            "RGB", im.size, attached.buf, "raw", "RGB", 0, 1
+        ).load()
+        attached.close()
+    finally:
+        block.close()
+        block.unlink()
+
+
+def main():
+    nbr_runs = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    UI.verbosity = 0
+    UI.logprint = lambda *args: None
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        FNAMES.Imagery_dir = os.path.join(tmp_dir, "Imagery")
+        provider = {
+            "code": "BENCH",
+            "imagery_dir": "normal",
+            "color_filters": "none",
+        }
+        IMG.providers_dict["BENCH"] = provider
+        IMG.dds_encoder = "numpy"
+        tile = types.SimpleNamespace(
+            lat=45, lon=6, build_dir=tmp_dir, imprint_masks_to_dds=False
+        )
+        os.makedirs(os.path.join(tmp_dir, "textures"))
+        file_dir = FNAMES.jpeg_file_dir_from_attributes(45, 6, 16, provider)
+        os.makedirs(file_dir)
+        file_name = os.path.join(
+            file_dir,
+            FNAMES.jpeg_file_name_from_attributes(34000, 22000, 16, "BENCH"),
+        )
+        im = synthetic_ortho(4096)
+        im.save(file_name, format="JPEG")
+        print(
+            "Orthophoto of 4096 x 4096 pixels, JPEG of {:.1f} MB.".format(
+                os.path.getsize(file_name) / 1024 ** 2
+            )
+        )
+        decode = median_time(lambda: Image.open(file_name).load(), nbr_runs)
+        handoff = median_time(lambda: shared_memory_handoff(im), nbr_runs)
+        conversion = median_time(
+            lambda: IMG.convert_texture(tile, 34000, 22000, 16, "BENCH"),
+            nbr_runs,
+        )
+        for (name, elapsed) in (
+            ("JPEG read", decode),
+            ("shm handoff", handoff),
+            ("conversion", conversion),
+        ):
+            print(
+                "  {:12s}: {:7.3f} s, {:5.1f} % of the conversion".format(
+                    name, elapsed, 100 * elapsed / conversion
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
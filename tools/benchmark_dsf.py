@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+DSF writer benchmark
+====================
+
+Times the writing of the pools and patches of a synthetic tile to disk,
+md5 footer included, with the bulk DSF_Writer and with the former value
+by value writer (which reads the file back for its md5). Each writer runs
+in its own process so that its peak RSS can be reported, along with its
+increase over the one reached while building the synthetic data.
+
+Usage: python tools/benchmark_dsf.py [nbr_tris]
+"""
+
+import array
+import hashlib
+import os
+import resource
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+import numpy
+
+import O4_DSF_Utils as DSF
+
+
+class LegacyWriter(DSF.DSF_Writer):
+    """The former writer : one struct.pack per value, and the md5 of the
+    file read back once it is written."""
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.f = open(file_name, "wb")
+
+    def write(self, data):
+        self.f.write(data)
+
+    def pool_atom(self, planes, encodings):
+        (nbr_planes, length) = planes.shape
+        pool = planes.T.ravel()
+        self.f.write(b"LOOP")
+        self.f.write(
+            struct.pack("<I", 13 + nbr_planes + 2 * nbr_planes * length)
+        )
+        self.f.write(struct.pack("<I", length))
+        self.f.write(struct.pack("<B", nbr_planes))
+        for l in range(nbr_planes):
+            self.f.write(struct.pack("<B", 0))
+            for m in range(length):
+                self.f.write(struct.pack("<H", pool[nbr_planes * m + l]))
+
+    def scal_atom(self, params, nbr_planes):
+        self.f.write(b"LACS")
+        self.f.write(struct.pack("<I", 8 + 8 * nbr_planes))
+        for l in range(2 * nbr_planes):
+            self.f.write(struct.pack("<f", params[l]))
+
+    def patch_triangles(self, command, coords, width):
+        nbr_coords = len(coords) // width
+        for j in range(0, nbr_coords, 255):
+            count = min(255, nbr_coords - j)
+            self.f.write(struct.pack("<B", command))
+            self.f.write(struct.pack("<B", count))
+            for k in range(width * j, width * (j + count)):
+                self.f.write(struct.pack("<H", coords[k]))
+
+    def close(self):
+        self.f.close()
+        with open(self.file_name, "rb") as f:
+            md5sum = hashlib.md5(f.read()).digest()
+        with open(self.file_name, "ab") as f:
+            f.write(md5sum)
+
+
+def synthetic_dsf(nbr_tris, seed=0):
+    """write_dsf arguments (but the file name) for random pools and
+    patches holding about nbr_tris triangles."""
+    rng = numpy.random.default_rng(seed)
+    pool_nbr = nbr_tris // 20000 + 2
+    dsf_pool_plane = numpy.array([7] * pool_nbr + [9] * pool_nbr + [7] * pool_nbr)
+    dsf_pool_length = rng.integers(1, 20000, 3 * pool_nbr)
+    # a few pools left empty
+    dsf_pool_length[rng.random(3 * pool_nbr) < 0.2] = 0
+    dsf_pools = {}
+    for (k, (length, planes)) in enumerate(zip(dsf_pool_length, dsf_pool_plane)):
+        dsf_pools[k] = array.array("H")
+        dsf_pools[k].frombytes(
+            rng.integers(0, 65536, length * planes, dtype=numpy.uint16).tobytes()
+        )
+    pool_param = [tuple(rng.uniform(-10, 10, 18).tolist()) for _ in range(pool_nbr)]
+    used = numpy.flatnonzero(dsf_pool_length)
+    textured_tris = {}
+    nbr_terrains = nbr_tris // 50000 + 5
+    for terrain_idx in range(nbr_terrains):
+        textured_tris[terrain_idx] = {}
+        for pool in rng.choice(used, min(len(used), 3), replace=False).tolist():
+            size = 3 * int(rng.integers(1, 2 * nbr_tris // (3 * nbr_terrains) + 2))
+            textured_tris[terrain_idx][pool] = array.array(
+                "H",
+                rng.integers(0, dsf_pool_length[pool], size, dtype=numpy.uint16)
+                .tobytes(),
+            )
+        pools = rng.choice(used, 3 * int(rng.integers(1, 400)))
+        cross = numpy.empty(2 * len(pools), dtype=numpy.uint16)
+        cross[0::2] = pools
+        cross[1::2] = rng.integers(0, dsf_pool_length[pools])
+        textured_tris[terrain_idx]["cross-pool"] = array.array(
+            "H", cross.tobytes()
+        )
+    textured_tris[nbr_terrains] = {}
+    atoms = {name: b"" for name in ("OBJT", "POLY", "NETW", "DEMN", "GEOD")}
+    atoms["PROP"] = b"sim/west\x00-10\x00sim/south\x0045\x00"
+    atoms["TERT"] = b"".join(
+        b"terrain/" + str(k).encode() + b".ter\x00"
+        for k in range(nbr_terrains + 1)
+    )
+    # a 16 bits signed elevation raster
+    raster = rng.integers(-500, 5000, (21, 31), dtype=numpy.int16)
+    atoms["DEMS"] = (
+        struct.pack("<4sIBBHIIff", b"IMED", 28, 1, 2, 1, 31, 21, 1.0, 0.0)
+        + struct.pack("<4sI", b"DMED", 8 + raster.nbytes)
+        + raster.astype("<i2").tobytes()
+    )
+    atoms["CMDS"] = b""
+    return (
+        types.SimpleNamespace(overlay_lod=25000),
+        atoms,
+        dsf_pools,
+        dsf_pool_length,
+        dsf_pool_plane,
+        pool_param,
+        textured_tris,
+        set(range(0, nbr_terrains, 3)),
+        2,
+    )
+
+
+def run(name, nbr_tris):
+    arguments = synthetic_dsf(nbr_tris)
+    if name == "legacy":
+        DSF.DSF_Writer = LegacyWriter
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dsf_file_name = os.path.join(tmp_dir, "bench.dsf")
+        timer = time.time()
+        DSF.write_dsf(dsf_file_name, *arguments)
+        elapsed = time.time() - timer
+        size = os.path.getsize(dsf_file_name + ".tmp")
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kB on Linux, in bytes on macOS
+    unit = 1024 ** 2 if sys.platform == "darwin" else 1024
+    print(
+        "  {:8s}: {:7.3f} s, {:7.1f} MB written, peak RSS {:7.1f} MB"
+        " (+{:.1f} MB)".format(
+            name,
+            elapsed,
+            size / 1024 ** 2,
+            rss_after / unit,
+            (rss_after - rss_before) / unit,
+        )
+    )
+
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == "--run":
+        run(sys.argv[2], int(sys.argv[3]))
+        return
+    nbr_tris = int(sys.argv[1]) if len(sys.argv) > 1 else 3000000
+    print("Synthetic tile with about", nbr_tris, "triangles.")
+    for name in ("legacy", "bulk"):
+        subprocess.run(
+            [sys.executable, __file__, "--run", name, str(nbr_tris)],
+            check=True,
+        )
+
+
+if __name__ == "__main__":
+    main()
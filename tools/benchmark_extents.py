@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Extent coverage micro-benchmark
+===============================
+
+Times has_data over a synthetic extent mask, against the former way of
+reading, cropping and testing the extent PNG at each call.
+
+Usage: python tools/benchmark_extents.py [extent_size] [nbr_calls]
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+import numpy
+from PIL import Image, ImageFilter, ImageOps
+
+import O4_File_Names as FNAMES
+import O4_Geo_Utils as GEO
+import O4_Imagery_Utils as IMG
+import O4_UI_Utils as UI
+
+
+def synthetic_extent(size):
+    # a blurred disc: fully covered, empty and partial areas
+    yy, xx = numpy.mgrid[0:size, 0:size]
+    disc = (xx - size / 2) ** 2 + (yy - size / 2) ** 2 < (size / 3) ** 2
+    im = Image.fromarray((255 * disc).astype(numpy.uint8))
+    return im.filter(ImageFilter.GaussianBlur(size / 50))
+
+
+def legacy_has_data(
+    bbox,
+    extent_code,
+    return_mask=False,
+    mask_size=(4096, 4096),
+    is_sharp_resize=False,
+    is_mask_layer=False,
+):
+    # has_data as it was, reading the extent PNG from disk at each call
+    (x0, y0, x1, y1) = bbox
+    try:
+        # global layers need special treatment
+        if extent_code == "global" and (not is_mask_layer or (x1 - x0) == 1):
+            return (not return_mask) or Image.new("L", mask_size, "white")
+        if extent_code[0] == "!":
+            extent_code = extent_code[1:]
+            negative = True
+        else:
+            negative = False
+        (xmin, ymin, xmax, ymax) = (
+            IMG.extents_dict[extent_code]["mask_bounds"]
+            if extent_code != "global"
+            else (-180, -90, 180, 90)
+        )
+        if x0 > xmax or x1 < xmin or y0 < ymin or y1 > ymax:
+            return negative
+        if (not is_mask_layer) or (x1 - x0) == 1:
+            mask_im = Image.open(
+                os.path.join(
+                    FNAMES.Extent_dir,
+                    IMG.extents_dict[extent_code]["dir"],
+                    IMG.extents_dict[extent_code]["code"] + ".png",
+                )
+            ).convert("L")
+            (sizex, sizey) = mask_im.size
+            pxx0 = int((x0 - xmin) / (xmax - xmin) * sizex)
+            pxx1 = int((x1 - xmin) / (xmax - xmin) * sizex)
+            pxy0 = int((ymax - y0) / (ymax - ymin) * sizey)
+            pxy1 = int((ymax - y1) / (ymax - ymin) * sizey)
+            if not return_mask:
+                pxx0 = max(-1, pxx0)
+                pxx1 = min(sizex, pxx1)
+                pxy0 = max(-1, pxy0)
+                pxy1 = min(sizey, pxy1)
+            mask_im = mask_im.crop((pxx0, pxy0, pxx1, pxy1))
+            if negative:
+                mask_im = ImageOps.invert(mask_im)
+            if not mask_im.getbbox():
+                return False
+            if not return_mask:
+                return True
+            if is_sharp_resize:
+                return mask_im.resize(mask_size)
+            else:
+                return mask_im.resize(mask_size, Image.BICUBIC)
+        else:
+            # following code only visited when is_mask_layer is True
+            # in which case it is passed as (lat,lon,mask_zl)
+            # check if sea mask file exists
+            (lat, lon, mask_zl) = is_mask_layer
+            (m_tilx, m_tily) = GEO.wgs84_to_orthogrid(
+                (y0 + y1) / 2, (x0 + x1) / 2, mask_zl
+            )
+            if os.path.isdir(
+                os.path.join(FNAMES.mask_dir(lat, lon), "Combined_imagery")
+            ):
+                check_dir = os.path.join(
+                    FNAMES.mask_dir(lat, lon), "Combined_imagery"
+                )
+            else:
+                check_dir = FNAMES.mask_dir(lat, lon)
+            if not os.path.isfile(
+                os.path.join(check_dir, FNAMES.legacy_mask(m_tilx, m_tily))
+            ):
+                return False
+            # build extent mask_im
+            if extent_code != "global":
+                mask_im = Image.open(
+                    os.path.join(
+                        FNAMES.Extent_dir,
+                        IMG.extents_dict[extent_code]["dir"],
+                        IMG.extents_dict[extent_code]["code"] + ".png",
+                    )
+                ).convert("L")
+                (sizex, sizey) = mask_im.size
+                pxx0 = int((x0 - xmin) / (xmax - xmin) * sizex)
+                pxx1 = int((x1 - xmin) / (xmax - xmin) * sizex)
+                pxy0 = int((ymax - y0) / (ymax - ymin) * sizey)
+                pxy1 = int((ymax - y1) / (ymax - ymin) * sizey)
+                mask_im = mask_im.crop((pxx0, pxy0, pxx1, pxy1))
+                if negative:
+                    mask_im = ImageOps.invert(mask_im)
+                if not mask_im.getbbox():
+                    return False
+                if is_sharp_resize:
+                    mask_im = mask_im.resize(mask_size)
+                else:
+                    mask_im = mask_im.resize(mask_size, Image.BICUBIC)
+            else:
+                mask_im = Image.new("L", mask_size, "white")
+            # build sea mask_im2
+            (ymax, xmin) = GEO.gtile_to_wgs84(m_tilx, m_tily, mask_zl)
+            (ymin, xmax) = GEO.gtile_to_wgs84(m_tilx + 16, m_tily + 16, mask_zl)
+            mask_im2 = Image.open(
+                os.path.join(check_dir, FNAMES.legacy_mask(m_tilx, m_tily))
+            ).convert("L")
+            (sizex, sizey) = mask_im2.size
+            pxx0 = int((x0 - xmin) / (xmax - xmin) * sizex)
+            pxx1 = int((x1 - xmin) / (xmax - xmin) * sizex)
+            pxy0 = int((ymax - y0) / (ymax - ymin) * sizey)
+            pxy1 = int((ymax - y1) / (ymax - ymin) * sizey)
+            mask_im2 = mask_im2.crop((pxx0, pxy0, pxx1, pxy1)).resize(
+                mask_size, Image.BICUBIC
+            )
+            # invert it
+            mask_array2 = 255 - numpy.array(mask_im2, dtype=numpy.uint8)
+            # let full sea down (if you wish to...)
+            # mask_array2[mask_array2==255]=0
+            #  combine (multiply) both
+            mask_array = numpy.array(mask_im, dtype=numpy.uint16)
+            mask_array = (mask_array * mask_array2 / 255).astype(numpy.uint8)
+            mask_im = Image.fromarray(mask_array).convert("L")
+            if not mask_im.getbbox():
+                return False
+            if not return_mask:
+                return True
+            return mask_im
+    except Exception as e:
+        UI.vprint(1, "Could not test coverage of ", extent_code, " !!!")
+        UI.vprint(2, e)
+        return False
+
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+    nbr_calls = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        FNAMES.Extent_dir = tmp_dir
+        os.makedirs(os.path.join(tmp_dir, "Test"))
+        synthetic_extent(size).save(os.path.join(tmp_dir, "Test", "TEST.png"))
+        IMG.extents_dict["TEST"] = {
+            "dir": "Test",
+            "code": "TEST",
+            "mask_bounds": [0, 0, 10, 10],
+        }
+        random.seed(0)
+        bboxes = []
+        for _ in range(nbr_calls):
+            (x0, y1) = (random.uniform(0, 9.9), random.uniform(0, 9.9))
+            bboxes.append((x0, y1 + 0.1, x0 + 0.1, y1))
+        print("Extent of", size, "x", size, "pixels,", nbr_calls, "bboxes.")
+        for (name, check) in (
+            ("legacy", lambda bbox: legacy_has_data(bbox, "TEST")),
+            ("cached", lambda bbox: IMG.has_data(bbox, "TEST")),
+        ):
+            timer = time.time()
+            results = [check(bbox) for bbox in bboxes]
+            elapsed = time.time() - timer
+            print(
+                "  {:8s}: {:8.3f} s, {:8.3f} ms per call, {} covered".format(
+                    name, elapsed, 1000 * elapsed / nbr_calls, sum(results)
+                )
+            )
+        print("  decoded", IMG.extent_cache_stats["decoded"], "time(s).")
+
+
+if __name__ == "__main__":
+    main()